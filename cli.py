@@ -1,19 +1,190 @@
 #!/usr/bin/env python
+import glob
 import json
+import os
 import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 
+import mpy
+import uploader
 
-def mkdir_cmd(port, dir_path):
-    return ['ampy', '--port', port, '-d', '0.5', 'mkdir', dir_path]
 
+# esptool can be pointed elsewhere, e.g. at a fake for a dry run
+ESPTOOL = os.environ.get('ESPTOOL', 'esptool.py')
 
-def put_cmd(port, src_path, dest_path=None):
-    cmd_list = ['ampy', '--port', port, '-d', '0.5', 'put', src_path]
-    if dest_path:
-        cmd_list.append(dest_path)
-    return cmd_list
+ECHO_LOCK = threading.Lock()
+
+
+def erase_cmd(chip, port):
+    return [ESPTOOL, '--chip', chip, '--port', port, 'erase_flash']
+
+
+def write_flash_cmd(chip, port, bin_file):
+    return [
+        ESPTOOL,
+        '--chip',
+        chip,
+        '--port',
+        port,
+        '--baud',
+        '460800',
+        'write_flash',
+        '-z',
+        '0x1000',
+        bin_file,
+    ]
+
+
+def install_files(drivers):
+    """
+    The (local path, device path) pairs of the config and firmware files.
+    """
+    files = [('embedded/config/config.json', 'config/config.json')]
+    if drivers:
+        files.append(('embedded/drivers/__init__.py', 'drivers/__init__.py'))
+        for driver_name in drivers:
+            files.append(
+                (
+                    f'embedded/drivers/{driver_name}.py',
+                    f'drivers/{driver_name}.py'
+                )
+            )
+
+    for name in (
+        'httpclient.py', 'outbox.py', 'events.py', 'rules.py', 'boot.py',
+        'main.py'
+    ):
+        files.append((f'embedded/{name}', name))
+    return files
+
+
+def upload_step(files, remove=()):
+    """
+    A pipeline step uploading the changed files in one raw REPL session.
+    """
+    def upload(port):
+        uploaded = uploader.upload(
+            port,
+            files,
+            echo=lambda message: echo(port, message),
+            remove=remove
+        )
+        echo(port, f'{len(uploaded)} of {len(files)} files changed')
+
+    return upload
+
+
+def expand_ports(ports):
+    """
+    Expand port globs such as `/dev/ttyUSB*`, dropping duplicates.
+    """
+    expanded = []
+    for port in ports:
+        matches = sorted(glob.glob(port)) if glob.has_magic(port) else [port]
+        for match in matches:
+            if match not in expanded:
+                expanded.append(match)
+    if not expanded:
+        raise click.UsageError(f'No ports match {", ".join(ports)}')
+    return expanded
+
+
+def echo(port, message):
+    with ECHO_LOCK:
+        click.echo(f'[{port}] {message}')
+
+
+def run_pipeline(port, steps):
+    """
+    Run a device's steps in order, prefixing their output with the port.
+    A step is a command or a function called with the port. Stops at the
+    first failing step.
+    """
+    start = time.monotonic()
+    error = None
+    for step in steps:
+        if callable(step):
+            try:
+                step(port)
+            except Exception as exc:
+                error = str(exc)
+                break
+            continue
+
+        echo(port, ' '.join(step))
+        try:
+            process = subprocess.Popen(
+                step,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                errors='replace'
+            )
+        except OSError as exc:
+            error = str(exc)
+            break
+
+        for line in process.stdout:
+            line = line.rstrip()
+            if line:
+                echo(port, line)
+        if process.wait():
+            name = ' '.join([os.path.basename(step[0])] + step[1:])
+            error = f'`{name}` exited with {process.returncode}'
+            break
+
+    return {
+        'port': port,
+        'ok': error is None,
+        'seconds': time.monotonic() - start,
+        'error': error,
+    }
+
+
+def run_pipelines(pipelines, jobs):
+    """
+    Run the pipelines of several devices in a worker pool and print a
+    summary. Exits with an error if any device failed.
+    """
+    with ThreadPoolExecutor(max_workers=jobs or len(pipelines)) as pool:
+        results = list(pool.map(lambda item: run_pipeline(*item), pipelines))
+
+    width = max(len('port'), *(len(result['port']) for result in results))
+    click.echo(f'\n{"port":<{width}}  result  seconds')
+    for result in results:
+        click.echo(
+            f'{result["port"]:<{width}}  '
+            f'{"ok" if result["ok"] else "failed":<6}  '
+            f'{result["seconds"]:>7.1f}'
+            + (f'  {result["error"]}' if result['error'] else '')
+        )
+
+    failed = sum(1 for result in results if not result['ok'])
+    click.echo(f'\n{len(results) - failed} succeeded, {failed} failed')
+    if failed:
+        sys.exit(1)
+
+
+port_option = click.option(
+    '--port',
+    'ports',
+    required=True,
+    multiple=True,
+    type=str,
+    help='The usb port the device is connected to, repeat it or use a glob '
+    'such as /dev/ttyUSB* for several devices'
+)
+jobs_option = click.option(
+    '--jobs',
+    default=0,
+    type=int,
+    help='Devices handled at once, all of them by default'
+)
 
 
 @click.group()
@@ -28,53 +199,76 @@ def cli():
     type=click.Choice(['esp8266', 'esp32'], case_sensitive=False),
     help='The chip type you want to flash'
 )
-@click.option(
-    '--port',
-    required=True,
-    type=str,
-    help='The usb port the device is connect to'
-)
+@port_option
 @click.option('--bin-file', required=True, type=str, help='The path of the bin file')
-def flash(chip, port, bin_file):
+@jobs_option
+def flash(chip, ports, bin_file, jobs):
     """
-    Erases the chip's flash and writes it to the chip again.
+    Erases the chips' flash and writes it to the chips again.
     """
+    ports = expand_ports(ports)
 
-    # Erase the flash
-    click.echo('Erasing flash')
-    subprocess.run([
-        'esptool.py',
-        '--chip',
-        chip,
-        '--port',
-        port,
-        'erase_flash'
-    ])
+    click.echo(
+        f'Flashing {len(ports)} device(s) with `{bin_file.split("/")[-1]}`'
+    )
+    run_pipelines(
+        [
+            (
+                port,
+                [
+                    erase_cmd(chip, port),
+                    write_flash_cmd(chip, port, bin_file),
+                ]
+            )
+            for port in ports
+        ],
+        jobs
+    )
 
-    # Flash the chip
-    click.echo(f'\n\nFlashing device with `{bin_file.split("/")[-1]}`')
-    subprocess.run([
-        'esptool.py',
-        '--chip',
-        chip,
-        '--port',
-        port,
-        '--baud',
-        '460800',
-        'write_flash',
-        '-z',
-        '0x1000',
-        bin_file,
-    ])
 
+def echo_build(rows):
+    if not rows:
+        return
+    click.echo(f'{"module":<22} {"source":>8} {"mpy":>8}  cached')
+    for path, source_size, mpy_size, cached in rows:
+        click.echo(
+            f'{path:<22} {source_size:>8} {mpy_size:>8}  '
+            f'{"yes" if cached else "no"}'
+        )
 
-@cli.command()
-@click.option(
-    '--port',
-    required=True,
-    type=str,
-    help='The usb port the device is connect to'
+
+chip_option = click.option(
+    '--chip',
+    default='esp32',
+    type=click.Choice(['esp8266', 'esp32'], case_sensitive=False),
+    help='The chip type the modules are compiled for'
 )
+
+
+@cli.command()
+@chip_option
+def build(chip):
+    """
+    Cross-compiles the firmware modules to .mpy and checks the artifacts.
+    """
+    with open('embedded/config/config.example.json', 'r') as _file:
+        drivers = json.loads(_file.read()).get('drivers')
+    if os.path.exists('embedded/config/config.json'):
+        with open('embedded/config/config.json', 'r') as _file:
+            drivers = json.loads(_file.read()).get('drivers')
+
+    files = [
+        (local_path, path) for local_path, path in install_files(drivers)
+        if path.endswith('.py')
+    ]
+    _, _, rows = mpy.compile_files(files, chip.lower(), click.echo)
+    echo_build(rows)
+    if not rows:
+        sys.exit(1)
+
+
+@cli.command()
+@port_option
 @click.option('--init-config', is_flag=True, help='Reinitialise the config file')
 @click.option(
     '--config-file',
@@ -82,10 +276,16 @@ def flash(chip, port, bin_file):
     required=False,
     help='Reinitialise config from a file'
 )
-def install(port, init_config, config_file):
+@chip_option
+@click.option(
+    '--source', is_flag=True, help='Upload the sources without compiling'
+)
+@jobs_option
+def install(ports, init_config, config_file, chip, source, jobs):
     """
-    Installs the firmware to the chip
+    Installs the firmware to the chips
     """
+    ports = expand_ports(ports)
 
     if init_config:
         with open('embedded/config/config.example.json', 'r') as _file:
@@ -143,33 +343,168 @@ def install(port, init_config, config_file):
         with open('embedded/config/config.json', 'w') as _file:
             _file.write(json.dumps(config, indent=4))
 
-    # Write the firmware to the device
-    click.echo(f'Writing firmware to `{port}`')
-    subprocess.run(mkdir_cmd(port, 'config'))
-    subprocess.run(
-        put_cmd(port, 'embedded/config/config.json', 'config/config.json')
-    )
-    if config['drivers']:
-        subprocess.run(mkdir_cmd(port, 'drivers'))
-        subprocess.run(
-            put_cmd(
-                port,
-                'embedded/drivers/__init__.py',
-                'drivers/__init__.py'
-            )
+    else:
+        with open('embedded/config/config.json', 'r') as _file:
+            config = json.loads(_file.read())
+
+    files = install_files(config.get('drivers'))
+    remove = []
+    if not source:
+        files, remove, rows = mpy.compile_files(
+            files, chip.lower(), click.echo
         )
-        for driver_name in config['drivers']:
-            subprocess.run(
-                put_cmd(
-                    port,
-                    f'embedded/drivers/{driver_name}.py',
-                    f'drivers/{driver_name}.py'
-                )
-            )
+        echo_build(rows)
+
+    # Write the firmware to the devices
+    click.echo(f'Writing firmware to {len(ports)} device(s)')
+    run_pipelines(
+        [(port, [upload_step(files, remove)]) for port in ports],
+        jobs
+    )
+
+
+@cli.command()
+@click.argument('scenarios', nargs=-1)
+@click.option('--cycles', default=20, type=int, help='Cycles per scenario')
+@click.option(
+    '--legacy', is_flag=True, help='Also compare the loop with the legacy one'
+)
+@click.option(
+    '--http', is_flag=True, help='Also compare the service response readers'
+)
+@click.option(
+    '--display', is_flag=True, help='Also compare the Oled refresh transfers'
+)
+@click.option(
+    '--bmp180', is_flag=True, help='Also compare the BMP180 reading transfers'
+)
+@click.option('--save', type=str, help='Write the results to a json file')
+@click.option(
+    '--compare',
+    type=str,
+    help='Fail if the results regress against a saved json file'
+)
+@click.option(
+    '--tolerance',
+    default=10.0,
+    type=float,
+    help='Allowed regression in percent'
+)
+@click.option('--gate-wall', is_flag=True, help='Also gate the wall times')
+def bench(
+    scenarios, cycles, legacy, http, display, bmp180, save, compare,
+    tolerance, gate_wall
+):
+    """
+    Benchmarks the rule loop on the host runtime.
+    """
+    from host import bench as host_bench
+
+    argv = list(scenarios) + ['--cycles', str(cycles)]
+    argv += ['--tolerance', str(tolerance)]
+    if legacy:
+        argv.append('--legacy')
+    if http:
+        argv.append('--http')
+    if display:
+        argv.append('--display')
+    if bmp180:
+        argv.append('--bmp180')
+    if save:
+        argv += ['--save', save]
+    if compare:
+        argv += ['--compare', compare]
+    if gate_wall:
+        argv.append('--gate-wall')
+
+    sys.exit(host_bench.main(argv))
+
+
+@cli.command('simulate-fleet')
+@click.option('--devices', default=100, type=int, help='Number of devices')
+@click.option('--duration', default=30.0, type=float, help='Seconds to run')
+@click.option(
+    '--interval',
+    default=5.0,
+    type=float,
+    help='The devices\' process interval in seconds'
+)
+@click.option(
+    '--commands',
+    default=5.0,
+    type=float,
+    help='Toggle commands sent per second'
+)
+@click.option(
+    '--server',
+    type=str,
+    help='The iotserver url, a local stand-in is started by default'
+)
+@click.option(
+    '--broker',
+    type=str,
+    help='host:port of the MQTT broker, an in-process one is used by default'
+)
+@click.option(
+    '--no-trace', is_flag=True, help='Skip measuring memory per device'
+)
+@click.option('--save', type=str, help='Write the results to a json file')
+def simulate_fleet(devices, duration, interval, commands, server, broker,
+                   no_trace, save):
+    """
+    Runs a fleet of virtual devices on the host runtime.
+    """
+    from host import fleet
+
+    argv = [
+        '--devices', str(devices),
+        '--duration', str(duration),
+        '--interval', str(interval),
+        '--commands', str(commands),
+    ]
+    if server:
+        argv += ['--server', server]
+    if broker:
+        argv += ['--broker', broker]
+    if no_trace:
+        argv.append('--no-trace')
+    if save:
+        argv += ['--save', save]
+
+    sys.exit(fleet.main(argv))
+
+
+@cli.command('simulate-deepsleep')
+@click.option('--wakes', default=12, type=int, help='Number of wakes')
+@click.option(
+    '--interval',
+    default=300,
+    type=int,
+    help='The device\'s process interval in seconds'
+)
+@click.option(
+    '--sync-interval',
+    default=3600,
+    type=int,
+    help='Seconds between time syncs'
+)
+@click.option('--save', type=str, help='Write the results to a json file')
+def simulate_deepsleep(wakes, interval, sync_interval, save):
+    """
+    Runs a deep sleeping device for a number of wakes on the host runtime
+    and checks the per wake budget.
+    """
+    from host import deepsleep
+
+    argv = [
+        '--wakes', str(wakes),
+        '--interval', str(interval),
+        '--sync-interval', str(sync_interval),
+    ]
+    if save:
+        argv += ['--save', save]
 
-    subprocess.run(put_cmd(port, 'embedded/rules.py'))
-    subprocess.run(put_cmd(port, 'embedded/boot.py'))
-    subprocess.run(put_cmd(port, 'embedded/main.py'))
+    sys.exit(deepsleep.main(argv))
 
 
 if __name__ == '__main__':
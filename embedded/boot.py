@@ -8,50 +8,178 @@ import webrepl
 
 gc.collect()
 
+# The access point and IP lease of the last successful connection
+WIFI_STATE_PATH = 'wifi_state.json'
+
+# Milliseconds between connection checks
+WIFI_POLL_INTERVAL = 100
+
+# Statuses of a connection attempt which gave up, they differ by port
+WIFI_FAILED = tuple(
+    getattr(network, name) for name in (
+        'STAT_NO_AP_FOUND', 'STAT_WRONG_PASSWORD', 'STAT_CONNECT_FAIL',
+        'STAT_ASSOC_FAIL', 'STAT_HANDSHAKE_TIMEOUT', 'STAT_BEACON_TIMEOUT',
+    ) if hasattr(network, name)
+)
+
 
 def load_config():
     with open('config/config.json', 'r') as config_file:
         return json.loads(config_file.read())
 
 
+def load_wifi_state(essid):
+    try:
+        with open(WIFI_STATE_PATH, 'r') as state_file:
+            state = json.loads(state_file.read())
+    except (OSError, ValueError):
+        return None
+
+    if state.get('essid') != essid:
+        return None
+    return state
+
+
+def save_wifi_state(state):
+    try:
+        with open(WIFI_STATE_PATH, 'w') as state_file:
+            state_file.write(json.dumps(state))
+    except OSError:
+        pass
+
+
+def clear_wifi_state():
+    import os
+
+    try:
+        os.remove(WIFI_STATE_PATH)
+    except OSError:
+        pass
+
+
+def find_access_point(wifi, essid):
+    """
+    Returns the bssid and channel of the strongest access point for the
+    essid, or None if it isn't in range.
+    """
+    best = None
+    for ap_essid, bssid, channel, rssi, _, _ in wifi.scan():
+        if ap_essid.decode('utf-8') == essid and (
+            best is None or rssi > best[2]
+        ):
+            best = (bssid, channel, rssi)
+    return best
+
+
+def wait_connected(wifi, deadline):
+    """
+    Poll the connection until it is up, the attempt fails or the deadline in
+    ticks passes.
+    """
+    while not wifi.isconnected():
+        if time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+            return False
+        if wifi.status() in WIFI_FAILED:
+            return False
+        time.sleep_ms(WIFI_POLL_INTERVAL)
+    return True
+
+
+def join(wifi, wifi_config, state, deadline):
+    """
+    Join the network, on the cached access point if there is one, and
+    returns whether it connected before the deadline.
+    """
+    essid = wifi_config['essid']
+    password = wifi_config['password']
+
+    static = wifi_config.get('static')
+    if static:
+        wifi.ifconfig((
+            static['ip'], static['netmask'], static['gateway'], static['dns']
+        ))
+    elif state and wifi_config.get('reuse_lease'):
+        wifi.ifconfig(tuple(state['ifconfig']))
+
+    if state:
+        # Rejoin the same access point, skipping the scan
+        try:
+            wifi.config(channel=state['channel'])
+        except (OSError, ValueError, TypeError):
+            pass
+        wifi.connect(essid, password, bssid=bytes(state['bssid']))
+
+        # Leave some of the time for a full connect if the rejoin fails
+        rejoin_deadline = time.ticks_add(
+            time.ticks_ms(), time.ticks_diff(deadline, time.ticks_ms()) // 2
+        )
+        if wait_connected(wifi, rejoin_deadline):
+            return True
+
+        print('Cached access point unavailable.')
+        wifi.disconnect()
+        clear_wifi_state()
+
+    access_point = find_access_point(wifi, essid)
+    if access_point:
+        state = {
+            'essid': essid,
+            'bssid': list(access_point[0]),
+            'channel': access_point[1],
+        }
+        wifi.connect(essid, password, bssid=access_point[0])
+    else:
+        state = None
+        wifi.connect(essid, password)
+
+    if not wait_connected(wifi, deadline):
+        return False
+
+    if state:
+        state['ifconfig'] = list(wifi.ifconfig())
+        save_wifi_state(state)
+    return True
+
+
 def connect_wifi(wifi_config):
     wifi = network.WLAN(network.STA_IF)
     if not wifi.isconnected():
         print('Connecting to wifi...')
         wifi.active(True)
         essid = wifi_config['essid']
-        wifi.connect(essid, wifi_config['password'])
-        for i in range(wifi_config['retry_count']):
-            if not wifi.isconnected():
-                print(
-                    'Connection attempt {count}/{retry_count}'.format(
-                        count=i + 1, retry_count=wifi_config['retry_count']
-                    )
-                )
-                time.sleep(10)
-                if i == wifi_config['retry_count'] - 1:
-                    print('Connection failed. Rebooting.')
-            else:
-                ip_address = wifi.ifconfig()[0]
-                print(
-                    'Connected to {essid} with IP: {ip_address}'.format(
-                        essid=essid, ip_address=ip_address
-                    )
-                )
 
-                led_pin = machine.Signal(
-                    machine.Pin(2, machine.Pin.OUT),
-                    invert=True
+        # An overall deadline, falling back to the old retry budget of 10
+        # seconds per retry
+        timeout = wifi_config.get(
+            'timeout', wifi_config.get('retry_count', 3) * 10
+        )
+        start = time.ticks_ms()
+        deadline = time.ticks_add(start, int(timeout * 1000))
+
+        if join(wifi, wifi_config, load_wifi_state(essid), deadline):
+            ip_address = wifi.ifconfig()[0]
+            print(
+                'Connected to {essid} with IP: {ip_address} in {ms} ms'.format(
+                    essid=essid,
+                    ip_address=ip_address,
+                    ms=time.ticks_diff(time.ticks_ms(), start)
                 )
-                led_pin.on()
+            )
 
-                break
+            led_pin = machine.Signal(
+                machine.Pin(2, machine.Pin.OUT),
+                invert=True
+            )
+            led_pin.on()
+        else:
+            print('Connection failed. Rebooting.')
 
     return wifi.isconnected()
 
 
-WIFI_CONFIG = load_config()['wifi']
-MAIN_CONFIG = load_config()['main']
+CONFIG = load_config()
+WIFI_CONFIG = CONFIG['wifi']
+MAIN_CONFIG = CONFIG['main']
 
 # Connect to wifi if enabled
 wifi_connected = connect_wifi(WIFI_CONFIG)
@@ -3,64 +3,66 @@
 from ustruct import unpack
 import time
 
+# Calibration EEPROM: AC1-AC3, AC4-AC6 (unsigned), B1, B2, MB, MC and MD
+CALIBRATION_ADDRESS = 0xAA
+CALIBRATION_FORMAT = '>hhhHHHhhhhh'
+CALIBRATION_SIZE = 22
+
+# Conversion times in ms of the temperature and, by oversample setting, the
+# pressure
+TEMPERATURE_DELAY = 5
+PRESSURE_DELAYS = (5, 8, 14, 26)
+
+
+def multiply_shift(value, factor):
+    """
+    Returns (value * factor) >> 15 for an unsigned 16 bit factor, without
+    the product leaving the small int range.
+    """
+    return (value * (factor >> 7) + ((value * (factor & 0x7F)) >> 7)) >> 8
+
+
+def divide(dividend, divisor):
+    """
+    Integer division truncating towards zero, like the datasheet's C.
+    """
+    quotient = abs(dividend) // abs(divisor)
+    return quotient if (dividend < 0) == (divisor < 0) else -quotient
+
 
 class BMP180(object):
     """
     Module for the BMP180 pressure sensor.
     """
 
-    _bmp_addr = 119  # Address of BMP180 is hardcoded on the sensor
+    _bmp_addr = 119  # Default address of the BMP180
 
-    def __init__(self, i2c_bus):
-
-        # Create i2c obect
-        _bmp_addr = self._bmp_addr
+    def __init__(self, i2c_bus, address=None):
+        if address is not None:
+            self._bmp_addr = address
         self._bmp_i2c = i2c_bus
-        self._bmp_i2c.start()
         self.chip_id = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xD0, 2)
 
-        # Read calibration data from EEPROM
-        self.eprom_address_map = {
-            '_AC1': 0xAA,
-            '_AC2': 0xAC,
-            '_AC3': 0xAE,
-            '_AC4': 0xB0,
-            '_AC5': 0xB2,
-            '_AC6': 0xB4,
-            '_B1': 0xB6,
-            '_B2': 0xB8,
-            '_MB': 0xBA,
-            '_MC': 0xBC,
-            '_MD': 0xBE,
-        }
-
-        count = 0
-        for attr, address in self.eprom_address_map.items():
-            format = '>h' if count > 3 or count < 5 else '>H'
-            setattr(
-                self, attr, unpack(
-                    format, self._bmp_i2c.readfrom_mem(
-                        _bmp_addr, address, 2
-                    )
-                )[0]
+        # Read the calibration data from the EEPROM in one burst
+        (
+            self._AC1, self._AC2, self._AC3, self._AC4, self._AC5, self._AC6,
+            self._B1, self._B2, self._MB, self._MC, self._MD
+        ) = unpack(
+            CALIBRATION_FORMAT,
+            self._bmp_i2c.readfrom_mem(
+                self._bmp_addr, CALIBRATION_ADDRESS, CALIBRATION_SIZE
             )
-            count += 1
+        )
 
         # Settings to be adjusted by user
         self.oversample_setting = 3
         self.baseline = 101325.0
 
-        # Output raw data
-        self.UT_raw = None
-        self.B5_raw = None
-        self.MSB_raw = None
-        self.LSB_raw = None
-        self.XLSB_raw = None
-        self.gauge = self.make_gauge()
-
-        for _ in range(128):
-            next(self.gauge)
-            time.sleep_ms(1)
+        # Command and raw reading buffers, the temperature is the first two
+        # bytes of the raw buffer
+        self.command = bytearray(1)
+        self.raw = bytearray(3)
+        self.raw_temperature = memoryview(self.raw)[:2]
 
     def compute_value_dump(self):
         """
@@ -81,47 +83,6 @@ class BMP180(object):
             self.oversample_setting
         ]
 
-    def make_gauge(self):
-        """
-        Generator refreshing the raw measurments.
-        """
-        delays = (5, 8, 14, 25)
-        while True:
-            self._bmp_i2c.writeto_mem(self._bmp_addr, 0xF4, bytearray([0x2E]))
-            t_start = time.ticks_ms()
-
-            while (time.ticks_ms() - t_start) <= 5:  # 5mS delay
-                yield None
-            try:
-                self.UT_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF6, 2)
-            except Exception:
-                yield None
-
-            self._bmp_i2c.writeto_mem(
-                self._bmp_addr,
-                0xF4,
-                bytearray([0x34+(self.oversample_setting << 6)])
-            )
-            t_pressure_ready = delays[self.oversample_setting]
-            t_start = time.ticks_ms()
-
-            while (time.ticks_ms() - t_start) <= t_pressure_ready:
-                yield None
-            try:
-                self.MSB_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF6, 1)
-                self.LSB_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF7, 1)
-                self.XLSB_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF8, 1)
-            except Exception:
-                yield None
-
-            yield True
-
-    def blocking_read(self):
-        if next(self.gauge) is not None:
-            pass  # Discard old data
-        while next(self.gauge) is None:
-            pass
-
     @property
     def oversample(self):
         return self.oversample_setting
@@ -134,82 +95,114 @@ class BMP180(object):
             print('`oversample_setting` can only be less than 3, setting to 3')
             self.oversample_setting = 3
 
-    def temperature(self):
+    def read_raw(self):
         """
-        Temperature in degrees C.
+        Run a temperature and a pressure conversion, returns the raw UT and
+        UP readings. The readings go into preallocated buffers.
         """
-        next(self.gauge)
-        try:
-            UT = unpack('>H', self.UT_raw)[0]
-        except Exception:
-            return 0.0
-
-        X1 = (UT - self._AC6) * (self._AC5 / (2 ** 15))
-        X2 = (self._MC * (2 ** 11)) / (X1 + self._MD)
-
-        self.B5_raw = X1 + X2
+        i2c = self._bmp_i2c
+        address = self._bmp_addr
+        oversample = self.oversample_setting
+        command = self.command
+        raw = self.raw
+
+        command[0] = 0x2E
+        i2c.writeto_mem(address, 0xF4, command)
+        time.sleep_ms(TEMPERATURE_DELAY)
+        i2c.readfrom_mem_into(address, 0xF6, self.raw_temperature)
+        UT = (raw[0] << 8) | raw[1]
+
+        command[0] = 0x34 + (oversample << 6)
+        i2c.writeto_mem(address, 0xF4, command)
+        time.sleep_ms(PRESSURE_DELAYS[oversample])
+        i2c.readfrom_mem_into(address, 0xF6, raw)
+        UP = ((raw[0] << 16) | (raw[1] << 8) | raw[2]) >> (8 - oversample)
+
+        return UT, UP
+
+    def compensate(self, UT, UP):
+        """
+        Returns the temperature in 0.1 degrees C and the absolute pressure
+        in pascal of the raw readings, with the datasheet's integer
+        arithmetic. The products are split so they stay small ints.
+        """
+        oversample = self.oversample_setting
 
-        return ((self.B5_raw + 8) / (2 ** 4)) / 10
+        X1 = multiply_shift(UT - self._AC6, self._AC5)
+        X2 = divide(self._MC << 11, X1 + self._MD)
+        B5 = X1 + X2
+        temperature = (B5 + 8) >> 4
 
-    def absolute_pressure(self):
+        B6 = B5 - 4000
+        B6_squared = (B6 * B6) >> 12
+        X1 = (self._B2 * B6_squared) >> 11
+        X2 = (self._AC2 * B6) >> 11
+        X3 = X1 + X2
+        B3 = divide(((self._AC1 * 4 + X3) << oversample) + 2, 4)
+        X1 = (self._AC3 * B6) >> 13
+        X2 = (self._B1 * B6_squared) >> 16
+        X3 = ((X1 + X2) + 2) >> 2
+        B4 = multiply_shift(X3 + 32768, self._AC4)
+
+        # p = (UP - B3) * (100000 >> oversample) / B4, in two steps. Unlike
+        # the datasheet's 32 bit version it doesn't lose the last bit above
+        # 0x80000000.
+        difference = UP - B3
+        scale = 100000 >> oversample
+        quotient, remainder = divmod(difference * (scale >> 8), B4)
+        pressure = (quotient << 8) + (
+            (remainder << 8) + difference * (scale & 0xFF)
+        ) // B4
+
+        X1 = (pressure >> 8) * (pressure >> 8)
+        X1 = (X1 * 3038) >> 16
+        X2 = (-7357 * pressure) >> 16
+
+        return temperature, pressure + ((X1 + X2 + 3791) >> 4)
+
+    def measure(self):
         """
-        Asolute pressure in pascal.
+        Run one temperature and one pressure conversion. Returns the
+        temperature in degrees C, the sealevel compensated pressure in
+        pascal and the altitude in meters.
         """
-        next(self.gauge)
-        self.temperature()  # Populate self.B5_raw
+        temperature, absolute_pressure = self.compensate(*self.read_raw())
+        temperature /= 10
 
+        altitude = 0.0
+        pressure = 0.0
         try:
-            MSB = unpack('B', self.MSB_raw)[0]
-            LSB = unpack('B', self.LSB_raw)[0]
-            XLSB = unpack('B', self.XLSB_raw)[0]
-        except Exception:
-            return 0.0
-
-        UP = ((MSB << 16) + (LSB << 8) + XLSB) >> (8 - self.oversample_setting)
-        B6 = self.B5_raw - 4000
-        X1 = (self._B2 * ((B6 ** 2) / (2 ** 12))) / (2 ** 11)
-        X2 = (self._AC2 * B6) / (2 ** 11)
-        X3 = X1 + X2
-        B3 = ((int((self._AC1 * 4 + X3)) << self.oversample_setting) + 2) / 4
-        X1 = (self._AC3 * B6) / (2 ** 13)
-        X2 = (self._B1 * (B6 ** 2 / 2 ** 12)) / (2 ** 16)
-        X3 = ((X1 + X2) + 2) / (2 ** 2)
-        B4 = abs(self._AC4) * (X3 + 32768) / (2 ** 15)
-        B7 = (abs(UP) - B3) * (50000 >> self.oversample_setting)
-
-        if B7 < 0x80000000:
-            pressure = (B7 * 2) / B4
-        else:
-            pressure = (B7 / B4) * 2
+            altitude = (
+                44330 * (1 - ((absolute_pressure / self.baseline) ** 0.1903))
+            )
+            pressure = (
+                absolute_pressure / pow(1 - (altitude / 44330.0), 2.9382)
+            )
+        except ZeroDivisionError:
+            pass
 
-        X1 = (pressure / (2 ** 8)) ** 2
-        X1 = (X1 * 3038) / (2 ** 16)
-        X2 = (-7357 * pressure) / (2 ** 16)
+        return temperature, pressure, altitude
 
-        return (pressure + (X1 + X2 + 3791) / (2 ** 4))
+    def temperature(self):
+        """
+        Temperature in degrees C.
+        """
+        return self.compensate(*self.read_raw())[0] / 10
+
+    def absolute_pressure(self):
+        """
+        Asolute pressure in pascal.
+        """
+        return self.compensate(*self.read_raw())[1]
 
     def pressure(self):
         """
         Sealevel compensated pressure in pascal.
         """
-        pressure = 0.0
-        try:
-            pressure = (
-                self.absolute_pressure() / pow(1 - (self.altitude() / 44330.0), 2.9382)
-            )
-        except ZeroDivisionError:
-            pass
-        return pressure
+        return self.measure()[1]
 
     def altitude(self):
         """
         Altitude in meters.
         """
-        altitude = 0.0
-        try:
-            altitude = (
-                44330 * (1 - ((self.absolute_pressure() / self.baseline) ** 0.1903))
-            )
-        except ZeroDivisionError:
-            pass
-        return altitude
+        return self.measure()[2]
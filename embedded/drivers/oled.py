@@ -26,6 +26,11 @@ SET_CHARGE_PUMP = const(0x8d)
 
 
 class Oled(object):
+    """
+    SSD1306 display with a framebuffer. The drawing methods record the
+    pages and columns they change, and `show()` sends only those.
+    """
+
     def __init__(self, width, height):
         self.width = width
         self.height = height
@@ -41,21 +46,15 @@ class Oled(object):
             framebuf.MONO_VLSB
         )
 
-        self.fill = self.framebuffer.fill
-        self.pixel = self.framebuffer.pixel
-        self.hline = self.framebuffer.hline
-        self.vline = self.framebuffer.vline
-        self.line = self.framebuffer.line
-        self.rect = self.framebuffer.rect
-        self.fill_rect = self.framebuffer.fill_rect
-        self.text = self.framebuffer.text
-        self.scroll = self.framebuffer.scroll
-        self.blit = self.framebuffer.blit
+        # First and last changed column by page, a clean page starts past
+        # the last column
+        self.dirty_start = bytearray([self.width] * self.pages)
+        self.dirty_end = bytearray(self.pages)
 
         self.init_display()
 
     def init_display(self):
-        for cmd in (
+        self.write_cmds((
             SET_DISP | 0x00,
 
             # Address setting
@@ -82,12 +81,77 @@ class Oled(object):
             # Charge pump
             SET_CHARGE_PUMP, 0x14,
             SET_DISP | 0x01
-        ):
-            self.write_cmd(cmd)
+        ))
 
         self.fill(0)
         self.show()
 
+    def mark(self, x, y, width, height):
+        """
+        Record a changed area of the framebuffer.
+        """
+        x0 = max(x, 0)
+        x1 = min(x + width, self.width) - 1
+        y0 = max(y, 0)
+        y1 = min(y + height, self.height) - 1
+        if x0 > x1 or y0 > y1:
+            return
+
+        dirty_start = self.dirty_start
+        dirty_end = self.dirty_end
+        for page in range(y0 >> 3, (y1 >> 3) + 1):
+            if x0 < dirty_start[page]:
+                dirty_start[page] = x0
+            if x1 > dirty_end[page]:
+                dirty_end[page] = x1
+
+    def mark_all(self):
+        self.mark(0, 0, self.width, self.height)
+
+    def fill(self, c):
+        self.framebuffer.fill(c)
+        self.mark_all()
+
+    def pixel(self, x, y, c=None):
+        if c is None:
+            return self.framebuffer.pixel(x, y)
+        self.framebuffer.pixel(x, y, c)
+        self.mark(x, y, 1, 1)
+
+    def hline(self, x, y, w, c):
+        self.framebuffer.hline(x, y, w, c)
+        self.mark(x, y, w, 1)
+
+    def vline(self, x, y, h, c):
+        self.framebuffer.vline(x, y, h, c)
+        self.mark(x, y, 1, h)
+
+    def line(self, x1, y1, x2, y2, c):
+        self.framebuffer.line(x1, y1, x2, y2, c)
+        self.mark(
+            min(x1, x2), min(y1, y2), abs(x2 - x1) + 1, abs(y2 - y1) + 1
+        )
+
+    def rect(self, x, y, w, h, c, *args):
+        self.framebuffer.rect(x, y, w, h, c, *args)
+        self.mark(x, y, w, h)
+
+    def fill_rect(self, x, y, w, h, c):
+        self.framebuffer.fill_rect(x, y, w, h, c)
+        self.mark(x, y, w, h)
+
+    def text(self, s, x, y, c=1):
+        self.framebuffer.text(s, x, y, c)
+        self.mark(x, y, len(s) * 8, 8)
+
+    def scroll(self, xstep, ystep):
+        self.framebuffer.scroll(xstep, ystep)
+        self.mark_all()
+
+    def blit(self, fbuf, x, y, *args):
+        self.framebuffer.blit(fbuf, x, y, *args)
+        self.mark_all()
+
     def poweroff(self):
         self.write_cmd(SET_DISP | 0x00)
 
@@ -95,28 +159,55 @@ class Oled(object):
         self.write_cmd(SET_DISP | 0x01)
 
     def contrast(self, contrast):
-        self.write_cmd(SET_CONTRAST)
-        self.write_cmd(contrast)
+        self.write_cmds((SET_CONTRAST, contrast))
 
     def invert(self, invert):
         self.write_cmd(SET_NORM_INV | (invert & 1))
 
-    def show(self):
-        x0 = 0
-        x1 = self.width - 1
+    def show(self, full=False):
+        """
+        Send the changed pages to the display, or the whole framebuffer.
+        Consecutive changed pages go in one transfer of the columns any of
+        them changed.
+        """
+        if full:
+            self.mark_all()
 
-        # Displays with width of 64 pixels are shifted by 32
-        if self.width == 64:
-            x0 += 32
-            x1 += 32
+        width = self.width
+        dirty_start = self.dirty_start
+        dirty_end = self.dirty_end
+        buffer = memoryview(self.buffer)
 
-        self.write_cmd(SET_COL_ADDR)
-        self.write_cmd(x0)
-        self.write_cmd(x1)
-        self.write_cmd(SET_PAGE_ADDR)
-        self.write_cmd(0)
-        self.write_cmd(self.pages - 1)
-        self.write_data(self.buffer)
+        # Displays with width of 64 pixels are shifted by 32
+        offset = 32 if width == 64 else 0
+
+        page = 0
+        while page < self.pages:
+            if dirty_start[page] >= width:
+                page += 1
+                continue
+
+            first_page = page
+            x0 = dirty_start[page]
+            x1 = dirty_end[page]
+            while page + 1 < self.pages and dirty_start[page + 1] < width:
+                page += 1
+                x0 = min(x0, dirty_start[page])
+                x1 = max(x1, dirty_end[page])
+
+            self.write_cmds((
+                SET_COL_ADDR, x0 + offset, x1 + offset,
+                SET_PAGE_ADDR, first_page, page
+            ))
+            self.write_data([
+                buffer[index * width + x0:index * width + x1 + 1]
+                for index in range(first_page, page + 1)
+            ])
+
+            for index in range(first_page, page + 1):
+                dirty_start[index] = width
+                dirty_end[index] = 0
+            page += 1
 
 
 class OledI2C(Oled):
@@ -124,6 +215,10 @@ class OledI2C(Oled):
         self.i2c = i2c
         self.addr = addr
         self.temp = bytearray(2)
+
+        # Control bytes of a command stream and a data stream
+        self.commands = bytearray(33)
+        self.data_prefix = b'\x40'
         super().__init__(width, height)
 
     def write_cmd(self, cmd):
@@ -132,10 +227,20 @@ class OledI2C(Oled):
 
         self.i2c.writeto(self.addr, self.temp)
 
-    def write_data(self, buf):
-        self.temp[0] = self.addr << 1
-        self.temp[1] = 0x40
-        self.i2c.start()
-        self.i2c.write(self.temp)
-        self.i2c.write(buf)
-        self.i2c.stop()
+    def write_cmds(self, cmds):
+        """
+        Send a sequence of commands in one transfer.
+        """
+        commands = self.commands
+        commands[0] = 0x00
+        for index, cmd in enumerate(cmds):
+            commands[index + 1] = cmd
+        self.i2c.writeto(
+            self.addr, memoryview(commands)[:len(cmds) + 1]
+        )
+
+    def write_data(self, buffers):
+        """
+        Send the buffers as one data transfer.
+        """
+        self.i2c.writevto(self.addr, [self.data_prefix] + buffers)
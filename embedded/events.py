@@ -0,0 +1,214 @@
+"""
+Interrupt driven digital inputs.
+
+An `EventInput` wraps an input pin with a `Pin.irq` handler. The first edge
+after the input has been stable for `debounce` ms is accepted straight
+away, and the edges bouncing after it are ignored. If the level the input
+settles at differs from the accepted one, `settle()` accepts it once no
+edge was seen for `debounce` ms.
+
+Accepted edges are written to a preallocated ring buffer with the input,
+the new level and the ticks_ms of the edge, and rising edges are counted
+per input. The handlers only write to preallocated arrays, so they don't
+allocate.
+"""
+import machine
+import time
+from array import array
+
+DEBOUNCE_MS = 20
+
+BUFFER_SIZE = 32
+
+# Ring buffer of the accepted edges: input index, level and ticks_ms
+EVENT_INPUTS = array('B', bytes(BUFFER_SIZE))
+EVENT_LEVELS = array('B', bytes(BUFFER_SIZE))
+EVENT_TICKS = array('i', [0] * BUFFER_SIZE)
+
+# Next write position, edges buffered and edges dropped while full
+RING = array('i', [0, 0, 0])
+HEAD = 0
+COUNT = 1
+DROPPED = 2
+
+# Registered inputs by index, and an object with a `set()` method to wake
+# a waiting task on every accepted edge, like uasyncio's ThreadSafeFlag.
+# The index of a released input is reused, and NO_INPUT marks its edges
+# left in the ring buffer.
+INPUTS = []
+FLAG = None
+NO_INPUT = 255
+
+# EventInput state fields
+LEVEL = 0
+ACCEPTED = 1
+LAST_EDGE = 2
+PULSES = 3
+UNSETTLED = 4
+
+
+def record(index, level, ticks):
+    position = RING[HEAD]
+    EVENT_INPUTS[position] = index
+    EVENT_LEVELS[position] = level
+    EVENT_TICKS[position] = ticks
+    RING[HEAD] = (position + 1) % BUFFER_SIZE
+    if RING[COUNT] < BUFFER_SIZE:
+        RING[COUNT] += 1
+    else:
+        RING[DROPPED] += 1
+
+    if FLAG is not None:
+        FLAG.set()
+
+
+class EventInput(object):
+    """
+    A debounced input pin. `value()` returns the accepted level, so the
+    read rules work on it unchanged.
+    """
+
+    def __init__(self, pin, debounce=DEBOUNCE_MS):
+        self.pin = pin
+        self.debounce = debounce
+        if None in INPUTS:
+            self.index = INPUTS.index(None)
+            INPUTS[self.index] = self
+        elif len(INPUTS) < NO_INPUT:
+            self.index = len(INPUTS)
+            INPUTS.append(self)
+        else:
+            raise ValueError('Too many event inputs.')
+
+        now = time.ticks_ms()
+        self.state = array('i', [pin.value(), now, now, 0, 0])
+        self.counted = 0
+
+        pin.irq(
+            handler=self.irq,
+            trigger=machine.Pin.IRQ_RISING | machine.Pin.IRQ_FALLING
+        )
+
+    def release(self):
+        """
+        Remove the irq handler, when the pin is rebuilt or removed. Its
+        buffered edges are dropped, so they aren't taken for the input
+        which reuses its index.
+        """
+        self.pin.irq(handler=None)
+        irq_state = machine.disable_irq()
+        try:
+            for position in range(BUFFER_SIZE):
+                if EVENT_INPUTS[position] == self.index:
+                    EVENT_INPUTS[position] = NO_INPUT
+        finally:
+            machine.enable_irq(irq_state)
+        INPUTS[self.index] = None
+
+    def irq(self, pin):
+        state = self.state
+        now = time.ticks_ms()
+        level = pin.value()
+        state[LAST_EDGE] = now
+        if level == state[LEVEL]:
+            return
+        if time.ticks_diff(now, state[ACCEPTED]) < self.debounce:
+            state[UNSETTLED] = 1
+            return
+
+        self.accept(level, now)
+
+    def accept(self, level, now):
+        state = self.state
+        state[LEVEL] = level
+        state[ACCEPTED] = now
+        state[UNSETTLED] = 0
+        if level:
+            state[PULSES] += 1
+        record(self.index, level, now)
+
+    def settle(self):
+        """
+        Accept the level the input settled at after a bounce. Returns
+        whether the input is still bouncing.
+        """
+        state = self.state
+        if not state[UNSETTLED]:
+            return False
+
+        now = time.ticks_ms()
+        if time.ticks_diff(now, state[LAST_EDGE]) < self.debounce:
+            return True
+
+        irq_state = machine.disable_irq()
+        try:
+            level = self.pin.value()
+            if level != state[LEVEL]:
+                self.accept(level, now)
+            state[UNSETTLED] = 0
+        finally:
+            machine.enable_irq(irq_state)
+        return False
+
+    def value(self):
+        return self.state[LEVEL]
+
+    def take_pulses(self):
+        """
+        Returns the rising edges counted since the last call.
+        """
+        pulses = self.state[PULSES]
+        count = pulses - self.counted
+        self.counted = pulses
+        return count
+
+
+def active():
+    """
+    Returns whether any input is registered.
+    """
+    for event_input in INPUTS:
+        if event_input is not None:
+            return True
+    return False
+
+
+def settle():
+    """
+    Settle the bouncing inputs. Returns whether any is still bouncing.
+    """
+    bouncing = False
+    for event_input in INPUTS:
+        if event_input is not None and event_input.settle():
+            bouncing = True
+    return bouncing
+
+
+def pending():
+    return RING[COUNT] > 0
+
+
+def drain():
+    """
+    Returns the buffered edges, oldest first, as (input, level, ticks_ms)
+    tuples and the number of edges dropped since the last call.
+    """
+    irq_state = machine.disable_irq()
+    try:
+        count = RING[COUNT]
+        start = (RING[HEAD] - count) % BUFFER_SIZE
+        edges = []
+        for offset in range(count):
+            position = (start + offset) % BUFFER_SIZE
+            index = EVENT_INPUTS[position]
+            event_input = INPUTS[index] if index != NO_INPUT else None
+            if event_input is not None:
+                edges.append((
+                    event_input, EVENT_LEVELS[position], EVENT_TICKS[position]
+                ))
+        dropped = RING[DROPPED]
+        RING[COUNT] = 0
+        RING[DROPPED] = 0
+    finally:
+        machine.enable_irq(irq_state)
+    return edges, dropped
@@ -0,0 +1,406 @@
+import json
+import socket
+
+
+# Resolved addresses keyed by (host, port)
+ADDRESSES = {}
+
+# Open keep-alive connections keyed by (host, port)
+CONNECTIONS = {}
+
+TIMEOUT = 15.0
+
+# Largest response body accepted by default, larger bodies raise
+# ResponseTooLarge. It covers a 10 KB weather response.
+MAX_BODY_SIZE = 12288
+
+# Receive buffer shared by all the requests, see `get_buffer`. It starts
+# at the size of the first body and grows in steps of at least
+# MIN_BUFFER_SIZE for bodies of unknown size.
+BUFFER = None
+MIN_BUFFER_SIZE = 1024
+
+# Taken by `get_async` while it reads a body into the shared buffer
+BUFFER_LOCK = None
+
+
+class ResponseTooLarge(ValueError):
+    """
+    The response body is larger than the maximum size.
+    """
+
+
+class Connection(object):
+    """
+    A persistent HTTP/1.1 connection to a single host.
+    """
+
+    def __init__(self, host, port, timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self.requests = 0
+
+        self.socket = socket.socket()
+        self.socket.settimeout(timeout)
+        try:
+            self.socket.connect(resolve(host, port))
+        except OSError:
+            # The address may be stale, look it up again next time
+            ADDRESSES.pop((host, port), None)
+            self.socket.close()
+            raise
+
+        self.stream = self.socket.makefile('rb')
+
+    def close(self):
+        try:
+            self.stream.close()
+            self.socket.close()
+        except OSError:
+            pass
+
+
+def resolve(host, port):
+    """
+    Returns the cached address for the host, looking it up on the first use.
+    """
+    address = ADDRESSES.get((host, port))
+    if address is None:
+        address = socket.getaddrinfo(host, port)[0][-1]
+        ADDRESSES[(host, port)] = address
+    return address
+
+
+def parse_url(url):
+    """
+    Returns the host, port and path of a http url.
+    """
+    _, _, host, path = url.split('/', 3)
+    port = 80
+    if ':' in host:
+        host, port = host.split(':', 1)
+    return host, int(port), '/' + path
+
+
+def get_connection(host, port):
+    connection = CONNECTIONS.get((host, port))
+    if connection is None:
+        connection = Connection(host, port)
+        CONNECTIONS[(host, port)] = connection
+    return connection
+
+
+def close_connection(host, port):
+    connection = CONNECTIONS.pop((host, port), None)
+    if connection:
+        connection.close()
+
+
+def read_line(stream):
+    line = stream.readline()
+    if not line:
+        raise OSError('Connection closed by server.')
+    return line
+
+
+def get_buffer(size, keep=0):
+    """
+    Returns the shared receive buffer, growing it only when a larger body
+    size is needed. The first `keep` bytes are copied when it grows.
+    """
+    global BUFFER
+
+    if BUFFER is None or len(BUFFER) < size:
+        if keep:
+            buffer = bytearray(size)
+            buffer[:keep] = memoryview(BUFFER)[:keep]
+            BUFFER = buffer
+        else:
+            BUFFER = None
+            BUFFER = bytearray(size)
+    return memoryview(BUFFER)
+
+
+def grow_buffer(view, size, needed, max_size):
+    """
+    Returns a view of the shared buffer with room for `needed` bytes,
+    keeping the `size` bytes read so far. It at least doubles, up to
+    `max_size`, so a body of unknown size is copied only a few times.
+    """
+    if needed <= len(view):
+        return view
+    return get_buffer(
+        min(max(needed, 2 * len(view), MIN_BUFFER_SIZE), max_size), size
+    )
+
+
+def too_large(max_size):
+    return ResponseTooLarge(
+        'Response body exceeds {size} bytes.'.format(size=max_size)
+    )
+
+
+def read_into(stream, view):
+    """
+    Fill the view from the stream.
+    """
+    received = 0
+    while received < len(view):
+        count = stream.readinto(view[received:])
+        if not count:
+            raise OSError('Connection closed by server.')
+        received += count
+
+
+def read_body(stream, status, headers, max_size):
+    """
+    Reads the response body into the shared buffer, sized from the
+    Content-Length or grown as a body of unknown size comes in. Returns a
+    view of the body and whether the connection can be reused.
+    """
+    if status in (204, 304) or 100 <= status < 200:
+        return memoryview(b''), True
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        view = memoryview(b'')
+        size = 0
+        while True:
+            chunk_size = int(read_line(stream).split(b';', 1)[0].strip(), 16)
+            if not chunk_size:
+                break
+            if size + chunk_size > max_size:
+                raise too_large(max_size)
+            view = grow_buffer(view, size, size + chunk_size, max_size)
+            read_into(stream, view[size:size + chunk_size])
+            size += chunk_size
+            read_line(stream)
+
+        # Skip any trailers
+        while read_line(stream) not in (b'\r\n', b'\n'):
+            pass
+
+        return view[:size], True
+
+    length = headers.get('content-length')
+    if length is not None:
+        length = int(length)
+        if length > max_size:
+            raise too_large(max_size)
+        view = get_buffer(length)[:length]
+        read_into(stream, view)
+        return view, True
+
+    # No framing, the body runs until the server closes the connection
+    view = memoryview(b'')
+    size = 0
+    while True:
+        if size == max_size:
+            if stream.read(1):
+                raise too_large(max_size)
+            break
+        view = grow_buffer(view, size, size + 1, max_size)
+        count = stream.readinto(view[size:max_size])
+        if not count:
+            break
+        size += count
+    return view[:size], False
+
+
+def parse_status_line(status_line):
+    """
+    Returns the status code of a `HTTP/1.x <status> <reason>` line.
+    """
+    if not status_line.startswith(b'HTTP/'):
+        raise ValueError('Invalid HTTP status line.')
+    return int(status_line.split(None, 2)[1])
+
+
+def parse_header(line, headers):
+    key, value = str(line, 'utf8').split(':', 1)
+    headers[key.strip().lower()] = value.strip()
+
+
+def read_response(stream, max_size):
+    """
+    Returns the status code, lower cased headers and body of a response as
+    well as whether the connection can be reused.
+    """
+    status_line = read_line(stream)
+    status = parse_status_line(status_line)
+
+    headers = {}
+    while True:
+        line = read_line(stream)
+        if line in (b'\r\n', b'\n'):
+            break
+        parse_header(line, headers)
+
+    body, reusable = read_body(stream, status, headers, max_size)
+    if headers.get('connection', '').lower() == 'close':
+        reusable = False
+    if status_line.startswith(b'HTTP/1.0'):
+        reusable = headers.get('connection', '').lower() == 'keep-alive'
+
+    return status, headers, body, reusable
+
+
+def loads(body):
+    """
+    Parse a json body, MicroPython reads the buffer in place.
+    """
+    try:
+        return json.loads(body)
+    except TypeError:
+        return json.loads(bytes(body))
+
+
+def build_request(host, path, headers=None, version='1.1'):
+    request = 'GET {path} HTTP/{version}\r\nHost: {host}\r\n'.format(
+        path=path, version=version, host=host
+    )
+    if headers:
+        for header in headers:
+            request += header + '\r\n'
+    return bytes(request + '\r\n', 'utf8')
+
+
+def get(url, headers=None, max_size=None):
+    """
+    Send a GET request over a persistent connection to the host. Returns the
+    status code, lower cased headers and body. The body is a view of the
+    shared receive buffer and is only valid until the next request. A
+    connection dropped by the server while idle is reopened and the request
+    retried once.
+    """
+    if max_size is None:
+        max_size = MAX_BODY_SIZE
+
+    host, port, path = parse_url(url)
+    request = build_request(host, path, headers)
+
+    while True:
+        connection = get_connection(host, port)
+        reused = connection.requests > 0
+        try:
+            connection.socket.sendall(request)
+            status, response_headers, body, reusable = read_response(
+                connection.stream, max_size
+            )
+        except OSError:
+            close_connection(host, port)
+            if reused:
+                continue
+            raise
+        except ValueError:
+            close_connection(host, port)
+            raise
+
+        connection.requests += 1
+        if not reusable:
+            close_connection(host, port)
+
+        return status, response_headers, body
+
+
+async def read_into_async(reader, view):
+    """
+    Fill the view from the stream reader until it is full or the stream ends.
+    Returns the number of bytes read.
+    """
+    received = 0
+    while received < len(view):
+        data = await reader.read(len(view) - received)
+        if not data:
+            break
+        view[received:received + len(data)] = data
+        received += len(data)
+    return received
+
+
+async def read_body_async(reader, length, max_size):
+    """
+    Non-blocking version of `read_body` for a HTTP/1.0 response, which has
+    a Content-Length or runs until the server closes the connection.
+    """
+    if length is not None:
+        view = get_buffer(length)[:length]
+        if await read_into_async(reader, view) < length:
+            raise OSError('Connection closed by server.')
+        return view
+
+    view = memoryview(b'')
+    size = 0
+    while True:
+        if size == max_size:
+            if await reader.read(1):
+                raise too_large(max_size)
+            return view[:size]
+        view = grow_buffer(view, size, size + 1, max_size)
+        count = await read_into_async(reader, view[size:max_size])
+        size += count
+        if size < min(len(view), max_size):
+            return view[:size]
+
+
+async def get_async(url, headers=None, max_size=None):
+    """
+    Non-blocking version of `get` for the async runtime. It uses a HTTP/1.0
+    request on its own connection, so requests from several tasks can
+    overlap. Only their body reads take turns, as they share the receive
+    buffer: the body is only valid until the caller's next await.
+    """
+    global BUFFER_LOCK
+
+    try:
+        import uasyncio as asyncio
+    except ImportError:
+        import asyncio
+
+    if max_size is None:
+        max_size = MAX_BODY_SIZE
+    if BUFFER_LOCK is None:
+        BUFFER_LOCK = asyncio.Lock()
+
+    host, port, path = parse_url(url)
+    request = build_request(host, path, headers, version='1.0')
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port), TIMEOUT
+    )
+    locked = False
+    try:
+        writer.write(request)
+        await writer.drain()
+
+        status = parse_status_line(
+            await asyncio.wait_for(reader.readline(), TIMEOUT)
+        )
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), TIMEOUT)
+            if not line:
+                raise OSError('Connection closed by server.')
+            if line in (b'\r\n', b'\n'):
+                break
+            parse_header(line, response_headers)
+
+        length = response_headers.get('content-length')
+        if length is not None:
+            length = int(length)
+            if length > max_size:
+                raise too_large(max_size)
+
+        await BUFFER_LOCK.acquire()
+        locked = True
+        body = await asyncio.wait_for(
+            read_body_async(reader, length, max_size), TIMEOUT
+        )
+    finally:
+        try:
+            writer.close()
+            await writer.wait_closed()
+        finally:
+            if locked:
+                BUFFER_LOCK.release()
+
+    return status, response_headers, body
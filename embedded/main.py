@@ -2,10 +2,22 @@ import hashlib
 import json
 import ntptime
 import machine
+import os
+import struct
 import sys
 import time
 import upip
 
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Wakes a task from an irq handler, CPython's asyncio only has Event
+ThreadSafeFlag = getattr(asyncio, 'ThreadSafeFlag', asyncio.Event)
+
+import events
+import outbox
 import rules
 
 DEVICE_ID = None
@@ -21,13 +33,115 @@ ERROR = 'error'
 
 LOG_LEVELS = [INFO, DEBUG, WARNING, ERROR]
 
-# Device pin status state
-PREVIOUS_STATE = None
+# Config file and the size, mtime and digest it was last loaded with
+CONFIG_PATH = 'config/config.json'
+CONFIG_SIGNATURE = None
+CONFIG_DIGEST = None
+
+# Config sections which need a reset to be applied
+RESET_SECTIONS = ('wifi', 'mqtt', 'time', 'outbox')
+RESET_MAIN_KEYS = ('identifier', 'mode', 'webrepl_password')
+
+# Condition tree node types, see `compile_node`
+ALL = 0
+ANY = 1
+NOT = 2
+LEAF = 3
+BRANCH_NODES = {'all': ALL, 'any': ANY}
+
+# Condition operators comparing the input with its previous value
+STATEFUL_OPERATORS = ('change', 'rise', 'fall')
+
+# Version of the last change to each rule value, from a counter bumped on
+# every change, see `complete_rule`
+VALUE_VERSIONS = {}
+VALUE_VERSION = 0
+
+# Runtime modes
+LOOP = 'loop'
+ASYNC = 'async'
+DEEPSLEEP = 'deepsleep'
+
+# Milliseconds between checks of the event inputs while waiting for the next
+# cycle or for a bouncing input to settle
+EVENT_POLL_INTERVAL = 10
+
+# State kept in RTC memory between deep sleep wakes: a header followed by
+# the rule values as json, which go to a file in flash instead when they
+# don't fit the RTC memory
+SLEEP_STATE_MAGIC = b'IOT1'
+SLEEP_STATE_HEADER = '<4sBIII4sH'
+SLEEP_STATE_PATH = 'sleep_state.json'
+RTC_MEMORY_SIZE = {'esp8266': 492, 'esp32': 2048}
+
+# Sleep state header flags
+SYNCED = 1
+SNAPSHOT = 2
+IN_FLASH = 4
+
+# Published log level index and the ring buffer of unpublished messages
+LOG_LEVEL = None
+LOG_BUFFER = None
+LOG_HEAD = 0
+LOG_COUNT = 0
+LOG_DROPPED = 0
+
+# Last published value per rule value key, when the last full status
+# snapshot was published and whether one has been requested
+PUBLISHED_STATUS = {}
+STATUS_SNAPSHOT_TIME = None
+STATUS_REQUESTED = False
+
+# Status publishing modes
+KEYS = 'keys'
+PATCH = 'patch'
+
+# Whether the broker is reachable, and the flash buffer of the messages
+# published while it isn't, see `get_outbox`
+MQTT_ONLINE = True
+OUTBOX = None
+
+
+def get_config_signature():
+    stat = os.stat(CONFIG_PATH)
+    return stat[6], stat[8]
 
 
 def load_config():
-    with open('config/config.json', 'r') as config_file:
-        return json.loads(config_file.read())
+    global CONFIG_SIGNATURE, CONFIG_DIGEST
+
+    CONFIG_SIGNATURE = get_config_signature()
+    with open(CONFIG_PATH, 'rb') as config_file:
+        config = config_file.read()
+    CONFIG_DIGEST = hashlib.sha1(config).digest()
+
+    return json.loads(config)
+
+
+def check_config():
+    """
+    Returns the config if the config file has changed since it was loaded.
+    The file is only read when its size or mtime changed, and only parsed
+    when its digest changed.
+    """
+    global CONFIG_SIGNATURE, CONFIG_DIGEST
+
+    signature = get_config_signature()
+    if signature == CONFIG_SIGNATURE:
+        return None
+    CONFIG_SIGNATURE = signature
+
+    with open(CONFIG_PATH, 'rb') as config_file:
+        config = config_file.read()
+    digest = hashlib.sha1(config).digest()
+    if digest == CONFIG_DIGEST:
+        return None
+    CONFIG_DIGEST = digest
+
+    config = json.loads(config)
+    if config == CONFIG:
+        return None
+    return config
 
 
 def reset():
@@ -47,11 +161,10 @@ def set_time(mqtt, time_config):
             log_message(
                 mqtt, 'Could not retrieve local time. Retrying.', WARNING
             )
+            flush_logs(mqtt)
             reset()
 
-    log_message(
-        mqtt, 'Local time set to {now}'.format(now=time.localtime()), DEBUG
-    )
+    log_message(mqtt, 'Local time set to {now}', DEBUG, now=time.localtime())
 
 
 def init_mqtt(mqtt_config):
@@ -76,73 +189,344 @@ def init_mqtt(mqtt_config):
             msg=lastwill['message']
         )
 
-    mqtt.connect()
+    try:
+        mqtt.connect()
+    except Exception:
+        # Start offline, buffering the messages until the broker is back
+        if get_outbox() is None:
+            raise
+        set_mqtt_offline(mqtt)
 
     log_message(
         mqtt,
-        'Initilised MQTT Client at {host}'.format(host=mqtt_config['host']),
-        DEBUG
+        'Initilised MQTT Client at {host}',
+        DEBUG,
+        host=mqtt_config['host']
     )
 
     return mqtt
 
 
-def publish_mqtt_message(mqtt, mqtt_queue, message, retry_count=0):
-    if retry_count > 0:
-        mqtt.connect()
-    try:
-        mqtt.publish(mqtt_queue, message)
-    except Exception:
-        if retry_count <= 3:
-            retry_count += 1
-            publish_mqtt_message(mqtt, mqtt_queue, message, retry_count)
-        else:
-            raise Exception('MQTT Service is offline.')
+def get_outbox():
+    """
+    Returns the flash buffer for the messages published while the broker is
+    offline, or None when `outbox.enabled` is false.
+    """
+    global OUTBOX
+
+    if OUTBOX is None:
+        outbox_config = CONFIG.get('outbox', {})
+        if not outbox_config.get('enabled', True):
+            return None
+        OUTBOX = outbox.Outbox(
+            prefix='iot-devices/{identifier}/'.format(identifier=DEVICE_ID),
+            size=outbox_config.get('segment_size', outbox.SEGMENT_SIZE),
+            count=outbox_config.get('segments', outbox.SEGMENT_COUNT)
+        )
+    return OUTBOX
 
 
-def subscribe_mqtt_message(mqtt, mqtt_queue, callback, retry_count=0):
-    if retry_count > 0:
-        mqtt.connect()
+def set_mqtt_offline(mqtt):
+    global MQTT_ONLINE
+
+    if MQTT_ONLINE:
+        MQTT_ONLINE = False
+        log_message(
+            mqtt, 'MQTT Service is offline, buffering messages.', WARNING
+        )
+
+
+def publish_mqtt_message(
+    mqtt, mqtt_queue, message, retry_count=0, retain=False
+):
+    """
+    Publish the message, reconnecting up to four times. When the broker
+    stays unreachable the message is stored in the outbox and the device
+    goes offline until `check_mqtt` reconnects, or without an outbox an
+    exception is raised.
+    """
+    store = get_outbox()
+    if store is not None and not MQTT_ONLINE:
+        store.append(time.time(), mqtt_queue, message, retain)
+        return
+
     try:
-        mqtt.set_callback(callback)
-        mqtt.subscribe(mqtt_queue)
-        mqtt.check_msg()
+        if retry_count > 0:
+            mqtt.connect()
+            rules.resubscribe_mqtt(mqtt)
+        mqtt.publish(mqtt_queue, message, retain)
     except Exception:
         if retry_count <= 3:
             retry_count += 1
-            subscribe_mqtt_message(mqtt, mqtt_queue, callback, retry_count)
-        else:
+            publish_mqtt_message(
+                mqtt, mqtt_queue, message, retry_count, retain
+            )
+        elif store is None:
             raise Exception('MQTT Service is offline.')
+        else:
+            set_mqtt_offline(mqtt)
+            store.append(time.time(), mqtt_queue, message, retain)
+
+
+def check_mqtt(mqtt):
+    """
+    Ping the broker. With the outbox enabled a dropped connection takes the
+    device offline instead of raising, and once a reconnect succeeds a full
+    status snapshot is requested and the backlog replayed.
+    """
+    global MQTT_ONLINE, STATUS_REQUESTED
 
+    store = get_outbox()
+    if store is None:
+        mqtt.ping()
+        return
 
-def log_message(mqtt, message, level):
-    logging_config = CONFIG['logging']
+    if MQTT_ONLINE:
+        try:
+            mqtt.ping()
+        except Exception:
+            set_mqtt_offline(mqtt)
 
-    if not mqtt:
-        print(message)
+    if not MQTT_ONLINE:
+        try:
+            mqtt.connect()
+            rules.resubscribe_mqtt(mqtt)
+        except Exception:
+            return
+        MQTT_ONLINE = True
+        STATUS_REQUESTED = True
+        log_message(
+            mqtt, 'MQTT Service is back, {count} messages buffered.',
+            WARNING, count=len(store)
+        )
+
+    replay_outbox(mqtt, store)
+
+
+def replay_outbox(mqtt, store):
+    """
+    Publish the buffered messages to the backlog topic as json lists of
+    [unix time, topic, message, retain], oldest first. At most
+    `outbox.batches` batches of up to `outbox.batch_size` bytes are sent
+    per call, so the backlog drains without crowding out the live work.
+    """
+    if not len(store):
         return
 
-    if LOG_LEVELS.index(level) >= LOG_LEVELS.index(logging_config['level']):
-        mqtt_queue = 'iot-devices/{identifier}/logs'.format(
-            identifier=DEVICE_ID
+    outbox_config = CONFIG.get('outbox', {})
+    mqtt_queue = 'iot-devices/{identifier}/backlog'.format(
+        identifier=DEVICE_ID
+    )
+    for _ in range(outbox_config.get('batches', 2)):
+        batch = store.read_batch(outbox_config.get('batch_size', 1024))
+        if not batch:
+            break
+        try:
+            mqtt.publish(mqtt_queue, json.dumps(batch))
+        except Exception:
+            set_mqtt_offline(mqtt)
+            break
+        store.commit()
+
+
+def save_outbox():
+    """
+    Write the messages buffered this cycle to flash in one go.
+    """
+    if OUTBOX is not None:
+        OUTBOX.flush()
+
+
+def log_enabled(level):
+    """
+    Returns whether a message at the level is published.
+    """
+    global LOG_LEVEL
+
+    if LOG_LEVEL is None:
+        LOG_LEVEL = LOG_LEVELS.index(CONFIG['logging']['level'])
+    return LOG_LEVELS.index(level) >= LOG_LEVEL
+
+
+def buffer_log(message):
+    """
+    Add the message to the log ring buffer, overwriting the oldest message
+    when it is full.
+    """
+    global LOG_BUFFER, LOG_HEAD, LOG_COUNT, LOG_DROPPED
+
+    if LOG_BUFFER is None:
+        LOG_BUFFER = [None] * CONFIG['logging'].get('buffer_size', 16)
+
+    size = len(LOG_BUFFER)
+    LOG_BUFFER[(LOG_HEAD + LOG_COUNT) % size] = message
+    if LOG_COUNT < size:
+        LOG_COUNT += 1
+    else:
+        LOG_HEAD = (LOG_HEAD + 1) % size
+        LOG_DROPPED += 1
+
+
+def flush_logs(mqtt):
+    """
+    Publish the buffered log messages as a single message.
+    """
+    global LOG_HEAD, LOG_COUNT, LOG_DROPPED
+
+    if not LOG_COUNT or not mqtt:
+        return
+
+    size = len(LOG_BUFFER)
+    messages = [
+        LOG_BUFFER[(LOG_HEAD + index) % size] for index in range(LOG_COUNT)
+    ]
+    if LOG_DROPPED:
+        messages.insert(
+            0, 'Dropped {count} log messages.'.format(count=LOG_DROPPED)
         )
-        publish_mqtt_message(mqtt, mqtt_queue, message)
 
-    if logging_config['level'] in [INFO, DEBUG]:
+    mqtt_queue = 'iot-devices/{identifier}/logs'.format(identifier=DEVICE_ID)
+    publish_mqtt_message(mqtt, mqtt_queue, '\n'.join(messages))
+
+    for index in range(size):
+        LOG_BUFFER[index] = None
+    LOG_HEAD = 0
+    LOG_COUNT = 0
+    LOG_DROPPED = 0
+
+
+def log_message(mqtt, message, level, **kwargs):
+    """
+    Buffer the message to be published with the next batch of logs. The
+    message is only formatted with the kwargs once it is known to be
+    published or printed. Errors are published straight away.
+    """
+    printed = not mqtt or CONFIG['logging']['level'] in [INFO, DEBUG]
+    published = mqtt and log_enabled(level)
+    if not (printed or published):
+        return
+
+    if kwargs:
+        message = message.format(**kwargs)
+
+    if printed:
         print(message)
 
+    if published:
+        if LOG_BUFFER is not None and LOG_COUNT == len(LOG_BUFFER):
+            try:
+                flush_logs(mqtt)
+            except Exception:
+                # Keep the newest messages while mqtt is unavailable
+                pass
+        buffer_log(message)
+        if level == ERROR:
+            flush_logs(mqtt)
+
 
-def log_status(mqtt, status):
-    global PREVIOUS_STATE
+def request_status(topic, msg):
+    """
+    Handles a request for a full status snapshot.
+    """
+    global STATUS_REQUESTED
+    STATUS_REQUESTED = True
+
+
+def subscribe_status_requests(mqtt):
+    rules.subscribe_mqtt(
+        mqtt,
+        'iot-devices/{identifier}/refresh-status'.format(identifier=DEVICE_ID),
+        request_status,
+        connected=MQTT_ONLINE
+    )
 
+
+def poll_subscriptions(mqtt):
+    """
+    Handle the pending messages of the subscribed topics, like the status
+    requests, whether or not a rule polls the broker.
+    """
+    if not MQTT_ONLINE or not rules.MQTT_SUBSCRIPTIONS:
+        return
+    try:
+        rules.poll_mqtt(mqtt)
+    except Exception:
+        if get_outbox() is None:
+            raise
+        set_mqtt_offline(mqtt)
+
+
+def log_status(mqtt):
+    """
+    Publish the rule values which changed since they were last published. A
+    full snapshot is published to the status topic on the first call, every
+    `status.snapshot_interval` seconds and when requested over mqtt.
+    """
+    global STATUS_SNAPSHOT_TIME, STATUS_REQUESTED
+
+    status_config = CONFIG.get('status', {})
     mqtt_queue = 'iot-devices/{identifier}/status/'.format(
         identifier=DEVICE_ID
     )
 
-    if PREVIOUS_STATE != hashlib.sha1(status).digest():
-        publish_mqtt_message(mqtt, mqtt_queue, status)
+    now = time.time()
+    if (
+        STATUS_REQUESTED
+        or STATUS_SNAPSHOT_TIME is None
+        or now - STATUS_SNAPSHOT_TIME
+        >= status_config.get('snapshot_interval', 3600)
+    ):
+        publish_mqtt_message(mqtt, mqtt_queue, json.dumps(RULE_VALUES))
+        PUBLISHED_STATUS.clear()
+        PUBLISHED_STATUS.update(RULE_VALUES)
+        STATUS_SNAPSHOT_TIME = now
+        STATUS_REQUESTED = False
+        return
 
-    PREVIOUS_STATE = hashlib.sha1(status).digest()
+    changed = [
+        key for key, value in RULE_VALUES.items()
+        if key not in PUBLISHED_STATUS or PUBLISHED_STATUS[key] != value
+    ]
+    if not changed:
+        return
+
+    if status_config.get('mode', KEYS) == PATCH:
+        publish_mqtt_message(
+            mqtt,
+            mqtt_queue + 'patch',
+            json.dumps(dict((key, RULE_VALUES[key]) for key in changed))
+        )
+    else:
+        for key in changed:
+            publish_mqtt_message(
+                mqtt,
+                mqtt_queue + key,
+                json.dumps(RULE_VALUES[key]),
+                retain=True
+            )
+
+    for key in changed:
+        PUBLISHED_STATUS[key] = RULE_VALUES[key]
+
+
+def clear_status(mqtt, identifiers):
+    """
+    Forget the published status of removed rules. In `keys` mode their
+    retained status topics are cleared with an empty retained message, so
+    new subscribers don't get the stale values.
+    """
+    keys = CONFIG.get('status', {}).get('mode', KEYS) == KEYS
+    for identifier in identifiers:
+        PUBLISHED_STATUS.pop(identifier, None)
+        if keys:
+            publish_mqtt_message(
+                mqtt,
+                'iot-devices/{identifier}/status/{key}'.format(
+                    identifier=DEVICE_ID, key=identifier
+                ),
+                '',
+                retain=True
+            )
 
 
 def health_check(mqtt):
@@ -153,55 +537,361 @@ def health_check(mqtt):
     )
 
     # Check MQTT connection
-    mqtt.ping()
+    check_mqtt(mqtt)
 
 
-def find_xpath_value(response, xpaths):
-    xpath = xpaths.pop()  # paths must be reversed before passing it in
+async def health_check_async(mqtt):
 
-    try:
-        response = response[int(xpath)]
-    except ValueError:
-        response = response[xpath]
-    except (KeyError, IndexError):
-        return None
+    # Check Wifi connection
+    await rules.get_service_response_async(
+        url=CONFIG['health']['url'].format(identifier=DEVICE_ID)
+    )
+
+    # Check MQTT connection
+    check_mqtt(mqtt)
+
+
+def find_xpath_value(values, xpath):
+    """
+    Walk the pre-split xpath tuple into the given values.
+    """
+    for key in xpath:
+        try:
+            values = values[key]
+        except (KeyError, IndexError, TypeError):
+            return None
 
-    if not len(xpaths):
-        return response
+    return values
 
-    return find_xpath_value(response, xpaths)
+
+def compile_xpath(pin_identifier):
+    """
+    Split a condition key like `weather.0.rain` into a tuple of keys, with
+    list indexes already converted to integers.
+    """
+    xpath = []
+    for key in pin_identifier.split('.'):
+        try:
+            xpath.append(int(key))
+        except ValueError:
+            xpath.append(key)
+    return tuple(xpath)
 
 
-def evaluate_condition(input, operator, value):
+def evaluate_condition(input, operator, value, state=None):
+    """
+    Compare the input with the value. The change and edge operators compare
+    it with the input seen the last time the rule's conditions were
+    evaluated, kept in `state` by `handle_conditions`, and are False on the
+    first evaluation.
+    """
     try:
         if operator == 'eq':
             return input == value
+        elif operator == 'ne':
+            return input != value
         elif operator == 'gt':
             return input > value
         elif operator == 'lt':
             return input < value
+        elif operator == 'gte':
+            return input >= value
+        elif operator == 'lte':
+            return input <= value
+        elif operator == 'in':
+            return input in value
+        elif operator == 'between':
+            return value[0] <= input <= value[1]
+        elif operator in STATEFUL_OPERATORS:
+            previous = state[0]
+            if previous is None or input is None:
+                return False
+            if operator == 'change':
+                return input != previous
+            elif operator == 'rise':
+                return previous < value <= input
+            elif operator == 'fall':
+                return input < value <= previous
     except TypeError:
         return False
+    return False
+
+
+def node_cost(node):
+    """
+    Returns the number of xpath keys walked to evaluate the whole node.
+    """
+    if node[0] == LEAF:
+        return len(node[1])
+    if node[0] == NOT:
+        return node_cost(node[1])
+    return sum(node_cost(child) for child in node[1])
 
 
-def handle_conditions(rule_values, input_value):
+def compile_branch(kind, children):
+    """
+    Returns an `all` or `any` node of the children, cheapest first so the
+    deciding child is more likely to be found before the costly lookups.
+    A single child is returned as is.
     """
-    Returns a dict of condition boolean values to be evaluated.
+    children = sorted(children, key=node_cost)
+    if len(children) == 1:
+        return children[0]
+    return (kind, tuple(children))
+
+
+def compile_node(node):
     """
-    condition_values = {'must': [], 'should': []}
-    for condition_type, conditions in input_value['conditions'].items():
-        if condition_type in condition_values:
-            for pin_identifier, condition in conditions.items():
-                xpaths = pin_identifier.split('.')
-                xpaths.reverse()
-                condition_values[condition_type].append(
-                    evaluate_condition(
-                        find_xpath_value(rule_values, xpaths),
-                        **condition
+    Compile a condition config into a tree of tuples:
+
+    - (ALL, children) and (ANY, children) from `{"all": [...]}` and
+      `{"any": [...]}`, a dict instead of a list is one child per key
+    - (NOT, child) from `{"not": {...}}`
+    - (LEAF, xpath, operator, value, state) from
+      `{"pin.0.key": {"operator": ..., "value": ...}}`
+
+    A dict with several keys needs all of them to be true.
+    """
+    children = []
+    for key, value in node.items():
+        if key in BRANCH_NODES:
+            if type(value) == dict:
+                value = [{child_key: child_value}
+                         for child_key, child_value in value.items()]
+            children.append(compile_branch(
+                BRANCH_NODES[key], [compile_node(child) for child in value]
+            ))
+        elif key == 'not':
+            children.append((NOT, compile_node(value)))
+        else:
+            operator = value['operator']
+            children.append((
+                LEAF,
+                compile_xpath(key),
+                operator,
+                value.get('value'),
+                [None] if operator in STATEFUL_OPERATORS else None
+            ))
+    return compile_branch(ALL, children)
+
+
+def stateful_leaves(node, leaves):
+    """
+    Add the `change`, `rise` and `fall` leaves of the condition tree to the
+    leaves list.
+    """
+    if node[0] == LEAF:
+        if node[4] is not None:
+            leaves.append(node)
+    elif node[0] == NOT:
+        stateful_leaves(node[1], leaves)
+    else:
+        for child in node[1]:
+            stateful_leaves(child, leaves)
+    return leaves
+
+
+def compile_conditions(input_value):
+    """
+    Compile the rule input's conditions into a condition tree. The original
+    `must` and `should` conditions are true when all the `must` or any of
+    the `should` conditions are.
+    """
+    conditions = input_value['conditions']
+    if 'must' not in conditions and 'should' not in conditions:
+        return compile_node(conditions)
+
+    must = compile_node({'all': conditions.get('must', {})})
+    should = compile_node({'any': conditions.get('should', {})})
+    return compile_branch(ANY, [must, should])
+
+
+def evaluate_node(rule_values, node):
+    """
+    Evaluate the condition tree against the rule values, stopping at the
+    first child which decides an `all` or `any` node.
+    """
+    kind = node[0]
+    if kind == LEAF:
+        return evaluate_condition(
+            find_xpath_value(rule_values, node[1]), node[2], node[3], node[4]
+        )
+    elif kind == ALL:
+        for child in node[1]:
+            if not evaluate_node(rule_values, child):
+                return False
+        return True
+    elif kind == ANY:
+        for child in node[1]:
+            if evaluate_node(rule_values, child):
+                return True
+        return False
+    return not evaluate_node(rule_values, node[1])
+
+
+def handle_conditions(rule_values, conditions, leaves=()):
+    """
+    Evaluates a compiled condition tree against the stored rule values.
+    Afterwards the stateful leaves, see `stateful_leaves`, record their
+    input, also the ones the evaluation skipped, so the next evaluation
+    compares with this one.
+    """
+    result = evaluate_node(rule_values, conditions)
+    for leaf in leaves:
+        leaf[4][0] = find_xpath_value(rule_values, leaf[1])
+    return result
+
+
+def node_dependencies(node, dependencies):
+    """
+    Add the identifiers of the rule values the condition tree reads to the
+    dependencies set.
+    """
+    if node[0] == LEAF:
+        if node[1]:
+            dependencies.add(node[1][0])
+    elif node[0] == NOT:
+        node_dependencies(node[1], dependencies)
+    else:
+        for child in node[1]:
+            node_dependencies(child, dependencies)
+
+
+class Rule(object):
+    """
+    A pin rule compiled from the config, ready to be executed every cycle.
+    """
+
+    def __init__(self, pin_config, pin):
+        rule = pin_config['rule']
+
+        self.identifier = pin_config['identifier']
+        self.interval = pin_config.get('interval', 1)
+        self.period = pin_config.get('period')
+        self.pin = pin
+        self.rule = rule
+        self.action_name = rule['action']
+        self.action = getattr(rules, rule['action'])
+        self.sampler = rules.SAMPLE_READERS.get(rule['action'])
+        self.async_action = rules.ASYNC_RULES.get(rule['action'])
+        self.actuator = rule['action'] in rules.ACTUATOR_RULES
+
+        # Static inputs are copied once, conditional inputs are evaluated and
+        # written into the same params dict on every run
+        self.params = {}
+        self.conditions = []
+        for input_key, input_value in rule['input'].items():
+            if type(input_value) == dict and 'conditions' in input_value:
+                conditions = compile_conditions(input_value)
+                self.conditions.append((
+                    input_key, conditions, stateful_leaves(conditions, [])
+                ))
+                self.params[input_key] = False
+            else:
+                self.params[input_key] = input_value
+
+        # The rule values the conditions read, and their latest version when
+        # an actuator last ran. Conditions with `change`, `rise` or `fall`
+        # compare with their last evaluation, so they are evaluated every run.
+        self.dependencies = set()
+        for _, conditions, _ in self.conditions:
+            node_dependencies(conditions, self.dependencies)
+        self.inputs_version = None
+        self.stateful = any(leaves for _, _, leaves in self.conditions)
+
+        # The rule values shown by a display, written into the values param
+        # on every run
+        self.fields = []
+        if rule['action'] in rules.DISPLAY_RULES:
+            for field in rule['input'].get('layout', []):
+                xpath = compile_xpath(field['value'])
+                self.fields.append(xpath)
+                self.dependencies.add(xpath[0])
+            self.params['values'] = [None] * len(self.fields)
+
+
+def order_plan(plan):
+    """
+    Returns the rules in dependency order, every rule after the rules its
+    conditions read, and otherwise in config order. A reference cycle is
+    broken where it is found, see `plan_errors`.
+    """
+    rules_by_identifier = dict((rule.identifier, rule) for rule in plan)
+    ordered = []
+    visited = set()
+
+    def visit(rule):
+        if rule.identifier in visited:
+            return
+        visited.add(rule.identifier)
+        for dependency in sorted(rule.dependencies):
+            upstream = rules_by_identifier.get(dependency)
+            if upstream is not None:
+                visit(upstream)
+        ordered.append(rule)
+
+    for rule in plan:
+        visit(rule)
+    return ordered
+
+
+def plan_errors(plan):
+    """
+    Returns an error message for every condition reading a rule value which
+    no rule sets, and every rule which reads a rule value set after it in
+    the ordered plan, which is a reference cycle.
+    """
+    positions = dict(
+        (rule.identifier, index) for index, rule in enumerate(plan)
+    )
+    errors = []
+    for index, rule in enumerate(plan):
+        for dependency in sorted(rule.dependencies):
+            position = positions.get(dependency)
+            if position is None:
+                errors.append(
+                    'Rule {rule} references unknown rule value '
+                    '{dependency}.'.format(
+                        rule=rule.identifier, dependency=dependency
+                    )
+                )
+            elif position > index:
+                errors.append(
+                    'Rule {rule} is in a reference cycle with '
+                    '{dependency}.'.format(
+                        rule=rule.identifier, dependency=dependency
                     )
                 )
+    return errors
+
+
+def compile_plan(pin_config, pins):
+    """
+    Compile the pin config into a list of rules in dependency order.
+    """
+    return order_plan(
+        [Rule(pin, pins[pin['identifier']]) for pin in pin_config]
+    )
+
+
+def check_plan(mqtt, plan):
+    """
+    Log the reference errors of the plan. The conditions reading a missing
+    rule value see None, as before.
+    """
+    for error in plan_errors(plan):
+        log_message(mqtt, error, ERROR)
+
 
-    return condition_values
+def subscribe_rules(mqtt, plan):
+    """
+    Subscribe once to the topics of the mqtt driven rules.
+    """
+    for rule in plan:
+        if rule.action_name in rules.MQTT_RULES:
+            rules.subscribe_mqtt(
+                mqtt, rule.params['topic'], connected=MQTT_ONLINE
+            )
 
 
 def get_i2c_pins(read):
@@ -233,7 +923,12 @@ def create_pins(pin_config):
                 )
 
             else:
-                if pin['read']:
+                if pin['read'] and pin.get('event'):
+                    pins[pin['identifier']] = events.EventInput(
+                        machine.Pin(pin['pin_number'], machine.Pin.IN),
+                        pin.get('debounce', events.DEBOUNCE_MS)
+                    )
+                elif pin['read']:
                     pins[pin['identifier']] = machine.Pin(
                         pin['pin_number'], machine.Pin.IN
                     )
@@ -257,91 +952,641 @@ def create_pins(pin_config):
     return pins
 
 
+def release_pin(pin):
+    """
+    Remove the irq handler of an event input which is rebuilt or removed.
+    """
+    if isinstance(pin, events.EventInput):
+        pin.release()
+
+
+def prepare_rule(mqtt, rule):
+    """
+    Evaluate the rule's conditions against the stored rule values and return
+    the params to run the rule with.
+    """
+    params = rule.params
+    for input_key, conditions, leaves in rule.conditions:
+        params[input_key] = handle_conditions(
+            RULE_VALUES, conditions, leaves
+        )
+    if rule.fields:
+        values = params['values']
+        for index, xpath in enumerate(rule.fields):
+            values[index] = find_xpath_value(RULE_VALUES, xpath)
+
+    log_message(
+        mqtt,
+        'Running rule: {action} with input: {input}.',
+        DEBUG,
+        action=rule.action_name,
+        input=params
+    )
+
+    return params
+
+
+def complete_rule(mqtt, rule, value):
+    """
+    Save the result of the rule to the rule values, bumping the value's
+    version when it changed.
+    """
+    global VALUE_VERSION
+
+    identifier = rule.identifier
+    if identifier not in RULE_VALUES or (
+        RULE_VALUES[identifier] is not value
+        and RULE_VALUES[identifier] != value
+    ):
+        VALUE_VERSION += 1
+        VALUE_VERSIONS[identifier] = VALUE_VERSION
+    RULE_VALUES[identifier] = value
+
+    log_message(
+        mqtt,
+        'Completed rule: {action} with output: {output}.',
+        DEBUG,
+        action=rule.action_name,
+        output=value
+    )
+
+
+def reload_config(mqtt, config, plan, pins):
+    """
+    Apply a changed config in place, rebuilding only the pins and rules
+    which changed. Resets the device if the network or identity config
+    changed. Returns the new plan, the rebuilt rules and the identifiers of
+    the removed rules.
+    """
+    global LOG_LEVEL, LOG_BUFFER, VALUE_VERSION
+
+    reset_required = any(
+        config.get(section) != CONFIG.get(section)
+        for section in RESET_SECTIONS
+    ) or any(
+        config['main'].get(key) != CONFIG['main'].get(key)
+        for key in RESET_MAIN_KEYS
+    )
+    if reset_required:
+        log_message(mqtt, 'Config updated, resetting.', WARNING)
+        flush_logs(mqtt)
+        reset()
+
+    previous = dict((pin['identifier'], pin) for pin in CONFIG['pins'])
+    existing = dict((rule.identifier, rule) for rule in plan)
+
+    new_plan = []
+    rebuilt = []
+    for pin in config['pins']:
+        identifier = pin['identifier']
+        if previous.get(identifier) == pin:
+            new_plan.append(existing[identifier])
+        else:
+            release_pin(pins.get(identifier))
+            pins.update(create_pins([pin]))
+            rule = Rule(pin, pins[identifier])
+            new_plan.append(rule)
+            rebuilt.append(rule)
+
+    identifiers = [pin['identifier'] for pin in config['pins']]
+    removed = [
+        identifier for identifier in existing if identifier not in identifiers
+    ]
+    for identifier in removed:
+        release_pin(pins.pop(identifier, None))
+        RULE_VALUES.pop(identifier, None)
+        VALUE_VERSION += 1
+        VALUE_VERSIONS[identifier] = VALUE_VERSION
+
+    if config['logging'] != CONFIG['logging']:
+        flush_logs(mqtt)
+        LOG_LEVEL = None
+        LOG_BUFFER = None
+
+    CONFIG.clear()
+    CONFIG.update(config)
+
+    clear_status(mqtt, removed)
+
+    new_plan = order_plan(new_plan)
+    if rebuilt or removed:
+        check_plan(mqtt, new_plan)
+    subscribe_rules(mqtt, rebuilt)
+
+    log_message(
+        mqtt,
+        'Config reloaded, rebuilt {rebuilt} and removed {removed} rules.',
+        INFO,
+        rebuilt=len(rebuilt),
+        removed=len(removed)
+    )
+
+    return new_plan, rebuilt, removed
+
+
+def run_rule(mqtt, rule, samples=None):
+    """
+    Evaluate the rule's conditions and run its action, saving the result to
+    the rule values.
+    """
+    # Keep the last value of the mqtt driven rules while offline
+    if rule.action_name in rules.MQTT_RULES and not MQTT_ONLINE:
+        return
+
+    # Actuators only run again once a rule value they read changed
+    if rule.actuator and not rule.stateful:
+        version = max(
+            [VALUE_VERSIONS.get(dependency, 0)
+             for dependency in rule.dependencies] or [0]
+        )
+        if version == rule.inputs_version:
+            log_message(
+                mqtt, 'Skipping rule: {action}, inputs unchanged.', DEBUG,
+                action=rule.action_name
+            )
+            return
+        rule.inputs_version = version
+
+    params = prepare_rule(mqtt, rule)
+
+    # Run the rule with the appropriate params, mqtt and server config are
+    # passed to every rule by default
+    try:
+        if samples is None:
+            value = rule.action(
+                rule.pin, rule.rule, mqtt=mqtt, config=CONFIG, **params
+            )
+        else:
+            value = rule.action(
+                rule.pin, rule.rule, mqtt=mqtt, config=CONFIG,
+                samples=samples, **params
+            )
+    except Exception:
+        # With the outbox a lost broker takes the device offline, and the
+        # mqtt driven rule keeps its last value
+        if rule.action_name not in rules.MQTT_RULES or get_outbox() is None:
+            raise
+        set_mqtt_offline(mqtt)
+        return
+
+    complete_rule(mqtt, rule, value)
+
+
+def run_cycle(mqtt, plan, run_count, check_health=True):
+    """
+    Run a single pass of the compiled rule plan.
+    """
+    if check_health:
+        health_check(mqtt)
+    poll_subscriptions(mqtt)
+
+    # Sample all the sampled pins due this cycle together before running the
+    # rules
+    sampled = [
+        rule for rule in plan
+        if rule.sampler and run_count % rule.interval == 0
+    ]
+    samples = {}
+    if sampled:
+        readings = rules.collect_samples([
+            (rule.sampler, rule.pin, rule.rule, rule.params)
+            for rule in sampled
+        ])
+        for rule, rule_samples in zip(sampled, readings):
+            samples[rule.identifier] = rule_samples
+
+    for rule in plan:
+        if run_count % rule.interval == 0:
+            run_rule(mqtt, rule, samples.get(rule.identifier))
+        else:
+            log_message(
+                mqtt, 'Skipping rule: {action}.', DEBUG,
+                action=rule.action_name
+            )
+
+    log_status(mqtt)
+    flush_logs(mqtt)
+    save_outbox()
+
+
+def handle_events(mqtt, plan):
+    """
+    Apply the edges of the event inputs: the rules reading a changed input
+    run straight away, followed by the actuators whose inputs changed, and
+    the status is published.
+    """
+    events.settle()
+    edges, dropped = events.drain()
+    if dropped:
+        log_message(
+            mqtt, 'Dropped {count} input events.', WARNING, count=dropped
+        )
+    if not edges:
+        return
+
+    changed = {}
+    for event_input, _, ticks in edges:
+        changed.setdefault(event_input, ticks)
+
+    # The plan is ordered, so the actuators run after the rules they read
+    for rule in plan:
+        if rule.pin in changed and rule.action_name in rules.EVENT_RULES:
+            run_rule(mqtt, rule)
+            log_message(
+                mqtt, 'Input {identifier} changed {latency} ms ago.', DEBUG,
+                identifier=rule.identifier,
+                latency=time.ticks_diff(time.ticks_ms(), changed[rule.pin])
+            )
+        elif rule.actuator:
+            run_rule(mqtt, rule)
+
+    log_status(mqtt)
+    flush_logs(mqtt)
+    save_outbox()
+
+
+def wait_cycle(mqtt, plan):
+    """
+    Sleep until the next cycle, handling the edges of the event inputs as
+    they come in.
+    """
+    process_interval = CONFIG['main']['process_interval']
+    if not events.active():
+        time.sleep(process_interval)
+        return
+
+    deadline = time.ticks_add(time.ticks_ms(), int(process_interval * 1000))
+    while True:
+        remaining = time.ticks_diff(deadline, time.ticks_ms())
+        if remaining <= 0:
+            return
+        time.sleep_ms(min(remaining, EVENT_POLL_INTERVAL))
+        events.settle()
+        if events.pending():
+            handle_events(mqtt, plan)
+
+
 def run(mqtt, pin_config):
 
     log_message(mqtt, 'Device started.', DEBUG)
 
     pins = create_pins(pin_config)
+    plan = compile_plan(pin_config, pins)
+    check_plan(mqtt, plan)
+    subscribe_rules(mqtt, plan)
+    subscribe_status_requests(mqtt)
 
     run_count = 0
     while True:
 
-        health_check(mqtt)
+        run_cycle(mqtt, plan, run_count)
 
-        for pin in pin_config:
-            rule = pin['rule']
+        wait_cycle(mqtt, plan)
 
-            # Get the rule action method
-            action = getattr(rules, rule['action'])
+        # Check if the config has been updated and apply it
+        config = check_config()
+        if config:
+            plan, _, _ = reload_config(mqtt, config, plan, pins)
 
-            # Retrieve method parms including return values from previous
-            # actions
-            rule_params = {}
-            for input_key, input_value in rule['input'].items():
+        run_count += 1
 
-                # Determine if the input contains a condition and evalute the
-                # condition against the previously stored rule values.
-                if type(input_value) == dict and 'conditions' in input_value:
-                    condition_values = handle_conditions(
-                        RULE_VALUES,
-                        input_value
-                    )
-                    rule_params[input_key] = any([
-                        all(condition_values['must']),
-                        any(condition_values['should'])
-                    ])
 
-                else:
-                    rule_params[input_key] = input_value
-
-            if run_count % pin.get('interval', 1) == 0:
-                log_message(
-                    mqtt,
-                    'Running rule: {action} with input: {input}.'.format(
-                        action=rule['action'], input=str(rule_params)
-                    ),
-                    DEBUG
-                )
+async def sample_rule_async(rule):
+    """
+    Take the rule's samples, yielding to the other tasks between readings.
+    """
+    params = rule.params
+    interval = params.get('sample_interval', rules.SAMPLE_INTERVAL)
 
-                # Add mqtt and server config to rule params by default
-                rule_params['mqtt'] = mqtt
-                rule_params['config'] = CONFIG
+    samples = []
+    for index in range(params.get('sample_size', 5)):
+        if index:
+            await asyncio.sleep(interval)
+        samples.append(rule.sampler(rule.pin, rule.rule, **params))
 
-                # Run the rule with the appropriate params and save the result
-                # to rule values
-                RULE_VALUES[pin['identifier']] = action(
-                    pins[pin['identifier']], rule, **rule_params
-                )
+    return samples
 
-                log_message(
-                    mqtt,
-                    'Completed rule: {action} with output: {output}.'.format(
-                        action=rule['action'],
-                        output=RULE_VALUES[pin['identifier']]
-                    ),
-                    DEBUG
-                )
-            else:
-                log_message(
-                    mqtt,
-                    'Skipping rule: {action} with input: {input}.'.format(
-                        action=rule['action'], input=str(rule_params)
-                    ),
-                    DEBUG
-                )
 
-        log_status(mqtt, json.dumps(RULE_VALUES))
+async def rule_task(mqtt, rule, period):
+    while True:
+        if rule.sampler:
+            run_rule(mqtt, rule, await sample_rule_async(rule))
+        elif rule.async_action:
+            params = prepare_rule(mqtt, rule)
+            value = await rule.async_action(
+                rule.pin, rule.rule, mqtt=mqtt, config=CONFIG, **params
+            )
+            complete_rule(mqtt, rule, value)
+        else:
+            run_rule(mqtt, rule)
 
-        time.sleep(CONFIG['main']['process_interval'])
+        await asyncio.sleep(period)
 
-        # Check if the config has been updated, reboot if it has
-        if CONFIG != load_config():
-            reset()
 
-        run_count += 1
+async def health_task(mqtt):
+    while True:
+        await health_check_async(mqtt)
+        process_interval = CONFIG['main']['process_interval']
+        await asyncio.sleep(
+            CONFIG['health'].get('interval', process_interval)
+        )
 
 
-if __name__ == '__main__':
+async def status_task(mqtt):
+    while True:
+        await asyncio.sleep(CONFIG['main']['process_interval'])
+        log_status(mqtt)
+        flush_logs(mqtt)
+        save_outbox()
+
+
+async def mqtt_task(mqtt):
+    while True:
+        poll_subscriptions(mqtt)
+        await asyncio.sleep(CONFIG['mqtt'].get('poll_interval', 1))
+
+
+async def event_task(mqtt, plan):
+    """
+    Handle the edges of the event inputs as soon as their irq wakes it.
+    """
+    flag = events.FLAG = ThreadSafeFlag()
+    while True:
+        await flag.wait()
+
+        # ThreadSafeFlag.wait() resets the flag, and uasyncio 1.19 has no
+        # clear(). Only the asyncio.Event fallback needs clearing.
+        if ThreadSafeFlag is asyncio.Event:
+            flag.clear()
+        handle_events(mqtt, plan)
+
+        # Settle the inputs still bouncing, a changed level wakes the task
+        # again
+        while events.settle():
+            await asyncio.sleep(EVENT_POLL_INTERVAL / 1000)
+
+
+async def config_task(mqtt, plan, pins, rule_tasks, failures, stopped):
+    """
+    Apply config changes, restarting the tasks of the changed rules.
+    """
+    while True:
+        await asyncio.sleep(CONFIG['main']['process_interval'])
+
+        config = check_config()
+        if not config:
+            continue
+
+        process_interval = CONFIG['main']['process_interval']
+        new_plan, rebuilt, removed = reload_config(mqtt, config, plan, pins)
+
+        # The plan is shared with the event task
+        plan[:] = new_plan
+
+        # Rules running every n process intervals change period with it
+        if CONFIG['main']['process_interval'] != process_interval:
+            rebuilt = plan
+
+        for identifier in removed:
+            rule_tasks.pop(identifier).cancel()
+        for rule in rebuilt:
+            task = rule_tasks.pop(rule.identifier, None)
+            if task:
+                task.cancel()
+            start_rule_task(mqtt, rule, rule_tasks, failures, stopped)
+
+
+async def supervise(coro, failures, stopped):
+    """
+    Run the task, stopping the runtime if it raises.
+    """
+    try:
+        await coro
+    except Exception as exc:
+        failures.append(exc)
+        stopped.set()
+
+
+def start_rule_task(mqtt, rule, rule_tasks, failures, stopped):
+    period = rule.period
+    if period is None:
+        period = rule.interval * CONFIG['main']['process_interval']
+
+    rule_tasks[rule.identifier] = asyncio.create_task(
+        supervise(rule_task(mqtt, rule, period), failures, stopped)
+    )
+
+
+async def run_async(mqtt, pin_config):
+    """
+    Run every rule as its own periodic task, next to the health check,
+    status, mqtt and config tasks. A rule runs every `period` seconds,
+    falling back to `interval` process intervals.
+    """
+
+    log_message(mqtt, 'Device started.', DEBUG)
+
+    pins = create_pins(pin_config)
+    plan = compile_plan(pin_config, pins)
+    check_plan(mqtt, plan)
+    subscribe_rules(mqtt, plan)
+    subscribe_status_requests(mqtt)
+
+    failures = []
+    stopped = asyncio.Event()
+    rule_tasks = {}
+
+    for task in (
+        health_task(mqtt),
+        status_task(mqtt),
+        mqtt_task(mqtt),
+        config_task(mqtt, plan, pins, rule_tasks, failures, stopped),
+        event_task(mqtt, plan),
+    ):
+        asyncio.create_task(supervise(task, failures, stopped))
+
+    for rule in plan:
+        start_rule_task(mqtt, rule, rule_tasks, failures, stopped)
+
+    await stopped.wait()
+    raise failures[0]
+
+
+def save_sleep_state(run_count, last_sync):
+    """
+    Save the run counter, the last time sync, the rule values and the digest
+    of the published status to RTC memory for the next wake.
+    """
+    values = json.dumps(RULE_VALUES).encode('utf-8')
+
+    # The published status is only recorded when it matches the rule values,
+    # which is the case unless publishing failed
+    digest = b'\x00\x00\x00\x00'
+    if PUBLISHED_STATUS == RULE_VALUES:
+        digest = hashlib.sha1(values).digest()[:4]
+
+    flags = 0
+    if last_sync is not None:
+        flags |= SYNCED
+    if STATUS_SNAPSHOT_TIME is not None:
+        flags |= SNAPSHOT
+
+    payload = values
+    header_size = struct.calcsize(SLEEP_STATE_HEADER)
+    if header_size + len(values) > RTC_MEMORY_SIZE.get(sys.platform, 2048):
+        with open(SLEEP_STATE_PATH, 'wb') as state_file:
+            state_file.write(values)
+        flags |= IN_FLASH
+        payload = b''
+
+    machine.RTC().memory(
+        struct.pack(
+            SLEEP_STATE_HEADER,
+            SLEEP_STATE_MAGIC,
+            flags,
+            run_count,
+            int(last_sync or 0),
+            int(STATUS_SNAPSHOT_TIME or 0),
+            digest,
+            len(values)
+        ) + payload
+    )
+
+
+def restore_sleep_state():
+    """
+    Restore the state saved before the last deep sleep. Returns the run
+    counter and the time of the last time sync, which are 0 and None after
+    a cold boot.
+    """
+    global STATUS_SNAPSHOT_TIME
+
+    if machine.reset_cause() != machine.DEEPSLEEP_RESET:
+        return 0, None
+
+    data = machine.RTC().memory()
+    header_size = struct.calcsize(SLEEP_STATE_HEADER)
+    if len(data) < header_size:
+        return 0, None
+
+    magic, flags, run_count, last_sync, snapshot_time, digest, size = (
+        struct.unpack(SLEEP_STATE_HEADER, data[:header_size])
+    )
+    if magic != SLEEP_STATE_MAGIC:
+        return 0, None
+
+    if flags & IN_FLASH:
+        try:
+            with open(SLEEP_STATE_PATH, 'rb') as state_file:
+                values = state_file.read()
+        except OSError:
+            values = b''
+    else:
+        values = data[header_size:header_size + size]
+
+    if len(values) == size:
+        try:
+            RULE_VALUES.update(json.loads(values))
+        except ValueError:
+            pass
+        else:
+            # Without the published status the next status is a full
+            # snapshot
+            if digest == hashlib.sha1(values).digest()[:4]:
+                PUBLISHED_STATUS.update(RULE_VALUES)
+                if flags & SNAPSHOT:
+                    STATUS_SNAPSHOT_TIME = snapshot_time
+
+    if not flags & SYNCED:
+        last_sync = None
+    return run_count, last_sync
+
+
+def deep_sleep(seconds):
+    ms = int(seconds * 1000)
+    if sys.platform == 'esp8266':
+        # The ESP8266 wakes from an RTC alarm, with GPIO16 wired to RST
+        rtc = machine.RTC()
+        rtc.irq(trigger=rtc.ALARM0, wake=machine.DEEPSLEEP)
+        rtc.alarm(rtc.ALARM0, ms)
+        machine.deepsleep()
+    else:
+        machine.deepsleep(ms)
+
+
+class DeferredMQTT(object):
+    """
+    MQTT client which only connects when it is first used, so a wake with
+    nothing to publish or receive doesn't set up a connection.
+    """
+
+    def __init__(self, mqtt_config):
+        self.mqtt_config = mqtt_config
+        self.client = None
+
+    def __getattr__(self, name):
+        if self.client is None:
+            self.client = init_mqtt(self.mqtt_config)
+        return getattr(self.client, name)
+
+    def ping(self):
+        # Nothing to check until the connection is needed
+        if self.client is not None:
+            self.client.ping()
+
+    def disconnect(self):
+        if self.client is not None:
+            self.client.disconnect()
+            self.client = None
+
+
+def run_deepsleep(mqtt, pin_config):
+    """
+    Run a single pass of the rules and deep sleep for `process_interval`.
+    The rule values, status and run counter carry over in RTC memory, and
+    the time is only synced every `time.sync_interval` seconds.
+    """
+    run_count, last_sync = restore_sleep_state()
+
+    sync_interval = CONFIG['time'].get('sync_interval', 3600)
+    if last_sync is None or time.time() - last_sync >= sync_interval:
+        set_time(mqtt, CONFIG['time'])
+        last_sync = time.time()
+
+    log_message(
+        mqtt, 'Device woke up for run {count}.', DEBUG, count=run_count
+    )
+
+    # The health check runs every `health.interval` seconds, rounded to
+    # whole wakes
+    process_interval = CONFIG['main']['process_interval']
+    health_every = max(
+        1, int(CONFIG['health'].get('interval', process_interval)
+               // process_interval)
+    )
+
+    pins = create_pins(pin_config)
+    plan = compile_plan(pin_config, pins)
+    if not run_count:
+        check_plan(mqtt, plan)
+    run_cycle(
+        mqtt, plan, run_count, check_health=run_count % health_every == 0
+    )
+
+    save_sleep_state(run_count + 1, last_sync)
+
+    # Disconnect cleanly so the broker doesn't publish the last will
+    mqtt.disconnect()
+    deep_sleep(process_interval)
+
+
+def start():
+    """
+    Boot the device from its config and run the rules. Called by main.py
+    itself or, for a precompiled install, by the main.py stub importing it
+    as `firmware`.
+    """
+    global CONFIG, DEVICE_ID
 
     CONFIG = load_config()
     DEVICE_ID = CONFIG['main']['identifier']
@@ -356,16 +1601,31 @@ if __name__ == '__main__':
         if not DEVICE_ID:
             raise Exception('Device not yet configured.')
 
-        # Connects to the configured mqtt queue
         mqtt_config = CONFIG['mqtt']
+        mode = CONFIG['main'].get('mode', LOOP)
+
+        # A deep sleeping device only connects and syncs the time when due
+        if mode == DEEPSLEEP:
+            mqtt = DeferredMQTT(mqtt_config)
+            run_deepsleep(mqtt, pin_config)
+            return
+
+        # Connects to the configured mqtt queue
         mqtt = init_mqtt(mqtt_config)
 
         # Set the local time
         set_time(mqtt, CONFIG['time'])
 
         # Run the rules
-        run(mqtt, pin_config)
+        if mode == ASYNC:
+            asyncio.run(run_async(mqtt, pin_config))
+        else:
+            run(mqtt, pin_config)
 
     except Exception as exc:
         log_message(mqtt, str(exc), ERROR)
         reset()
+
+
+if __name__ == '__main__':
+    start()
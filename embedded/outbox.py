@@ -0,0 +1,316 @@
+"""
+Store-and-forward buffer for MQTT messages published while the broker is
+unreachable.
+
+Records are appended to a ring of fixed segment files in flash. A segment
+starts with a header holding its sequence number and is only ever appended
+to, then deleted whole once its records are sent, so no sector is
+rewritten in place. Segments are allocated round-robin to spread the wear,
+and when the ring is full the oldest segment is dropped. Records are kept
+in RAM until `flush()`, so a cycle's messages cost a single flash write.
+
+A record is a packed header followed by the topic and the payload:
+
+    uint32 time, uint8 flags, uint8 topic length, uint16 payload length
+
+Topics under the device's prefix are stored without it.
+"""
+import os
+import struct
+import time
+from array import array
+
+OUTBOX_DIR = 'outbox'
+SEGMENT_SIZE = 4096
+SEGMENT_COUNT = 8
+
+SEGMENT_MAGIC = b'OB'
+SEGMENT_HEADER = '<2sI'
+RECORD_HEADER = '<IBBH'
+
+# Record flags
+RETAIN = 1
+RELATIVE = 2
+
+# Seconds to add to the device time for unix time, MicroPython's epoch
+# starts at 2000-01-01
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+
+class Outbox(object):
+    """
+    A ring of `count` segment files of up to `size` bytes in `directory`.
+    """
+
+    def __init__(self, prefix='', directory=OUTBOX_DIR, size=SEGMENT_SIZE,
+                 count=SEGMENT_COUNT):
+        self.prefix = prefix.encode('utf-8')
+        self.directory = directory
+        self.size = size
+        self.count = count
+
+        # Sequence number (-1 when free), bytes and records by segment slot
+        self.sequences = array('i', [-1] * count)
+        self.sizes = array('I', [0] * count)
+        self.records = array('I', [0] * count)
+
+        # Newest and oldest segment slots, the last slot allocated and the
+        # read position in the oldest segment
+        self.head = None
+        self.tail = None
+        self.last = (None, -1)
+        self.offset = 0
+        self.read_records = 0
+        self.batch = (0, 0)
+        self.pending = bytearray()
+        self.pending_records = 0
+        self.dropped = 0
+        self.load()
+
+    def path(self, slot):
+        return '{directory}/{slot}.seg'.format(
+            directory=self.directory, slot=slot
+        )
+
+    def load(self):
+        """
+        Recover the segments left in flash by a previous boot.
+        """
+        header_size = struct.calcsize(SEGMENT_HEADER)
+        truncated = []
+        for slot in range(self.count):
+            try:
+                with open(self.path(slot), 'rb') as segment:
+                    magic, sequence = struct.unpack(
+                        SEGMENT_HEADER, segment.read(header_size)
+                    )
+                    size, records, complete = self.scan(segment)
+            except (OSError, ValueError):
+                continue
+            if magic != SEGMENT_MAGIC:
+                continue
+
+            self.sequences[slot] = sequence
+            self.sizes[slot] = size
+            self.records[slot] = records
+            if not complete:
+                truncated.append(slot)
+            if self.head is None or sequence > self.sequences[self.head]:
+                self.head = slot
+            if self.tail is None or sequence < self.sequences[self.tail]:
+                self.tail = slot
+
+        self.offset = header_size
+        if self.head is not None:
+            self.last = (self.head, self.sequences[self.head])
+
+            # Don't append after a record cut short by a power loss
+            if self.head in truncated:
+                self.rotate()
+
+    def scan(self, segment):
+        """
+        Returns the size and record count of the segment up to the last
+        complete record, and whether the segment ends there.
+        """
+        header_size = struct.calcsize(RECORD_HEADER)
+        size = struct.calcsize(SEGMENT_HEADER)
+        records = 0
+        while True:
+            header = segment.read(header_size)
+            if not header:
+                return size, records, True
+            if len(header) < header_size:
+                return size, records, False
+            _, _, topic_length, payload_length = struct.unpack(
+                RECORD_HEADER, header
+            )
+            length = topic_length + payload_length
+            if len(segment.read(length)) < length:
+                return size, records, False
+            size += header_size + length
+            records += 1
+
+    def __len__(self):
+        return sum(self.records) + self.pending_records - self.read_records
+
+    def used(self):
+        """
+        Returns the bytes of flash used by the segments.
+        """
+        return sum(self.sizes)
+
+    def append(self, timestamp, topic, payload, retain=False):
+        """
+        Buffer a message, returns False if it is too large for a segment.
+        """
+        if isinstance(topic, str):
+            topic = topic.encode('utf-8')
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        flags = RETAIN if retain else 0
+        if self.prefix and topic.startswith(self.prefix):
+            topic = topic[len(self.prefix):]
+            flags |= RELATIVE
+
+        length = struct.calcsize(RECORD_HEADER) + len(topic) + len(payload)
+        if (
+            len(topic) > 255 or len(payload) > 65535
+            or struct.calcsize(SEGMENT_HEADER) + length > self.size
+        ):
+            self.dropped += 1
+            return False
+
+        if (
+            self.head is None
+            or self.sizes[self.head] + len(self.pending) + length > self.size
+        ):
+            self.flush()
+            self.rotate()
+
+        self.pending.extend(
+            struct.pack(
+                RECORD_HEADER, int(timestamp), flags, len(topic), len(payload)
+            )
+        )
+        self.pending.extend(topic)
+        self.pending.extend(payload)
+        self.pending_records += 1
+        return True
+
+    def flush(self):
+        """
+        Write the buffered records to the head segment.
+        """
+        if not self.pending:
+            return
+        with open(self.path(self.head), 'ab') as segment:
+            segment.write(self.pending)
+        self.sizes[self.head] += len(self.pending)
+        self.records[self.head] += self.pending_records
+        self.pending = bytearray()
+        self.pending_records = 0
+
+    def rotate(self):
+        """
+        Start a new head segment in the next slot, dropping the oldest
+        segment when the ring is full.
+        """
+        last_slot, last_sequence = self.last
+        slot = 0 if last_slot is None else (last_slot + 1) % self.count
+        sequence = last_sequence + 1
+
+        if self.sequences[slot] >= 0:
+            self.dropped += self.records[slot] - (
+                self.read_records if slot == self.tail else 0
+            )
+            self.release(slot)
+
+        try:
+            os.mkdir(self.directory)
+        except OSError:
+            pass
+        with open(self.path(slot), 'wb') as segment:
+            segment.write(
+                struct.pack(SEGMENT_HEADER, SEGMENT_MAGIC, sequence)
+            )
+        self.sequences[slot] = sequence
+        self.sizes[slot] = struct.calcsize(SEGMENT_HEADER)
+        self.records[slot] = 0
+        self.head = slot
+        self.last = (slot, sequence)
+        if self.tail is None:
+            self.tail = slot
+            self.offset = self.sizes[slot]
+
+    def release(self, slot):
+        """
+        Delete the segment, moving the tail to the next one if it was the
+        oldest.
+        """
+        try:
+            os.remove(self.path(slot))
+        except OSError:
+            pass
+        self.sequences[slot] = -1
+        self.sizes[slot] = 0
+        self.records[slot] = 0
+
+        if slot == self.tail:
+            self.offset = struct.calcsize(SEGMENT_HEADER)
+            self.read_records = 0
+            self.batch = (0, 0)
+            if slot == self.head:
+                self.head = self.tail = None
+            else:
+                self.tail = (slot + 1) % self.count
+
+    def read_batch(self, max_size):
+        """
+        Returns the oldest records, up to `max_size` bytes of topics and
+        payloads (at least one record), as (unix time, topic, payload,
+        retain) tuples. They stay buffered until `commit()`.
+        """
+        self.flush()
+
+        # Skip the segments left empty by a power loss
+        while self.tail is not None and self.tail != self.head and (
+            self.offset >= self.sizes[self.tail]
+        ):
+            self.release(self.tail)
+        if self.tail is None:
+            return []
+
+        header_size = struct.calcsize(RECORD_HEADER)
+        prefix = self.prefix.decode('utf-8')
+        batch = []
+        read = 0
+        offset = self.offset
+        with open(self.path(self.tail), 'rb') as segment:
+            segment.seek(offset)
+            while offset < self.sizes[self.tail]:
+                timestamp, flags, topic_length, payload_length = (
+                    struct.unpack(RECORD_HEADER, segment.read(header_size))
+                )
+                if batch and read + topic_length + payload_length > max_size:
+                    break
+                topic = segment.read(topic_length).decode('utf-8')
+                if flags & RELATIVE:
+                    topic = prefix + topic
+                batch.append((
+                    timestamp + EPOCH_OFFSET,
+                    topic,
+                    segment.read(payload_length).decode('utf-8'),
+                    bool(flags & RETAIN),
+                ))
+                read += topic_length + payload_length
+                offset += header_size + topic_length + payload_length
+
+        self.batch = (offset, len(batch))
+        return batch
+
+    def commit(self):
+        """
+        Drop the records returned by the last `read_batch()`, deleting the
+        oldest segment once all of it is sent.
+        """
+        offset, records = self.batch
+        if self.tail is None or not records:
+            return
+        self.offset = offset
+        self.read_records += records
+        self.batch = (0, 0)
+
+        # Records buffered since the batch was read go to the head segment
+        if self.tail == self.head:
+            self.flush()
+        if self.offset >= self.sizes[self.tail]:
+            self.release(self.tail)
+
+    def clear(self):
+        for slot in range(self.count):
+            if self.sequences[slot] >= 0:
+                self.release(slot)
+        self.pending = bytearray()
+        self.pending_records = 0
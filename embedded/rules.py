@@ -1,58 +1,266 @@
-import json
-import socket
 import time
 
+import httpclient
 
+
+# Latest message per subscribed topic and the handlers routed each message
 MQTT_SUB_MSG = {}
+MQTT_SUBSCRIPTIONS = {}
+MQTT_RECEIVED = 0
+
+# Most messages handled per poll, so a flood can't starve the rules
+MQTT_POLL_LIMIT = 20
+
+# Default seconds between readings for the sampled rules
+SAMPLE_INTERVAL = 0.5
+
+# Service responses cached by url, limited to a total number of body bytes
+SERVICE_CACHE = {}
+SERVICE_CACHE_SIZE = 16384
+SERVICE_CACHE_CLOCK = 0
+
+# BMP180 drivers by (I2C bus, address), see `get_bmp180`
+BMP180_SENSORS = {}
+
+# Oled displays and what they show by (I2C bus, address), see `display`
+DISPLAYS = {}
+DISPLAY_FIELD_WIDTH = 6
+DISPLAY_REFRESH_INTERVAL = 1
 
 
 def get_mqtt_msg(topic, msg):
-    global MQTT_SUB_MSG
+    global MQTT_RECEIVED
+
+    MQTT_RECEIVED += 1
     if topic and msg:
-        MQTT_SUB_MSG[str(topic.decode('utf-8'))] = str(msg.decode('utf-8'))
+        topic = str(topic.decode('utf-8'))
+        msg = str(msg.decode('utf-8'))
+        MQTT_SUB_MSG[topic] = msg
+        for handler in MQTT_SUBSCRIPTIONS.get(topic, ()):
+            handler(topic, msg)
+
+
+def subscribe_mqtt(mqtt, topic, handler=None, connected=True):
+    """
+    Subscribe to the topic the first time it is registered, routing its
+    messages to the handler if given. While not connected the topic is only
+    registered, to be subscribed by `resubscribe_mqtt` on reconnect.
+    """
+    handlers = MQTT_SUBSCRIPTIONS.get(topic)
+    if handlers is None:
+        handlers = MQTT_SUBSCRIPTIONS[topic] = []
+        if connected:
+            mqtt.set_callback(get_mqtt_msg)
+            mqtt.subscribe(topic)
+    if handler and handler not in handlers:
+        handlers.append(handler)
+
+
+def resubscribe_mqtt(mqtt):
+    """
+    Subscribe to all the registered topics again after reconnecting.
+    """
+    mqtt.set_callback(get_mqtt_msg)
+    for topic in MQTT_SUBSCRIPTIONS:
+        mqtt.subscribe(topic)
+
 
+def poll_mqtt(mqtt):
+    """
+    Handle every pending message, up to `MQTT_POLL_LIMIT`.
+    """
+    for _ in range(MQTT_POLL_LIMIT):
+        received = MQTT_RECEIVED
+        op = mqtt.check_msg()
+        if op is None and received == MQTT_RECEIVED:
+            break
+
+
+class CachedResponse(object):
+    """
+    A parsed service response kept for `cache_ttl` seconds.
+    """
 
-def get_service_response(url, auth_header=None):
-    response_body = ''
+    def __init__(self, value, size, headers):
+        self.value = value
+        self.size = size
+        self.etag = headers.get('etag')
+        self.last_modified = headers.get('last-modified')
+        self.expires = 0
+        self.last_used = 0
 
-    _, _, host, path = url.split('/', 3)
-    port = 80
-    if ':' in host:
-        host, port = host.split(':', 1)
 
-    address = socket.getaddrinfo(host, int(port))[0][-1]
+def get_request_headers(auth_header, cached=None):
+    """
+    Returns the request header lines, revalidating the cached response if
+    there is one.
+    """
+    headers = []
     if auth_header:
-        request = 'GET /{path} HTTP/1.0\r\nHost: {host}\r\n{auth_header}\r\n\r\n'.format(
-            path=path,
-            host=host,
-            auth_header=auth_header
-        )
-    else:
-        request = 'GET /{path} HTTP/1.0\r\nHost: {host}\r\n\r\n'.format(
-            path=path,
-            host=host
+        headers.append(auth_header)
+    if cached:
+        if cached.etag:
+            headers.append('If-None-Match: ' + cached.etag)
+        if cached.last_modified:
+            headers.append('If-Modified-Since: ' + cached.last_modified)
+    return headers
+
+
+def get_cached_response(url):
+    """
+    Returns the cached response for the url and whether it is still fresh.
+    """
+    global SERVICE_CACHE_CLOCK
+
+    cached = SERVICE_CACHE.get(url)
+    if cached is None:
+        return None, False
+
+    SERVICE_CACHE_CLOCK += 1
+    cached.last_used = SERVICE_CACHE_CLOCK
+    return cached, time.time() < cached.expires
+
+
+def cache_response(url, cached, status, headers, body, cache_ttl, config):
+    """
+    Update the cache from a response and return the parsed value. A 304
+    reply refreshes the cached response without parsing anything.
+    """
+    global SERVICE_CACHE_CLOCK
+
+    if status == 304 and cached:
+        cached.expires = time.time() + cache_ttl
+        return cached.value
+
+    SERVICE_CACHE.pop(url, None)
+    if status not in (200, 201, 301):
+        return None
+
+    value = httpclient.loads(body)
+
+    budget = SERVICE_CACHE_SIZE
+    if config:
+        budget = config['main'].get('service_cache_size', budget)
+    if len(body) > budget:
+        return value
+
+    # Evict the least recently used responses until the new one fits
+    used = sum(cached.size for cached in SERVICE_CACHE.values())
+    while SERVICE_CACHE and used + len(body) > budget:
+        oldest = min(
+            SERVICE_CACHE, key=lambda key: SERVICE_CACHE[key].last_used
         )
+        used -= SERVICE_CACHE.pop(oldest).size
 
-    _socket = socket.socket()
-    _socket.settimeout(15.0)
-    _socket.connect(address)
-    _socket.send(bytes(request, 'utf8'))
+    SERVICE_CACHE_CLOCK += 1
+    cached = CachedResponse(value, len(body), headers)
+    cached.expires = time.time() + cache_ttl
+    cached.last_used = SERVICE_CACHE_CLOCK
+    SERVICE_CACHE[url] = cached
 
-    while True:
-        data = _socket.recv(100)
-        if data:
-            response_body += str(data, 'utf8')
-        else:
-            break
-    _socket.close()
+    return value
+
+
+def skip_response(url, error):
+    """
+    Log a response too large to be read, the rule gets None instead.
+    """
+    print('Skipped the response of {url}: {error}'.format(
+        url=url, error=error
+    ))
+
+
+def fetch_service(url, headers, max_size):
+    """
+    Returns the status, headers and body of a GET on the url, or None when
+    the body is larger than `max_size`.
+    """
+    try:
+        return httpclient.get(url, headers, max_size)
+    except httpclient.ResponseTooLarge as error:
+        skip_response(url, error)
+        return None
+
+
+async def fetch_service_async(url, headers, max_size):
+    """
+    Non-blocking version of `fetch_service` for the async runtime.
+    """
+    try:
+        return await httpclient.get_async(url, headers, max_size)
+    except httpclient.ResponseTooLarge as error:
+        skip_response(url, error)
+        return None
+
+
+def get_service_response(url, auth_header=None, max_size=None):
+    response = fetch_service(url, get_request_headers(auth_header), max_size)
+    if response is not None and response[0] in (200, 201, 301):
+        return httpclient.loads(response[2])
+
+    return None
 
-    response_lines = response_body.split()
-    if response_lines[1] in ['200', '201', '301']:
-        return json.loads(response_lines[-1])
+
+async def get_service_response_async(url, auth_header=None, max_size=None):
+    """
+    Non-blocking version of `get_service_response` for the async runtime.
+    """
+    response = await fetch_service_async(
+        url, get_request_headers(auth_header), max_size
+    )
+    if response is not None and response[0] in (200, 201, 301):
+        return httpclient.loads(response[2])
 
     return None
 
 
+def collect_samples(jobs):
+    """
+    Take the samples for several pins in shared time slots. Each job is a
+    tuple of (reader, pin, rule, kwargs) and is sampled `sample_size` times,
+    `sample_interval` seconds apart, so the whole set costs as long as the
+    slowest job instead of the sum of all of them.
+    """
+    readings = [[] for _ in jobs]
+    start = time.ticks_ms()
+
+    while True:
+        next_due = None
+        elapsed = time.ticks_diff(time.ticks_ms(), start)
+        for index, (reader, pin, rule, kwargs) in enumerate(jobs):
+            sample_size = kwargs.get('sample_size', 5)
+            interval = int(
+                kwargs.get('sample_interval', SAMPLE_INTERVAL) * 1000
+            )
+
+            taken = len(readings[index])
+            if taken < sample_size and taken * interval <= elapsed:
+                readings[index].append(reader(pin, rule, **kwargs))
+                taken += 1
+
+            if taken < sample_size:
+                due = taken * interval
+                if next_due is None or due < next_due:
+                    next_due = due
+
+        if next_due is None:
+            return readings
+
+        wait = next_due - time.ticks_diff(time.ticks_ms(), start)
+        if wait > 0:
+            time.sleep_ms(wait)
+
+
+def get_samples(reader, pin, rule, **kwargs):
+    """
+    Return the samples collected by the main loop or sample the pin now.
+    """
+    samples = kwargs.get('samples')
+    if samples is None:
+        samples = collect_samples([(reader, pin, rule, kwargs)])[0]
+    return samples
+
+
 def read(pin, rule, **kwargs):
     reverse = kwargs.get('reverse', False)
     if reverse:
@@ -64,36 +272,28 @@ def read_bool(pin, rule, **kwargs):
     return bool(read(pin, rule, **kwargs))
 
 
+def read_count(pin, rule, **kwargs):
+    """
+    Returns the pulses counted by an event input since the last run.
+    """
+    return pin.take_pulses()
+
+
 def read_avg_sample(pin, rule, **kwargs):
-    readings = []
-    for _ in range(kwargs.get('sample_size', 5)):
-        readings.append(read(pin, rule, **kwargs))
-        time.sleep(0.5)
+    readings = get_samples(read, pin, rule, **kwargs)
     return int(sum(readings) / len(readings))
 
 
 def read_min_sample(pin, rule, **kwargs):
-    readings = []
-    for _ in range(kwargs.get('sample_size', 5)):
-        readings.append(read(pin, rule, **kwargs))
-        time.sleep(0.5)
-    return min(readings)
+    return min(get_samples(read, pin, rule, **kwargs))
 
 
 def read_max_sample(pin, rule, **kwargs):
-    readings = []
-    for _ in range(kwargs.get('sample_size', 5)):
-        readings.append(read(pin, rule, **kwargs))
-        time.sleep(0.5)
-    return max(readings)
+    return max(get_samples(read, pin, rule, **kwargs))
 
 
 def read_bool_sample(pin, rule, **kwargs):
-    readings = []
-    for _ in range(kwargs.get('sample_size', 5)):
-        readings.append(read(pin, rule, **kwargs))
-        time.sleep(0.5)
-    return all(readings)
+    return all(get_samples(read, pin, rule, **kwargs))
 
 
 def read_analog(pin, rule, **kwargs):
@@ -111,35 +311,33 @@ def read_analog_percentage(pin, rule, **kwargs):
 
 
 def read_analog_avg_sample(pin, rule, **kwargs):
-    readings = []
-    for _ in range(kwargs.get('sample_size', 5)):
-        readings.append(read_analog(pin, rule, **kwargs))
-        time.sleep(0.5)
+    readings = get_samples(read_analog, pin, rule, **kwargs)
     return int(sum(readings) / len(readings))
 
 
 def read_analog_min_sample(pin, rule, **kwargs):
-    readings = []
-    for _ in range(kwargs.get('sample_size', 5)):
-        readings.append(read_analog(pin, rule, **kwargs))
-        time.sleep(0.5)
-    return min(readings)
+    return min(get_samples(read_analog, pin, rule, **kwargs))
 
 
 def read_analog_max_sample(pin, rule, **kwargs):
-    readings = []
-    for _ in range(kwargs.get('sample_size', 5)):
-        readings.append(read_analog(pin, rule, **kwargs))
-        time.sleep(0.5)
-    return max(readings)
+    return max(get_samples(read_analog, pin, rule, **kwargs))
 
 
 def read_analog_bool_sample(pin, rule, **kwargs):
-    readings = []
-    for _ in range(kwargs.get('sample_size', 5)):
-        readings.append(read_analog_bool(pin, rule, **kwargs))
-        time.sleep(0.5)
-    return all(readings)
+    return all(get_samples(read_analog_bool, pin, rule, **kwargs))
+
+
+# Single reading used by each of the sampled rules
+SAMPLE_READERS = {
+    'read_avg_sample': read,
+    'read_min_sample': read,
+    'read_max_sample': read,
+    'read_bool_sample': read,
+    'read_analog_avg_sample': read_analog,
+    'read_analog_min_sample': read_analog,
+    'read_analog_max_sample': read_analog,
+    'read_analog_bool_sample': read_analog_bool,
+}
 
 
 def read_dht(pin, rule, **kwargs):
@@ -161,21 +359,33 @@ def read_dht(pin, rule, **kwargs):
     }
 
 
-def read_bmp180(pin, rule, **kwargs):
+def get_bmp180(i2c_bus, address):
+    """
+    Returns the BMP180 driver for the bus and address, reading its
+    calibration on the first call only.
+    """
     from drivers.bmp180 import BMP180
 
+    key = (i2c_bus, address)
+    if key not in BMP180_SENSORS:
+        BMP180_SENSORS[key] = BMP180(i2c_bus, address)
+    return BMP180_SENSORS[key]
+
+
+def read_bmp180(pin, rule, **kwargs):
     oversample = kwargs.get('oversample', 2)
     baseline = kwargs.get('baseline', 101325)
 
-    bmp180_sensor = BMP180(pin)
+    bmp180_sensor = get_bmp180(pin, kwargs.get('address', 0x77))
 
     bmp180_sensor.oversample = oversample
     bmp180_sensor.baseline = baseline
 
+    temperature, pressure, altitude = bmp180_sensor.measure()
     return {
-        'temperature': bmp180_sensor.temperature(),
-        'pressure': bmp180_sensor.pressure() / 100,
-        'altitude': bmp180_sensor.altitude(),
+        'temperature': temperature,
+        'pressure': pressure / 100,
+        'altitude': altitude,
     }
 
 
@@ -185,16 +395,116 @@ def toggle(pin, rule, **kwargs):
     return pin.value()
 
 
+def format_field(field, value):
+    """
+    Returns the text of a layout field, padded or cut to its width.
+    """
+    if value is None:
+        text = '-'
+    else:
+        try:
+            text = field.get('format', '{}').format(value)
+        except (ValueError, TypeError):
+            text = str(value)
+
+    width = field.get('width', DISPLAY_FIELD_WIDTH)
+    if len(text) < width:
+        return ' ' * (width - len(text)) + text
+    return text[:width]
+
+
+def display(pin, rule, **kwargs):
+    """
+    Show the rule values of the `layout` fields on an SSD1306 Oled. The
+    values are passed in layout order as `values`. The labels are drawn
+    once, after that only the fields whose text changed are redrawn, at most
+    once per `refresh_interval` seconds. Returns the texts of the fields
+    last sent to the display, which stay the same while a refresh is held
+    back.
+    """
+    from drivers.oled import OledI2C
+
+    layout = kwargs.get('layout', [])
+    values = kwargs.get('values', [])
+    key = (pin, kwargs.get('address', 0x3c))
+
+    state = DISPLAYS.get(key)
+    if state is None:
+        state = DISPLAYS[key] = {
+            'oled': OledI2C(
+                kwargs.get('width', 128), kwargs.get('height', 64), pin,
+                key[1]
+            ),
+            'layout': None,
+            'refreshed': None,
+            'rendered': None,
+        }
+    oled = state['oled']
+
+    # Draw the labels of a new layout and work out where its values go
+    if state['layout'] is not layout:
+        if state['layout'] is not None:
+            oled.fill(0)
+        fields = []
+        for field in layout:
+            label = field.get('label', '')
+            if label:
+                oled.text(label, field['x'], field['y'])
+            fields.append((
+                field['x'] + len(label) * 8,
+                field['y'],
+                field.get('width', DISPLAY_FIELD_WIDTH) * 8,
+            ))
+        state['layout'] = layout
+        state['fields'] = fields
+        state['shown'] = [None] * len(layout)
+        state['texts'] = [None] * len(layout)
+        state['refreshed'] = None
+
+    shown = state['shown']
+    texts = state['texts']
+    changed = [
+        index for index in range(len(layout))
+        if texts[index] is None or values[index] != shown[index]
+    ]
+    if not changed:
+        return state['rendered']
+
+    now = time.ticks_ms()
+    refresh_interval = kwargs.get('refresh_interval', DISPLAY_REFRESH_INTERVAL)
+    if state['refreshed'] is not None and time.ticks_diff(
+        now, state['refreshed']
+    ) < refresh_interval * 1000:
+        return state['rendered']
+
+    # Values formatting to the same text aren't drawn again
+    fields = state['fields']
+    for index in changed:
+        shown[index] = values[index]
+        text = format_field(layout[index], values[index])
+        if text == texts[index]:
+            continue
+        texts[index] = text
+        x, y, width = fields[index]
+        oled.fill_rect(x, y, width, 8, 0)
+        oled.text(text, x, y)
+
+    oled.show()
+    state['refreshed'] = now
+    state['rendered'] = list(texts)
+    return state['rendered']
+
+
 def mqtt_toggle(pin, rule, retry_count=0, **kwargs):
     mqtt = kwargs.get('mqtt')
     topic = kwargs.get('topic')
 
-    if retry_count > 0:
-        mqtt.connect()
     try:
-        mqtt.set_callback(get_mqtt_msg)
-        mqtt.subscribe(topic)
-        mqtt.check_msg()
+        if retry_count > 0:
+            mqtt.connect()
+            resubscribe_mqtt(mqtt)
+        subscribe_mqtt(mqtt, topic)
+        poll_mqtt(mqtt)
     except Exception:
         if retry_count <= 3:
             retry_count += 1
@@ -220,5 +530,66 @@ def timer(pin, rule, **kwargs):
 def service(pin, rule, **kwargs):
     url = kwargs.get('url')
     auth_header = kwargs.get('auth_header')
+    max_size = kwargs.get('max_size')
+    cache_ttl = kwargs.get('cache_ttl')
+
+    if not cache_ttl:
+        return get_service_response(url, auth_header, max_size)
+
+    cached, fresh = get_cached_response(url)
+    if fresh:
+        return cached.value
+
+    response = fetch_service(
+        url, get_request_headers(auth_header, cached), max_size
+    )
+    if response is None:
+        return None
+    status, headers, body = response
+    return cache_response(
+        url, cached, status, headers, body, cache_ttl, kwargs.get('config')
+    )
+
+
+async def service_async(pin, rule, **kwargs):
+    url = kwargs.get('url')
+    auth_header = kwargs.get('auth_header')
+    max_size = kwargs.get('max_size')
+    cache_ttl = kwargs.get('cache_ttl')
+
+    if not cache_ttl:
+        return await get_service_response_async(url, auth_header, max_size)
+
+    cached, fresh = get_cached_response(url)
+    if fresh:
+        return cached.value
+
+    response = await fetch_service_async(
+        url, get_request_headers(auth_header, cached), max_size
+    )
+    if response is None:
+        return None
+    status, headers, body = response
+    return cache_response(
+        url, cached, status, headers, body, cache_ttl, kwargs.get('config')
+    )
+
+
+# Rules subscribed to their `topic` input at startup
+MQTT_RULES = ('mqtt_toggle',)
+
+# Rules reading the level of a pin, run as soon as an event input changes
+EVENT_RULES = ('read', 'read_bool')
+
+# Rules driving a pin from their inputs alone, which only need to run again
+# when a rule value their conditions reference changed
+ACTUATOR_RULES = ('toggle',)
+
+# Rules passed the rule values their `layout` fields reference
+DISPLAY_RULES = ('display',)
+
 
-    return get_service_response(url, auth_header)
+# Non-blocking versions of the rules used by the async runtime
+ASYNC_RULES = {
+    'service': service_async,
+}
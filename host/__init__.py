@@ -0,0 +1,60 @@
+"""
+CPython host runtime for the embedded firmware.
+
+`install()` puts stand-ins for the MicroPython modules (`machine`, `network`,
+`ntptime`, `webrepl`, `upip`, `umqtt.simple`, ...) and the firmware in
+`embedded/` on the import path, and points the `time` module at a simulated
+clock.
+"""
+import os
+import sys
+
+from host import clock as _clock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBEDDED = os.path.join(ROOT, 'embedded')
+MODULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modules')
+
+# Modules loaded from embedded/ and host/modules/, dropped by `reload`
+FIRMWARE_MODULES = (
+    'main', 'rules', 'httpclient', 'outbox', 'events', 'drivers',
+    'drivers.bmp180', 'drivers.oled',
+)
+STAND_IN_MODULES = (
+    'machine', 'network', 'ntptime', 'webrepl', 'upip', 'umqtt',
+    'umqtt.simple', 'micropython', 'ustruct', 'dht', 'framebuf',
+)
+
+
+def install(clock=None, platform='esp32'):
+    """
+    Make the firmware importable on the host. Returns the simulated clock.
+    """
+    # Import the host's own dependencies before the platform changes
+    import asyncio  # noqa: F401
+    import http.server  # noqa: F401
+    import json  # noqa: F401
+    import socket  # noqa: F401
+    import tracemalloc  # noqa: F401
+
+    for path in (EMBEDDED, MODULES):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    if clock is None:
+        clock = _clock.Clock()
+    _clock.install(clock)
+
+    # main.get_i2c_pins picks the pins by platform
+    sys.platform = platform
+
+    return clock
+
+
+def reload():
+    """
+    Drop the firmware and stand-in modules so the next import starts from a
+    freshly booted device.
+    """
+    for name in FIRMWARE_MODULES + STAND_IN_MODULES:
+        sys.modules.pop(name, None)
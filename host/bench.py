@@ -0,0 +1,980 @@
+"""
+Cycle benchmarks for `main.run()` on the host runtime.
+
+Each scenario boots a simulated device with a representative config, runs
+the real rule loop for a number of cycles and reports per cycle:
+
+- wall: host milliseconds spent in the cycle
+- device: simulated seconds the cycle keeps the device busy (sampling
+  delays, I2C transfers, ...), excluding the `process_interval` sleep
+- alloc: peak KiB allocated during the cycle (separate traced pass)
+- publishes, bytes: MQTT messages and bytes published
+- http: requests served by the iotserver stand-in
+- i2c: I2C transactions
+- gpio: writes to output pins
+
+Usage: python -m host.bench [scenario ...] [--cycles N] [--save FILE]
+       [--compare FILE] [--tolerance PERCENT] [--legacy] [--http]
+       [--display] [--bmp180]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import host
+from host import broker as broker_module
+from host import devices
+from host.iotserver import IotServer
+
+DEVICE_ID = 'b6d49b8d-c31f-4809-a955-a814de6ab3f3'
+MQTT_HOST = 'broker.local'
+
+# Metrics compared by --compare, wall times are only gated with --gate-wall
+GATED_METRICS = (
+    'device_s', 'alloc_kib', 'publishes', 'bytes', 'http', 'i2c', 'gpio'
+)
+METRICS = ('wall_ms',) + GATED_METRICS
+
+
+class StopBenchmark(BaseException):
+    pass
+
+
+def base_config(pins, level='warning'):
+    return {
+        'wifi': {'essid': 'bench', 'password': 'bench', 'retry_count': 10},
+        'mqtt': {
+            'client_id': '{identifier}',
+            'host': MQTT_HOST,
+            'lastwill': {
+                'topic': 'iot-devices/{identifier}/logs',
+                'message': 'Device disconnected from MQTT'
+            },
+        },
+        'logging': {'level': level},
+        'main': {
+            'identifier': DEVICE_ID,
+            'process_interval': 15,
+            'webrepl_password': 'bench',
+        },
+        'time': {'server': 'pool.ntp.org'},
+        'health': {'url': '{server}/health/{identifier}/'},
+        'pins': pins,
+    }
+
+
+def pin(identifier, action, pin_number=None, read=True, analog=False,
+        i2c=False, **inputs):
+    return {
+        'pin_number': pin_number,
+        'name': identifier.replace('_', ' ').title(),
+        'identifier': identifier,
+        'analog': analog,
+        'read': read,
+        'i2c': i2c,
+        'rule': {'action': action, 'input': inputs},
+    }
+
+
+def condition(operator, value):
+    return {'operator': operator, 'value': value}
+
+
+def example_pins(cache_ttl=None):
+    service_input = {'auth_header': 'Authorization: Token bench'}
+    if cache_ttl:
+        service_input['cache_ttl'] = cache_ttl
+    return [
+        pin(
+            'day_timer', 'timer',
+            gmt_start_time='07:00', gmt_end_time='15:00'
+        ),
+        pin(
+            'soil_moisture_sensor', 'read_bool_sample', 5,
+            reverse=True, sample_size=5
+        ),
+        pin(
+            'weather_service_forecast', 'service',
+            url='{server}/api/devices/locations/1/weather/?type=forecast',
+            **service_input
+        ),
+        pin(
+            'weather_service_current', 'service',
+            url='{server}/api/devices/locations/1/weather/?type=current',
+            **service_input
+        ),
+        pin(
+            'mqtt_toggle', 'mqtt_toggle',
+            topic='iot-devices/{identifier}/toggle'.format(
+                identifier=DEVICE_ID
+            )
+        ),
+        pin(
+            'solenoid_relay', 'toggle', 4, read=False,
+            on={
+                'conditions': {
+                    'must': {
+                        'soil_moisture_sensor': condition('eq', True),
+                        'day_timer': condition('eq', True),
+                        'weather_service_forecast.0.rain': condition(
+                            'eq', False
+                        ),
+                        'weather_service_forecast.1.rain': condition(
+                            'eq', False
+                        ),
+                        'weather_service_current.temperature': condition(
+                            'gt', 10
+                        ),
+                        'weather_service_current.rain': condition(
+                            'eq', False
+                        ),
+                    },
+                    'should': {
+                        'mqtt_toggle': condition('eq', True),
+                    },
+                }
+            }
+        ),
+    ]
+
+
+def digital_pins():
+    pins = [
+        pin('input_{index}'.format(index=index), 'read_bool', 12 + index)
+        for index in range(8)
+    ]
+    pins += [
+        pin(
+            'relay_{index}'.format(index=index), 'toggle', 4 + index,
+            read=False,
+            on={
+                'conditions': {
+                    'must': {
+                        'input_{index}'.format(index=index): condition(
+                            'eq', True
+                        ),
+                        'input_{index}'.format(index=index + 4): condition(
+                            'eq', False
+                        ),
+                    }
+                }
+            }
+        )
+        for index in range(4)
+    ]
+    return pins
+
+
+def sampled_pins():
+    return [
+        pin(
+            'sensor_{index}'.format(index=index), action, 12 + index,
+            analog=analog, sample_size=5
+        )
+        for index, (action, analog) in enumerate((
+            ('read_avg_sample', False),
+            ('read_bool_sample', False),
+            ('read_analog_avg_sample', True),
+            ('read_analog_max_sample', True),
+            ('read_analog_bool_sample', True),
+        ))
+    ]
+
+
+def bmp180_pins():
+    return [pin('barometer', 'read_bmp180', i2c=True, oversample=2)]
+
+
+def display_pins():
+    layout = [
+        {'value': 'barometer.temperature', 'label': 'Temp', 'x': 0, 'y': 0,
+         'format': '{:.1f}C', 'width': 7},
+        {'value': 'barometer.pressure', 'label': 'hPa', 'x': 0, 'y': 16,
+         'format': '{:.0f}'},
+        {'value': 'input_0', 'label': 'In', 'x': 0, 'y': 32},
+    ]
+    return bmp180_pins() + [
+        pin('input_0', 'read_bool', 12),
+        pin('dashboard', 'display', read=False, i2c=True, layout=layout),
+    ]
+
+
+# Scenario name to (pins, logging level)
+SCENARIOS = {
+    'example': (example_pins, 'warning'),
+    'example-debug': (example_pins, 'debug'),
+    'example-cached': (lambda: example_pins(cache_ttl=3600), 'warning'),
+    'digital': (digital_pins, 'warning'),
+    'sampled': (sampled_pins, 'warning'),
+    'bmp180': (bmp180_pins, 'warning'),
+    'display': (display_pins, 'warning'),
+}
+
+
+def format_config(value, server):
+    """
+    Fill the iotserver url into the config strings.
+    """
+    if isinstance(value, dict):
+        return dict(
+            (key, format_config(item, server)) for key, item in value.items()
+        )
+    if isinstance(value, list):
+        return [format_config(item, server) for item in value]
+    if isinstance(value, str) and '{server}' in value:
+        return value.replace('{server}', server)
+    return value
+
+
+def boot(config, server):
+    """
+    Boot a simulated device with the config. Returns the imported main
+    module and its mqtt client.
+    """
+    host.reload()
+    clock = host.install()
+
+    import machine
+    import ntptime
+
+    broker_module.BROKERS.clear()
+    machine.INPUTS.clear()
+    machine.ANALOG.clear()
+    machine.OUTPUTS.clear()
+    machine.I2C_DEVICES.clear()
+    for pin_number in range(12, 24):
+        machine.INPUTS[pin_number] = pin_number % 2
+        machine.ANALOG[pin_number] = 1024 * (pin_number % 4)
+    devices.attach(machine.I2C_DEVICES, devices.BMP180Model())
+    devices.attach(machine.I2C_DEVICES, devices.SSD1306Model())
+    ntptime.OFFLINE = False
+
+    with open('config/config.json', 'w') as config_file:
+        config_file.write(json.dumps(format_config(config, server.url)))
+
+    import main
+
+    main.CONFIG = main.load_config()
+    main.DEVICE_ID = main.CONFIG['main']['identifier']
+    mqtt = main.init_mqtt(main.CONFIG['mqtt'])
+    main.set_time(mqtt, main.CONFIG['time'])
+
+    return clock, main, mqtt
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def run_pass(config, cycles, trace_allocations, legacy=False):
+    """
+    Run the rule loop for the number of cycles, returning the per cycle
+    measurements. `legacy` runs `legacy_run` instead of `main.run()`.
+    """
+    server = IotServer().start()
+    workdir = tempfile.mkdtemp(prefix='iotdevice-bench-')
+    cwd = os.getcwd()
+    os.makedirs(os.path.join(workdir, 'config'))
+    os.chdir(workdir)
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            clock, main, mqtt = boot(config, server)
+
+        import machine
+        broker = broker_module.get_broker(MQTT_HOST)
+        broker.reset_stats()
+
+        process_interval = main.CONFIG['main']['process_interval']
+        samples = []
+        state = {}
+
+        def counters():
+            return {
+                'publishes': broker.published,
+                'bytes': broker.published_bytes,
+                'http': server.stats()['requests'],
+                'i2c': machine.I2C_STATS['transactions'],
+                'gpio': sum(machine.OUTPUT_WRITES.values()),
+            }
+
+        def start_cycle():
+            state['counters'] = counters()
+            state['device'] = clock.now
+            if trace_allocations:
+                tracemalloc.reset_peak()
+                state['memory'] = tracemalloc.get_traced_memory()[0]
+            state['wall'] = time.perf_counter()
+
+        def on_sleep(seconds):
+            if seconds != process_interval:
+                return
+
+            wall = time.perf_counter() - state['wall']
+            sample = {
+                'wall_ms': wall * 1000,
+                'device_s': clock.now - state['device'],
+            }
+            if trace_allocations:
+                peak = tracemalloc.get_traced_memory()[1]
+                sample['alloc_kib'] = (peak - state['memory']) / 1024
+            current = counters()
+            for key, value in current.items():
+                sample[key] = value - state['counters'][key]
+            samples.append(sample)
+
+            if len(samples) >= cycles:
+                raise StopBenchmark()
+
+            # The config check after the sleep counts towards the next cycle
+            start_cycle()
+            state['device'] += seconds
+
+        clock.on_sleep = on_sleep
+        if trace_allocations:
+            tracemalloc.start()
+        start_cycle()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                if legacy:
+                    legacy_run(main, mqtt, main.CONFIG['pins'])
+                else:
+                    main.run(mqtt, main.CONFIG['pins'])
+        except StopBenchmark:
+            pass
+        finally:
+            clock.on_sleep = None
+            if trace_allocations:
+                tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+        server.stop()
+
+    return samples
+
+
+def summarise(samples):
+    """
+    Average the samples, leaving out the first cycle which includes the
+    startup work.
+    """
+    steady = samples[1:] or samples
+    summary = {}
+    for key in steady[0]:
+        summary[key] = sum(sample[key] for sample in steady) / len(steady)
+    summary['wall_p95_ms'] = percentile(
+        [sample['wall_ms'] for sample in steady], 95
+    )
+    summary['first_wall_ms'] = samples[0]['wall_ms']
+    return summary
+
+
+def run_scenario(name, cycles=20, legacy=False):
+    pins, level = SCENARIOS[name]
+    config = base_config(pins(), level)
+
+    summary = summarise(
+        run_pass(config, cycles, trace_allocations=False, legacy=legacy)
+    )
+    traced = summarise(
+        run_pass(config, cycles, trace_allocations=True, legacy=legacy)
+    )
+    summary['alloc_kib'] = traced['alloc_kib']
+    return summary
+
+
+def legacy_find_xpath_value(response, xpaths):
+    xpath = xpaths.pop()  # paths must be reversed before passing it in
+
+    try:
+        response = response[int(xpath)]
+    except ValueError:
+        response = response[xpath]
+    except (KeyError, IndexError):
+        return None
+
+    if not len(xpaths):
+        return response
+
+    return legacy_find_xpath_value(response, xpaths)
+
+
+def legacy_evaluate_condition(input, operator, value):
+    try:
+        if operator == 'eq':
+            return input == value
+        elif operator == 'gt':
+            return input > value
+        elif operator == 'lt':
+            return input < value
+    except TypeError:
+        return False
+
+
+def legacy_handle_conditions(rule_values, input_value):
+    condition_values = {'must': [], 'should': []}
+    for condition_type, conditions in input_value['conditions'].items():
+        if condition_type in condition_values:
+            for pin_identifier, condition in conditions.items():
+                xpaths = pin_identifier.split('.')
+                xpaths.reverse()
+                condition_values[condition_type].append(
+                    legacy_evaluate_condition(
+                        legacy_find_xpath_value(rule_values, xpaths),
+                        **condition
+                    )
+                )
+
+    return condition_values
+
+
+def legacy_run(main, mqtt, pin_config):
+    """
+    The rule loop of `main.run()` before the compiled plan, kept as the
+    baseline for `bench_loop`. Every cycle it looks up the actions, rebuilds
+    the params, splits the condition xpaths, formats the debug messages and
+    parses the config file. The rules, status and logs are today's, so only
+    the interpretation of the config differs from `main.run()`.
+    """
+    import rules
+
+    pins = main.create_pins(pin_config)
+
+    run_count = 0
+    while True:
+
+        main.health_check(mqtt)
+
+        for pin in pin_config:
+            rule = pin['rule']
+            action = getattr(rules, rule['action'])
+
+            rule_params = {}
+            for input_key, input_value in rule['input'].items():
+                if type(input_value) == dict and 'conditions' in input_value:
+                    condition_values = legacy_handle_conditions(
+                        main.RULE_VALUES,
+                        input_value
+                    )
+                    rule_params[input_key] = any([
+                        all(condition_values['must']),
+                        any(condition_values['should'])
+                    ])
+
+                else:
+                    rule_params[input_key] = input_value
+
+            if run_count % pin.get('interval', 1) == 0:
+                main.log_message(
+                    mqtt,
+                    'Running rule: {action} with input: {input}.'.format(
+                        action=rule['action'], input=str(rule_params)
+                    ),
+                    main.DEBUG
+                )
+
+                rule_params['mqtt'] = mqtt
+                rule_params['config'] = main.CONFIG
+
+                main.RULE_VALUES[pin['identifier']] = action(
+                    pins[pin['identifier']], rule, **rule_params
+                )
+
+                main.log_message(
+                    mqtt,
+                    'Completed rule: {action} with output: {output}.'.format(
+                        action=rule['action'],
+                        output=main.RULE_VALUES[pin['identifier']]
+                    ),
+                    main.DEBUG
+                )
+            else:
+                main.log_message(
+                    mqtt,
+                    'Skipping rule: {action} with input: {input}.'.format(
+                        action=rule['action'], input=str(rule_params)
+                    ),
+                    main.DEBUG
+                )
+
+        main.log_status(mqtt)
+        main.flush_logs(mqtt)
+        main.save_outbox()
+
+        time.sleep(main.CONFIG['main']['process_interval'])
+
+        with open(main.CONFIG_PATH) as config_file:
+            if main.CONFIG != json.loads(config_file.read()):
+                main.reset()
+
+        run_count += 1
+
+
+# Scenarios compared by bench_loop, the legacy loop only knows the `must`
+# and `should` conditions and the original rules
+LOOP_SCENARIOS = ('example', 'example-debug', 'digital', 'sampled')
+
+
+def bench_loop(cycles=20):
+    """
+    Compare the wall time and peak allocations per cycle of the legacy loop
+    and the compiled plan of `main.run()`.
+    """
+    results = {}
+    for name in LOOP_SCENARIOS:
+        results[name] = {
+            'legacy': run_scenario(name, cycles, legacy=True),
+            'plan': run_scenario(name, cycles),
+        }
+    return results
+
+
+def format_loop_results(results):
+    lines = ['{:<16} {:<8} {:>9} {:>9} {:>9}'.format(
+        'scenario', 'loop', 'wall ms', 'p95 ms', 'alloc KiB'
+    )]
+    for name, loops in results.items():
+        for loop, summary in loops.items():
+            lines.append('{:<16} {:<8} {:>9.2f} {:>9.2f} {:>9.1f}'.format(
+                name if loop == 'legacy' else '', loop, summary['wall_ms'],
+                summary['wall_p95_ms'], summary['alloc_kib']
+            ))
+    return '\n'.join(lines)
+
+
+def legacy_get(url):
+    """
+    The response reader `rules.get_service_response` used before the
+    bounded httpclient reader, kept as the baseline for `bench_http`.
+    """
+    response_body = ''
+
+    _, _, hostname, path = url.split('/', 3)
+    hostname, port = hostname.split(':', 1)
+    address = socket.getaddrinfo(hostname, int(port))[0][-1]
+    request = 'GET /{path} HTTP/1.0\r\nHost: {host}\r\n\r\n'.format(
+        path=path, host=hostname
+    )
+
+    _socket = socket.socket()
+    _socket.settimeout(15.0)
+    _socket.connect(address)
+    _socket.send(bytes(request, 'utf8'))
+    while True:
+        data = _socket.recv(100)
+        if data:
+            response_body += str(data, 'utf8')
+        else:
+            break
+    _socket.close()
+
+    return response_body.split()
+
+
+def bench_http(requests=20, forecast_days=40):
+    """
+    Compare the wall time and peak bytes allocated per weather response of
+    the legacy reader and httpclient.
+    """
+    host.install()
+    import httpclient
+
+    server = IotServer(forecast_days=forecast_days).start()
+    url = server.url + '/api/devices/locations/1/weather/?type=forecast'
+
+    results = {}
+    try:
+        for name, get in (
+            ('legacy', legacy_get),
+            ('httpclient', lambda url: httpclient.get(url, max_size=16384)),
+        ):
+            get(url)
+            walls = []
+            peaks = []
+            for _ in range(requests):
+                tracemalloc.start()
+                start = time.perf_counter()
+                get(url)
+                walls.append((time.perf_counter() - start) * 1000)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            results[name] = {
+                'wall_ms': sum(walls) / len(walls),
+                'alloc_kib': sum(peaks) / len(peaks) / 1024,
+            }
+        stats = server.stats()
+        results['body_kib'] = stats['bytes_sent'] / stats['requests'] / 1024
+    finally:
+        server.stop()
+        for connection in list(httpclient.CONNECTIONS.values()):
+            connection.close()
+        httpclient.CONNECTIONS.clear()
+
+    return results
+
+
+def legacy_oled(i2c):
+    """
+    An Oled sending every command as its own transfer and the whole
+    framebuffer on every `show()`, like the driver before dirty pages. Kept
+    as the baseline for `bench_display`.
+    """
+    from drivers import oled
+
+    class LegacyOled(oled.OledI2C):
+
+        def write_cmds(self, cmds):
+            for cmd in cmds:
+                self.write_cmd(cmd)
+
+        def show(self, full=False):
+            for cmd in (
+                oled.SET_COL_ADDR, 0, self.width - 1,
+                oled.SET_PAGE_ADDR, 0, self.pages - 1
+            ):
+                self.write_cmd(cmd)
+            self.write_data([self.buffer])
+
+    return LegacyOled(128, 64, i2c)
+
+
+# Display updates of bench_display by name
+DISPLAY_UPDATES = {
+    'line': lambda display, index: (
+        display.fill_rect(0, 24, 128, 8, 0),
+        display.text('Count {:>10}'.format(index), 0, 24),
+    ),
+    'field': lambda display, index: (
+        display.fill_rect(80, 8, 40, 8, 0),
+        display.text('{:>5}'.format(index % 100000), 80, 8),
+    ),
+    'screen': lambda display, index: [display.fill(0)] + [
+        display.text('Line {} {:>8}'.format(row, index), 0, row * 8)
+        for row in range(8)
+    ],
+}
+
+
+def bench_display(refreshes=10):
+    """
+    Compare the I2C transfers of the legacy and the dirty page Oled on a
+    100 kHz bus: the init, and per refresh after a display update. The
+    display RAM of an SSD1306 model is checked against the framebuffer
+    after every refresh.
+    """
+    clock = host.install()
+    import machine
+    from drivers import oled
+
+    results = {}
+    try:
+        for name, make in (
+            ('legacy', legacy_oled),
+            ('oled', lambda i2c: oled.OledI2C(128, 64, i2c)),
+        ):
+            machine.I2C_DEVICES.clear()
+            model = devices.attach(
+                machine.I2C_DEVICES, devices.SSD1306Model()
+            )
+            i2c = machine.SoftI2C(freq=100_000)
+
+            def transfers(run):
+                stats = (i2c.transactions, i2c.bytes_written, clock.now)
+                run()
+                return {
+                    'transactions': i2c.transactions - stats[0],
+                    'bytes': i2c.bytes_written - stats[1],
+                    'bus_ms': (clock.now - stats[2]) * 1000,
+                }
+
+            displays = []
+            results[name] = {
+                'init': transfers(lambda: displays.append(make(i2c)))
+            }
+            display = displays[0]
+            matches = model.ram == display.buffer
+
+            for update_name, update in DISPLAY_UPDATES.items():
+                samples = []
+                for index in range(refreshes):
+                    update(display, index)
+                    samples.append(transfers(display.show))
+                    matches = matches and model.ram == display.buffer
+                results[name][update_name] = dict(
+                    (key, sum(sample[key] for sample in samples) / refreshes)
+                    for key in samples[0]
+                )
+            results[name]['matches'] = matches
+    finally:
+        host.reload()
+
+    return results
+
+
+def format_display_results(results):
+    lines = ['{:<16} {:<8} {:>12} {:>9} {:>9}'.format(
+        'display', 'refresh', 'transactions', 'bytes', 'bus ms'
+    )]
+    for name, result in results.items():
+        for refresh in ['init'] + list(DISPLAY_UPDATES):
+            lines.append('{:<16} {:<8} {:>12.1f} {:>9.0f} {:>9.2f}'.format(
+                name if refresh == 'init' else '', refresh,
+                result[refresh]['transactions'], result[refresh]['bytes'],
+                result[refresh]['bus_ms']
+            ))
+        if not result['matches']:
+            lines.append(
+                '{:<16} display RAM differs from the framebuffer'.format('')
+            )
+    return '\n'.join(lines)
+
+
+def legacy_bmp180(i2c, oversample=2):
+    """
+    Returns a reader taking a `read_bmp180` reading like the driver before
+    it was cached: a new driver per reading, which reads the calibration a
+    register at a time and warms up a generator refreshing the raw readings
+    for 128 ms, then steps it again for the temperature, pressure and
+    altitude. Only its I2C transfers and sleeps are kept, as the baseline
+    for `bench_bmp180`.
+    """
+    address = devices.BMP180Model.ADDRESS
+    delays = (5, 8, 14, 25)
+
+    # The oversample setting the generator converts at
+    settings = [3]
+
+    def gauge():
+        while True:
+            i2c.writeto_mem(address, 0xF4, bytearray([0x2E]))
+            start = time.ticks_ms()
+            while time.ticks_ms() - start <= 5:
+                yield None
+            i2c.readfrom_mem(address, 0xF6, 2)
+
+            # The warm-up runs at the default setting, the rule sets its
+            # own afterwards
+            oversample_setting = settings[0]
+            i2c.writeto_mem(
+                address, 0xF4, bytearray([0x34 + (oversample_setting << 6)])
+            )
+            start = time.ticks_ms()
+            while time.ticks_ms() - start <= delays[oversample_setting]:
+                yield None
+            for register in (0xF6, 0xF7, 0xF8):
+                i2c.readfrom_mem(address, register, 1)
+            yield True
+
+    def read():
+        settings[0] = 3
+        i2c.start()
+        i2c.readfrom_mem(address, 0xD0, 2)
+        for register in range(0xAA, 0xC0, 2):
+            i2c.readfrom_mem(address, register, 2)
+
+        steps = gauge()
+        for _ in range(128):
+            next(steps)
+            time.sleep_ms(1)
+        settings[0] = oversample
+
+        # temperature(), then pressure() and altitude() which each step it
+        # through absolute_pressure() and temperature()
+        for _ in range(1 + 4 + 2):
+            next(steps)
+
+    return read
+
+
+def bench_bmp180(readings=10):
+    """
+    Compare the I2C transfers and the busy time of the legacy and the cached
+    BMP180 reading on a 100 kHz bus: the first reading, which sets up the
+    driver, and the readings after it.
+    """
+    clock = host.install()
+    import machine
+    import rules
+
+    results = {}
+    try:
+        for name, make in (
+            ('legacy', legacy_bmp180),
+            ('bmp180', lambda i2c: lambda: rules.read_bmp180(
+                i2c, None, oversample=2
+            )),
+        ):
+            machine.I2C_DEVICES.clear()
+            devices.attach(machine.I2C_DEVICES, devices.BMP180Model())
+            rules.BMP180_SENSORS.clear()
+            i2c = machine.SoftI2C(freq=100_000)
+            read = make(i2c)
+
+            def transfers():
+                stats = (i2c.transactions, i2c.bytes_written, clock.now)
+                read()
+                return {
+                    'transactions': i2c.transactions - stats[0],
+                    'bytes': i2c.bytes_written - stats[1],
+                    'device_ms': (clock.now - stats[2]) * 1000,
+                }
+
+            results[name] = {'first': transfers()}
+            samples = [transfers() for _ in range(readings)]
+            results[name]['reading'] = dict(
+                (key, sum(sample[key] for sample in samples) / readings)
+                for key in samples[0]
+            )
+    finally:
+        host.reload()
+
+    return results
+
+
+def format_bmp180_results(results):
+    lines = ['{:<16} {:<8} {:>12} {:>9} {:>9}'.format(
+        'bmp180', 'reading', 'transactions', 'bytes', 'device ms'
+    )]
+    for name, result in results.items():
+        for reading in ('first', 'reading'):
+            lines.append('{:<16} {:<8} {:>12.1f} {:>9.0f} {:>9.2f}'.format(
+                name if reading == 'first' else '',
+                'first' if reading == 'first' else 'next',
+                result[reading]['transactions'], result[reading]['bytes'],
+                result[reading]['device_ms']
+            ))
+    return '\n'.join(lines)
+
+
+def format_results(results):
+    lines = [
+        '{:<16} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6} {:>6} '
+        '{:>6}'.format(
+            'scenario', 'wall ms', 'p95 ms', 'device s', 'alloc KiB',
+            'publishes', 'bytes', 'http', 'i2c', 'gpio'
+        )
+    ]
+    for name, summary in results.items():
+        lines.append(
+            '{:<16} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>9.1f} {:>9.0f} '
+            '{:>6.1f} {:>6.1f} {:>6.1f}'.format(
+                name,
+                summary['wall_ms'],
+                summary['wall_p95_ms'],
+                summary['device_s'],
+                summary['alloc_kib'],
+                summary['publishes'],
+                summary['bytes'],
+                summary['http'],
+                summary['i2c'],
+                summary['gpio'],
+            )
+        )
+    return '\n'.join(lines)
+
+
+def compare(results, baseline, tolerance, metrics=GATED_METRICS):
+    """
+    Returns the regressions of the results against the baseline, metrics
+    which grew by more than `tolerance` percent.
+    """
+    regressions = []
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        for metric in metrics:
+            before = baseline[name].get(metric)
+            after = summary.get(metric)
+            if before is None or after is None:
+                continue
+            if after > before * (1 + tolerance / 100) + 1e-9:
+                regressions.append(
+                    '{name} {metric}: {before:.2f} -> {after:.2f}'.format(
+                        name=name, metric=metric, before=before, after=after
+                    )
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        'scenarios', nargs='*', help=', '.join(SCENARIOS), metavar='scenario'
+    )
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument(
+        '--legacy', action='store_true', help='Run bench_loop'
+    )
+    parser.add_argument('--http', action='store_true', help='Run bench_http')
+    parser.add_argument(
+        '--display', action='store_true', help='Run bench_display'
+    )
+    parser.add_argument(
+        '--bmp180', action='store_true', help='Run bench_bmp180'
+    )
+    parser.add_argument('--save', help='Write the results as json')
+    parser.add_argument('--compare', help='Baseline results to gate against')
+    parser.add_argument('--tolerance', type=float, default=10.0)
+    parser.add_argument('--gate-wall', action='store_true')
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {name}'.format(name=name))
+
+    results = {}
+    for name in args.scenarios or list(SCENARIOS):
+        results[name] = run_scenario(name, args.cycles)
+    print(format_results(results))
+
+    if args.legacy:
+        print()
+        print(format_loop_results(bench_loop(args.cycles)))
+
+    if args.http:
+        http_results = bench_http()
+        print()
+        print('response body {:.1f} KiB'.format(http_results['body_kib']))
+        for name in ('legacy', 'httpclient'):
+            print('{:<16} {:>9.2f} ms {:>9.1f} KiB allocated'.format(
+                name,
+                http_results[name]['wall_ms'],
+                http_results[name]['alloc_kib']
+            ))
+
+    if args.display:
+        print()
+        print(format_display_results(bench_display()))
+
+    if args.bmp180:
+        print()
+        print(format_bmp180_results(bench_bmp180()))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            results_file.write(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.loads(baseline_file.read())
+        metrics = METRICS if args.gate_wall else GATED_METRICS
+        regressions = compare(results, baseline, args.tolerance, metrics)
+        if regressions:
+            print('\nRegressions:')
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
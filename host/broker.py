@@ -0,0 +1,111 @@
+class Broker(object):
+    """
+    In-process stand-in for an MQTT broker. Clients created by the `umqtt`
+    stand-in connect to the broker registered for their server host.
+    """
+
+    def __init__(self):
+        self.online = True
+        self.clients = {}
+        self.subscriptions = {}
+        self.wildcards = set()
+        self.retained = {}
+        self.observers = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.connects = 0
+        self.published = 0
+        self.published_bytes = 0
+        self.subscribes = 0
+        self.delivered = 0
+        self.topics = {}
+
+    def connect(self, client):
+        if not self.online:
+            raise OSError('Broker offline.')
+        self.connects += 1
+        previous = self.clients.get(client.client_id)
+        if previous is not None and previous is not client:
+            self.disconnect(previous, graceful=False)
+        self.clients[client.client_id] = client
+
+    def disconnect(self, client, graceful=True):
+        if self.clients.get(client.client_id) is client:
+            del self.clients[client.client_id]
+        for subscribers in self.subscriptions.values():
+            subscribers.discard(client)
+        if not graceful and client.lastwill:
+            self.publish(*client.lastwill)
+
+    def check(self, client):
+        if not self.online or self.clients.get(client.client_id) is not client:
+            raise OSError('Not connected.')
+
+    def publish(self, topic, msg, retain=False):
+        self.published += 1
+        self.published_bytes += len(topic) + len(msg)
+        self.topics[topic] = self.topics.get(topic, 0) + 1
+
+        if retain:
+            if msg:
+                self.retained[topic] = msg
+            else:
+                self.retained.pop(topic, None)
+
+        for observer in self.observers:
+            observer(topic, msg)
+
+        # Exact subscriptions are looked up directly, only the wildcard
+        # patterns are matched against the topic
+        self.deliver(self.subscriptions.get(topic, ()), topic, msg)
+        for pattern in self.wildcards:
+            if pattern != topic and topic_matches(pattern, topic):
+                self.deliver(self.subscriptions[pattern], topic, msg)
+
+    def deliver(self, subscribers, topic, msg):
+        for subscriber in subscribers:
+            subscriber.pending.append((topic, msg))
+            self.delivered += 1
+
+    def subscribe(self, client, pattern):
+        self.subscribes += 1
+        self.subscriptions.setdefault(pattern, set()).add(client)
+        if b'+' in pattern or b'#' in pattern:
+            self.wildcards.add(pattern)
+        for topic, msg in self.retained.items():
+            if topic_matches(pattern, topic):
+                client.pending.append((topic, msg))
+                self.delivered += 1
+
+
+def topic_matches(pattern, topic):
+    """
+    Match a topic against a subscription pattern with `+` and `#` wildcards.
+    """
+    if pattern == topic:
+        return True
+
+    pattern_levels = pattern.split(b'/')
+    topic_levels = topic.split(b'/')
+    for index, level in enumerate(pattern_levels):
+        if level == b'#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != b'+' and level != topic_levels[index]:
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+BROKERS = {}
+
+
+def get_broker(host):
+    """
+    Returns the broker for the host, creating it on first use.
+    """
+    broker = BROKERS.get(host)
+    if broker is None:
+        broker = BROKERS[host] = Broker()
+    return broker
@@ -0,0 +1,153 @@
+import heapq
+import time as _time
+
+# Kept before the `time` module is patched
+_gmtime = _time.gmtime
+_monotonic = _time.monotonic
+_sleep = _time.sleep
+
+
+class Clock(object):
+    """
+    Simulated device clock. Sleeping advances the clock straight away, so a
+    `process_interval` sleep costs no wall time on the host. Callbacks set
+    with `call_at` run when the clock passes their time, at that time.
+    """
+
+    # MicroPython's epoch starts at 2000-01-01
+    EPOCH = 946684800
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+        self.slept = 0.0
+        self.on_sleep = None
+        self.timers = []
+        self.timer_count = 0
+
+    def call_at(self, when, callback):
+        # The count keeps callbacks due at the same time in order
+        self.timer_count += 1
+        heapq.heappush(self.timers, (when, self.timer_count, callback))
+
+    def run_until(self, when):
+        while self.timers and self.timers[0][0] <= when:
+            due, _, callback = heapq.heappop(self.timers)
+            self.now = max(self.now, due)
+            callback()
+        self.now = max(self.now, when)
+
+    def advance(self, seconds):
+        self.run_until(self.now + seconds)
+
+    def time(self):
+        return self.now
+
+    def time_ns(self):
+        return int(self.now * 1_000_000_000)
+
+    def sleep(self, seconds):
+        if self.on_sleep:
+            self.on_sleep(seconds)
+        self.slept += seconds
+        self.advance(seconds)
+
+    def sleep_ms(self, ms):
+        self.slept += ms / 1000
+        self.advance(ms / 1000)
+
+    def sleep_us(self, us):
+        self.slept += us / 1_000_000
+        self.advance(us / 1_000_000)
+
+    def ticks_ms(self):
+        return int(self.now * 1000)
+
+    def ticks_us(self):
+        return int(self.now * 1_000_000)
+
+    def ticks_cpu(self):
+        return self.ticks_us()
+
+    @staticmethod
+    def ticks_diff(ticks1, ticks2):
+        return ticks1 - ticks2
+
+    @staticmethod
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def localtime(self, secs=None):
+        if secs is None:
+            secs = self.now
+        return tuple(_gmtime(self.EPOCH + secs))[:8]
+
+    def gmtime(self, secs=None):
+        return self.localtime(secs)
+
+
+class WallClock(Clock):
+    """
+    Clock following the host's monotonic time, for runs on a real event
+    loop. Sleeping blocks for real.
+    """
+
+    def __init__(self, start=0.0):
+        self.started = _monotonic()
+        self.offset = 0.0
+        super().__init__(start)
+
+    @property
+    def now(self):
+        return _monotonic() - self.started + self.offset
+
+    @now.setter
+    def now(self, value):
+        self.offset = value - (_monotonic() - self.started)
+
+    def sleep(self, seconds):
+        if self.on_sleep:
+            self.on_sleep(seconds)
+        self.slept += seconds
+        _sleep(seconds)
+
+    def sleep_ms(self, ms):
+        self.sleep(ms / 1000)
+
+    def sleep_us(self, us):
+        self.sleep(us / 1_000_000)
+
+
+# Attributes of the `time` module replaced by the clock
+PATCHED = (
+    'time', 'time_ns', 'sleep', 'sleep_ms', 'sleep_us', 'ticks_ms',
+    'ticks_us', 'ticks_cpu', 'ticks_diff', 'ticks_add', 'localtime', 'gmtime'
+)
+
+CLOCK = None
+ORIGINALS = {}
+
+
+def install(clock):
+    """
+    Point the `time` module at the clock so the embedded code sees it.
+    """
+    global CLOCK
+
+    if CLOCK is None:
+        for name in PATCHED:
+            if hasattr(_time, name):
+                ORIGINALS[name] = getattr(_time, name)
+    for name in PATCHED:
+        setattr(_time, name, getattr(clock, name))
+    CLOCK = clock
+
+
+def uninstall():
+    global CLOCK
+
+    for name in PATCHED:
+        if name in ORIGINALS:
+            setattr(_time, name, ORIGINALS[name])
+        elif hasattr(_time, name):
+            delattr(_time, name)
+    CLOCK = None
@@ -0,0 +1,223 @@
+"""
+BMP180 compensation check for the integer arithmetic in `drivers.bmp180`.
+
+Compares `BMP180.compensate()` with the float compensation the driver used
+before, kept here as the reference. The datasheet's worked example and a
+number of random calibrations, in ranges covering the calibration of real
+parts, are swept over the full raw temperature and pressure range at every
+oversample setting. Raw readings the float path puts outside the sensor's
+operating range (-40 to 85 C, 300 to 1100 hPa) are skipped. Reports per
+oversample setting:
+
+- compared: raw readings compared
+- temperature: largest difference in degrees C
+- pressure: largest difference in pascal
+
+The integer results truncate like the datasheet's, so they differ from the
+float ones by up to about 0.2 C and 30 Pa, well inside the sensor's 1 C and
+100 Pa absolute accuracy. The run fails when the worked example doesn't give
+the datasheet's 15.0 C and 69964 Pa, or a difference is over the tolerance.
+
+Usage: python -m host.compensation [--calibrations N] [--steps N]
+       [--seed N] [--temperature-tolerance C] [--pressure-tolerance PA]
+       [--save FILE]
+"""
+import argparse
+import json
+import random
+import sys
+
+import host
+from host import devices
+
+# Calibration coefficients and their ranges
+CALIBRATION_RANGES = (
+    ('AC1', 200, 10000),
+    ('AC2', -1500, 0),
+    ('AC3', -15500, -13000),
+    ('AC4', 30000, 35000),
+    ('AC5', 20000, 33000),
+    ('AC6', 14000, 24000),
+    ('B1', 5000, 7000),
+    ('B2', 0, 100),
+    ('MB', -32768, -32768),
+    ('MC', -12000, -8000),
+    ('MD', 2000, 3500),
+)
+
+# Operating range of the sensor
+TEMPERATURE_RANGE = (-40.0, 85.0)
+PRESSURE_RANGE = (30000.0, 110000.0)
+
+
+def float_compensate(calibration, oversample, UT, UP):
+    """
+    The float compensation of the driver before the integer arithmetic,
+    returns the temperature in degrees C and the pressure in pascal.
+    """
+    AC1, AC2, AC3, AC4, AC5, AC6, B1, B2, _, MC, MD = calibration
+
+    X1 = (UT - AC6) * (AC5 / (2 ** 15))
+    X2 = (MC * (2 ** 11)) / (X1 + MD)
+    B5 = X1 + X2
+    temperature = ((B5 + 8) / (2 ** 4)) / 10
+
+    B6 = B5 - 4000
+    X1 = (B2 * ((B6 ** 2) / (2 ** 12))) / (2 ** 11)
+    X2 = (AC2 * B6) / (2 ** 11)
+    X3 = X1 + X2
+    B3 = ((int((AC1 * 4 + X3)) << oversample) + 2) / 4
+    X1 = (AC3 * B6) / (2 ** 13)
+    X2 = (B1 * (B6 ** 2 / 2 ** 12)) / (2 ** 16)
+    X3 = ((X1 + X2) + 2) / (2 ** 2)
+    B4 = abs(AC4) * (X3 + 32768) / (2 ** 15)
+    B7 = (abs(UP) - B3) * (50000 >> oversample)
+
+    if B7 < 0x80000000:
+        pressure = (B7 * 2) / B4
+    else:
+        pressure = (B7 / B4) * 2
+
+    X1 = (pressure / (2 ** 8)) ** 2
+    X1 = (X1 * 3038) / (2 ** 16)
+    X2 = (-7357 * pressure) / (2 ** 16)
+
+    return temperature, pressure + (X1 + X2 + 3791) / (2 ** 4)
+
+
+def make_sensor(calibration):
+    """
+    Returns a driver reading the calibration from a register model.
+    """
+    import machine
+    from drivers.bmp180 import BMP180
+
+    machine.I2C_DEVICES.clear()
+    devices.attach(
+        machine.I2C_DEVICES, devices.BMP180Model(calibration=calibration)
+    )
+    return BMP180(machine.SoftI2C())
+
+
+def calibrations(count, seed):
+    """
+    Returns the datasheet's calibration followed by `count` random ones.
+    """
+    generator = random.Random(seed)
+    sets = [tuple(value for _, value in devices.BMP180Model.CALIBRATION)]
+    for _ in range(count):
+        sets.append(tuple(
+            generator.randint(low, high)
+            for _, low, high in CALIBRATION_RANGES
+        ))
+    return sets
+
+
+def sweep(raw_max, steps):
+    step = max(1, raw_max // steps)
+    return range(0, raw_max, step)
+
+
+def in_range(temperature, pressure):
+    return (
+        TEMPERATURE_RANGE[0] <= temperature <= TEMPERATURE_RANGE[1]
+        and PRESSURE_RANGE[0] <= pressure <= PRESSURE_RANGE[1]
+    )
+
+
+def run_compensation(args):
+    host.install()
+    try:
+        sensor = make_sensor(None)
+        sensor.oversample = 0
+        example = sensor.compensate(27898, 23843)
+
+        results = dict(
+            (oversample, {'compared': 0, 'temperature': 0.0, 'pressure': 0.0})
+            for oversample in range(4)
+        )
+        for calibration in calibrations(args.calibrations, args.seed):
+            sensor = make_sensor(calibration)
+            for oversample, result in results.items():
+                sensor.oversample = oversample
+                for UT in sweep(1 << 16, args.steps):
+                    for UP in sweep(1 << (16 + oversample), args.steps):
+                        try:
+                            expected = float_compensate(
+                                calibration, oversample, UT, UP
+                            )
+                        except ZeroDivisionError:
+                            continue
+                        if not in_range(*expected):
+                            continue
+
+                        temperature, pressure = sensor.compensate(UT, UP)
+                        result['compared'] += 1
+                        result['temperature'] = max(
+                            result['temperature'],
+                            abs(temperature / 10 - expected[0])
+                        )
+                        result['pressure'] = max(
+                            result['pressure'], abs(pressure - expected[1])
+                        )
+    finally:
+        host.reload()
+
+    failures = []
+    if example != (150, 69964):
+        failures.append('worked example gives {} != (150, 69964)'.format(
+            example
+        ))
+    for oversample, result in results.items():
+        if not result['compared']:
+            failures.append('oss {} compared nothing'.format(oversample))
+        if result['temperature'] > args.temperature_tolerance:
+            failures.append('oss {} temperature off'.format(oversample))
+        if result['pressure'] > args.pressure_tolerance:
+            failures.append('oss {} pressure off'.format(oversample))
+
+    return {
+        'example': list(example),
+        'oversample': results,
+        'failures': failures,
+    }
+
+
+def format_result(result):
+    lines = ['{:>4} {:>9} {:>13} {:>10}'.format(
+        'oss', 'compared', 'temperature', 'pressure'
+    )]
+    for oversample, sample in result['oversample'].items():
+        lines.append('{:>4} {:>9} {:>11.3f} C {:>7.2f} Pa'.format(
+            oversample, sample['compared'], sample['temperature'],
+            sample['pressure']
+        ))
+    lines.append('failures: {}'.format(', '.join(result['failures']) or '-'))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calibrations', type=int, default=20)
+    parser.add_argument(
+        '--steps', type=int, default=128,
+        help='Raw readings swept per input and oversample setting'
+    )
+    parser.add_argument('--seed', type=int, default=180)
+    parser.add_argument('--temperature-tolerance', type=float, default=0.2)
+    parser.add_argument('--pressure-tolerance', type=float, default=30.0)
+    parser.add_argument('--save', help='Write the results as json')
+    args = parser.parse_args(argv)
+
+    result = run_compensation(args)
+    print(format_result(result))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            results_file.write(json.dumps(result, indent=2))
+
+    return 1 if result['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
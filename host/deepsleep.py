@@ -0,0 +1,261 @@
+"""
+Deep sleep duty cycle harness for `main.mode: deepsleep`.
+
+Boots a simulated device for a number of wakes. Between wakes the firmware
+and stand-in modules are dropped, like a deep sleep resets the chip, and
+only the RTC memory and the clock carry over. Every wake runs `main.start()`
+until it calls `machine.deepsleep()` and reports:
+
+- awake: simulated seconds from boot to deep sleep
+- publishes, connects: MQTT messages published and connections opened
+- http: requests served by the iotserver stand-in
+- ntp: time syncs
+- rtc: bytes of state saved to RTC memory
+
+After every wake the saved state is restored into a fresh `main` module and
+compared with the values the wake ended with. The run fails when a round
+trip doesn't match or a wake after the first goes over a budget.
+
+Usage: python -m host.deepsleep [--wakes N] [--interval S]
+       [--sync-interval S] [--max-awake S] [--max-publishes N]
+       [--max-connects N] [--max-http N] [--max-ntp N] [--save FILE]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+import host
+from host import bench
+from host import broker as broker_module
+from host import devices
+from host.iotserver import IotServer
+
+
+class DeepSleepFailed(Exception):
+    pass
+
+
+def device_config(interval, sync_interval, health_interval):
+    pins = bench.example_pins()
+    for pin in pins:
+        # The weather changes slowly, fetch it every 4 wakes
+        if pin['rule']['action'] == 'service':
+            pin['interval'] = 4
+
+    config = bench.base_config(pins)
+    config['main'].update(mode='deepsleep', process_interval=interval)
+    config['time']['sync_interval'] = sync_interval
+    config['health']['interval'] = health_interval
+    return config
+
+
+def power_on(clock, rtc_memory, reset_cause):
+    """
+    Reload the firmware and stand-ins as after a reset, keeping the clock
+    and the RTC memory. Returns the fresh `machine` module.
+    """
+    host.reload()
+    host.install(clock)
+
+    import machine
+
+    machine.RTC_MEMORY[:] = rtc_memory
+    machine.RESET_CAUSE = reset_cause
+    for pin_number in range(12, 24):
+        machine.INPUTS[pin_number] = pin_number % 2
+    devices.attach(machine.I2C_DEVICES, devices.BMP180Model())
+    return machine
+
+
+def wake(clock, rtc_memory, reset_cause, broker, server):
+    """
+    Run one wake. Returns the measurements, the RTC memory and the state of
+    `main` when the device went to sleep.
+    """
+    machine = power_on(clock, rtc_memory, reset_cause)
+
+    import ntptime
+
+    start = clock.now
+    counters = (broker.published, broker.connects, server.stats()['requests'])
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import main
+            main.start()
+    except machine.DeepSleep as exc:
+        sleep_ms = exc.ms
+    except machine.DeviceReset:
+        raise DeepSleepFailed('the device reset instead of sleeping')
+    else:
+        raise DeepSleepFailed('main.start() returned without sleeping')
+
+    sample = {
+        'awake_s': clock.now - start,
+        'publishes': broker.published - counters[0],
+        'connects': broker.connects - counters[1],
+        'http': server.stats()['requests'] - counters[2],
+        'ntp': ntptime.SYNCS,
+        'rtc_bytes': len(machine.RTC_MEMORY),
+        'sleep_s': sleep_ms / 1000,
+    }
+    state = {
+        'values': json.loads(json.dumps(main.RULE_VALUES)),
+        'published': json.loads(json.dumps(main.PUBLISHED_STATUS)),
+        'snapshot_time': main.STATUS_SNAPSHOT_TIME,
+    }
+    return sample, bytes(machine.RTC_MEMORY), state
+
+
+def check_round_trip(clock, rtc_memory, state, run_count):
+    """
+    Restore the saved state into a fresh `main` module and returns the
+    differences with the state the wake ended with.
+    """
+    machine = power_on(clock, rtc_memory, None)
+    machine.RESET_CAUSE = machine.DEEPSLEEP_RESET
+
+    import main
+
+    restored_count, _ = main.restore_sleep_state()
+    errors = []
+    if restored_count != run_count:
+        errors.append('run count {restored} != {expected}'.format(
+            restored=restored_count, expected=run_count
+        ))
+    if json.loads(json.dumps(main.RULE_VALUES)) != state['values']:
+        errors.append('rule values differ')
+    if state['published'] == state['values']:
+        if main.PUBLISHED_STATUS != main.RULE_VALUES:
+            errors.append('published status not restored')
+        if int(main.STATUS_SNAPSHOT_TIME or 0) != int(
+            state['snapshot_time'] or 0
+        ):
+            errors.append('snapshot time differs')
+    return errors
+
+
+def over_budget(sample, args):
+    budgets = (
+        ('awake_s', args.max_awake),
+        ('publishes', args.max_publishes),
+        ('connects', args.max_connects),
+        ('http', args.max_http),
+        ('ntp', args.max_ntp),
+    )
+    return [
+        '{metric} {value:g} > {budget:g}'.format(
+            metric=metric, value=sample[metric], budget=budget
+        )
+        for metric, budget in budgets
+        if budget is not None and sample[metric] > budget
+    ]
+
+
+def run_wakes(args):
+    """
+    Run the wakes, returning a sample per wake with its failures.
+    """
+    server = IotServer().start()
+    workdir = tempfile.mkdtemp(prefix='iotdevice-deepsleep-')
+    cwd = os.getcwd()
+    os.makedirs(os.path.join(workdir, 'config'))
+    os.chdir(workdir)
+
+    samples = []
+    try:
+        config = bench.format_config(
+            device_config(
+                args.interval, args.sync_interval, args.health_interval
+            ),
+            server.url
+        )
+        with open('config/config.json', 'w') as config_file:
+            config_file.write(json.dumps(config))
+
+        broker_module.BROKERS.clear()
+        broker = broker_module.get_broker(bench.MQTT_HOST)
+        clock = host.install()
+
+        import machine
+        rtc_memory = b''
+        reset_cause = machine.PWRON_RESET
+
+        for index in range(args.wakes):
+            sample, rtc_memory, state = wake(
+                clock, rtc_memory, reset_cause, broker, server
+            )
+            sample['failures'] = check_round_trip(
+                clock, rtc_memory, state, index + 1
+            )
+            if index:
+                sample['failures'] += over_budget(sample, args)
+            samples.append(sample)
+
+            clock.advance(sample['sleep_s'])
+            reset_cause = machine.DEEPSLEEP_RESET
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        host.reload()
+
+    return samples
+
+
+def format_samples(samples):
+    lines = [
+        '{:>5} {:>9} {:>9} {:>8} {:>5} {:>4} {:>6}  {}'.format(
+            'wake', 'awake s', 'publishes', 'connects', 'http', 'ntp',
+            'rtc', 'failures'
+        )
+    ]
+    for index, sample in enumerate(samples):
+        lines.append(
+            '{:>5} {:>9.2f} {:>9} {:>8} {:>5} {:>4} {:>6}  {}'.format(
+                index,
+                sample['awake_s'],
+                sample['publishes'],
+                sample['connects'],
+                sample['http'],
+                sample['ntp'],
+                sample['rtc_bytes'],
+                ', '.join(sample['failures']) or '-'
+            )
+        )
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--wakes', type=int, default=12)
+    parser.add_argument(
+        '--interval', type=int, default=300,
+        help='process_interval of the device in seconds'
+    )
+    parser.add_argument('--sync-interval', type=int, default=3600)
+    parser.add_argument('--health-interval', type=int, default=3600)
+    parser.add_argument('--max-awake', type=float, default=5.0)
+    parser.add_argument('--max-publishes', type=int, default=8)
+    parser.add_argument('--max-connects', type=int, default=1)
+    parser.add_argument('--max-http', type=int, default=3)
+    parser.add_argument('--max-ntp', type=int, default=1)
+    parser.add_argument('--save', help='Write the samples as json')
+    args = parser.parse_args(argv)
+    if args.wakes < 1:
+        parser.error('--wakes must be at least 1')
+
+    samples = run_wakes(args)
+    print(format_samples(samples))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            results_file.write(json.dumps(samples, indent=2))
+
+    return 1 if any(sample['failures'] for sample in samples) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
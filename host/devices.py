@@ -0,0 +1,170 @@
+import struct
+
+
+class RegisterDevice(object):
+    """
+    I2C device model with 8-bit register addresses.
+    """
+
+    def __init__(self, size=256):
+        self.registers = bytearray(size)
+        self.pointer = 0
+
+    def write(self, data):
+        if data:
+            self.write_mem(data[0], data[1:])
+
+    def read(self, nbytes):
+        data = self.read_mem(self.pointer, nbytes)
+        self.pointer += nbytes
+        return data
+
+    def write_mem(self, memaddr, data):
+        self.pointer = memaddr
+        self.registers[memaddr:memaddr + len(data)] = data
+
+    def read_mem(self, memaddr, nbytes):
+        return bytes(self.registers[memaddr:memaddr + nbytes])
+
+
+class BMP180Model(RegisterDevice):
+    """
+    BMP180 register model. The calibration and raw readings default to the
+    worked example in the datasheet (15.0 C, 69964 Pa). `up` is the raw
+    pressure at oversample setting 0, the other settings read it scaled.
+    """
+
+    ADDRESS = 0x77
+
+    CALIBRATION = (
+        ('>h', 408),     # AC1
+        ('>h', -72),     # AC2
+        ('>h', -14383),  # AC3
+        ('>H', 32741),   # AC4
+        ('>H', 32757),   # AC5
+        ('>H', 23153),   # AC6
+        ('>h', 6190),    # B1
+        ('>h', 4),       # B2
+        ('>h', -32768),  # MB
+        ('>h', -8711),   # MC
+        ('>h', 2868),    # MD
+    )
+
+    def __init__(self, ut=27898, up=23843, calibration=None):
+        super().__init__()
+        self.ut = ut
+        self.up = up
+        self.conversions = 0
+        self.registers[0xD0] = 0x55
+
+        address = 0xAA
+        for (fmt, default), value in zip(
+            self.CALIBRATION, calibration or [None] * 11
+        ):
+            self.registers[address:address + 2] = struct.pack(
+                fmt, default if value is None else value
+            )
+            address += 2
+
+    def write_mem(self, memaddr, data):
+        super().write_mem(memaddr, data)
+        if memaddr != 0xF4 or not data:
+            return
+
+        self.conversions += 1
+        control = data[0]
+        if control == 0x2E:
+            self.registers[0xF6:0xF8] = struct.pack('>H', self.ut & 0xFFFF)
+        elif control & 0x3F == 0x34:
+            oversample = control >> 6
+            raw = (self.up << 8) & 0xFFFFFF
+            self.registers[0xF6:0xF9] = raw.to_bytes(3, 'big')
+
+
+class SSD1306Model(object):
+    """
+    SSD1306 display controller model. Transfers are decoded by their
+    control bytes into commands and display data. Data is written to the
+    128 x 64 display RAM through the column and page window, in horizontal
+    addressing mode.
+    """
+
+    ADDRESS = 0x3C
+    COLUMNS = 128
+    PAGES = 8
+
+    # Argument bytes of the commands taking any
+    ARGUMENTS = {
+        0x20: 1, 0x21: 2, 0x22: 2, 0x81: 1, 0x8D: 1, 0xA8: 1, 0xD3: 1,
+        0xD5: 1, 0xD9: 1, 0xDA: 1, 0xDB: 1,
+    }
+
+    def __init__(self):
+        self.ram = bytearray(self.COLUMNS * self.PAGES)
+        self.window = (0, self.COLUMNS - 1, 0, self.PAGES - 1)
+        self.column = 0
+        self.page = 0
+        self.pending = []
+        self.display_on = False
+        self.commands = 0
+        self.data_bytes = 0
+
+    def write(self, data):
+        index = 0
+        while index < len(data):
+            control = data[index]
+
+            # With the continuation bit a single byte follows, otherwise
+            # the rest of the transfer
+            if control & 0x80:
+                payload = data[index + 1:index + 2]
+                index += 2
+            else:
+                payload = data[index + 1:]
+                index = len(data)
+
+            if control & 0x40:
+                self.write_ram(payload)
+            else:
+                for byte in payload:
+                    self.command_byte(byte)
+
+    def read(self, nbytes):
+        return bytes(nbytes)
+
+    def command_byte(self, byte):
+        self.pending.append(byte)
+        if len(self.pending) <= self.ARGUMENTS.get(self.pending[0], 0):
+            return
+
+        command = self.pending
+        self.pending = []
+        self.commands += 1
+        if command[0] == 0x21:
+            self.window = (command[1], command[2]) + self.window[2:]
+            self.column = command[1]
+        elif command[0] == 0x22:
+            self.window = self.window[:2] + (command[1], command[2])
+            self.page = command[1]
+        elif command[0] & 0xFE == 0xAE:
+            self.display_on = bool(command[0] & 0x01)
+
+    def write_ram(self, data):
+        column_start, column_end, page_start, page_end = self.window
+        for byte in data:
+            self.ram[self.page * self.COLUMNS + self.column] = byte
+            self.data_bytes += 1
+            self.column += 1
+            if self.column > column_end:
+                self.column = column_start
+                self.page += 1
+                if self.page > page_end:
+                    self.page = page_start
+
+
+def attach(devices, device, address=None):
+    """
+    Register a device model on the simulated I2C bus.
+    """
+    devices[device.ADDRESS if address is None else address] = device
+    return device
@@ -0,0 +1,496 @@
+"""
+Fleet load simulator, many virtual devices in one process.
+
+Every device runs the real `main.run_async` runtime on a shared event loop
+with its own copy of the firmware modules (`main`, `rules` and
+`httpclient`), so the module level state is kept per device. The devices
+share the in-process broker, or with `--broker` a real broker over TCP, the
+iotserver stand-in and the simulated sensors. A backend task publishes
+toggle commands to random devices while the fleet runs and reports:
+
+- publishes, bytes: MQTT messages and bytes (topic and payload) published
+  by the devices
+- http: iotserver requests and their latency
+- command latency: from a toggle command being published until the device
+  publishes the new `mqtt_toggle` status
+- loop lag: how late a 100 ms timer fires, the fleet saturates the host
+  when it grows
+- memory: traced KiB per device after boot and at the end of the run
+
+Usage: python -m host.fleet [--devices N] [--duration S] [--interval S]
+       [--commands N] [--server URL] [--broker HOST:PORT] [--no-trace]
+       [--save FILE]
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import host
+from host import bench
+from host import broker as broker_module
+from host import mqttclient
+from host.clock import WallClock
+from host.iotserver import IotServer
+
+MQTT_HOST = 'fleet.local'
+
+# Firmware modules copied for every device, in import order
+DEVICE_MODULES = ('httpclient', 'rules', 'main')
+
+# Compiled firmware sources by module name
+CODE = {}
+
+
+def compile_module(name):
+    code = CODE.get(name)
+    if code is None:
+        path = os.path.join(host.EMBEDDED, name + '.py')
+        with open(path) as source:
+            code = CODE[name] = compile(source.read(), path, 'exec')
+    return code
+
+
+def load_modules():
+    """
+    Returns fresh instances of the firmware modules by name. While they are
+    executed `sys.modules` points at the new instances, so `main` imports
+    this device's `rules` and `rules` this device's `httpclient`.
+    """
+    saved = dict((name, sys.modules.get(name)) for name in DEVICE_MODULES)
+    modules = {}
+    try:
+        for name in DEVICE_MODULES:
+            module = types.ModuleType(name)
+            module.__file__ = compile_module(name).co_filename
+            sys.modules[name] = module
+            exec(compile_module(name), module.__dict__)
+            modules[name] = module
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+    return modules
+
+
+def device_config(identifier, interval, cache_ttl, mqtt_host=MQTT_HOST):
+    pins = [
+        bench.pin(
+            'day_timer', 'timer',
+            gmt_start_time='00:00', gmt_end_time='23:59'
+        ),
+        bench.pin(
+            'soil_moisture_sensor', 'read_bool_sample', 5,
+            reverse=True, sample_size=3, sample_interval=0.2
+        ),
+        bench.pin(
+            'weather_service_current', 'service',
+            url='{server}/api/devices/locations/1/weather/?type=current',
+            auth_header='Authorization: Token fleet',
+            cache_ttl=cache_ttl
+        ),
+        bench.pin(
+            'mqtt_toggle', 'mqtt_toggle',
+            topic='iot-devices/{identifier}/toggle'.format(
+                identifier=identifier
+            )
+        ),
+        bench.pin(
+            'solenoid_relay', 'toggle', 4, read=False,
+            on={
+                'conditions': {
+                    'must': {
+                        'day_timer': bench.condition('eq', True),
+                        'weather_service_current.temperature': (
+                            bench.condition('gt', 10)
+                        ),
+                    },
+                    'should': {
+                        'mqtt_toggle': bench.condition('eq', True),
+                    },
+                }
+            }
+        ),
+    ]
+
+    config = bench.base_config(pins)
+    config['mqtt']['host'] = mqtt_host
+    config['mqtt']['poll_interval'] = 0.5
+    config['main'].update(
+        identifier=identifier, mode='async', process_interval=interval
+    )
+    return config
+
+
+class VirtualDevice(object):
+    """
+    A device running its own copy of the firmware.
+    """
+
+    def __init__(self, identifier, config, workdir, http_latencies):
+        self.identifier = identifier
+        self.error = None
+        self.modules = load_modules()
+        self.main = self.modules['main']
+
+        self.main.CONFIG_PATH = os.path.join(
+            workdir, '{identifier}.json'.format(identifier=identifier)
+        )
+        with open(self.main.CONFIG_PATH, 'w') as config_file:
+            config_file.write(json.dumps(config))
+
+        httpclient = self.modules['httpclient']
+        httpclient.get_async = timed(httpclient.get_async, http_latencies)
+
+    def boot(self):
+        main = self.main
+        main.CONFIG = main.load_config()
+        main.DEVICE_ID = main.CONFIG['main']['identifier']
+        self.mqtt = main.init_mqtt(main.CONFIG['mqtt'])
+        main.set_time(self.mqtt, main.CONFIG['time'])
+
+    async def run(self, delay):
+        await asyncio.sleep(delay)
+        try:
+            await self.main.run_async(self.mqtt, self.main.CONFIG['pins'])
+        except Exception as exc:
+            self.error = exc
+
+
+def timed(get_async, latencies):
+    """
+    Wrap `httpclient.get_async`, recording the latency of every request.
+    """
+    async def get(url, headers=None, max_size=None):
+        start = time.perf_counter()
+        try:
+            return await get_async(url, headers, max_size)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    return get
+
+
+class Backend(object):
+    """
+    Publishes toggle commands to the devices and times how long each takes
+    to show up in the device's status.
+    """
+
+    def __init__(self, publish, identifiers):
+        self.publish = publish
+        self.identifiers = identifiers
+        self.values = dict((identifier, 0) for identifier in identifiers)
+        self.sent = {}
+        self.latencies = []
+        self.commands = 0
+
+    def observe(self, topic, msg):
+        levels = topic.split(b'/')
+        if len(levels) != 4 or levels[2] != b'status':
+            return
+        if levels[3] != b'mqtt_toggle':
+            return
+
+        identifier = levels[1].decode()
+        sent = self.sent.get(identifier)
+        if sent and json.loads(msg) == sent[1]:
+            self.latencies.append(time.perf_counter() - sent[0])
+            del self.sent[identifier]
+
+    def command(self):
+        identifier = random.choice(self.identifiers)
+        if identifier in self.sent:
+            return
+        value = self.values[identifier] = 1 - self.values[identifier]
+        self.sent[identifier] = (time.perf_counter(), value)
+        self.commands += 1
+        self.publish(
+            'iot-devices/{identifier}/toggle'.format(
+                identifier=identifier
+            ).encode(),
+            str(value).encode()
+        )
+
+    async def run(self, rate):
+        while True:
+            await asyncio.sleep(1 / rate)
+            self.command()
+
+
+async def poll_client(client, interval=0.01):
+    """
+    Handle the messages of the backend's broker connection.
+    """
+    while True:
+        while client.check_msg() is not None:
+            pass
+        await asyncio.sleep(interval)
+
+
+def parse_broker(broker):
+    """
+    Returns the host and port of a `host:port` broker address.
+    """
+    host, _, port = broker.rpartition(':')
+    if not host:
+        return port, 1883
+    return host, int(port)
+
+
+def connect_backend(broker, backend):
+    """
+    Connect the backend to a real broker, observing the devices'
+    `mqtt_toggle` status. Returns its client.
+    """
+    host, port = parse_broker(broker)
+    client = mqttclient.MQTTClient('fleet-backend', host, port)
+    client.set_callback(backend.observe)
+    client.connect()
+    client.subscribe('iot-devices/+/status/mqtt_toggle')
+    return client
+
+
+async def monitor_lag(lags, interval=0.1):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+async def cancel_tasks():
+    """
+    Cancel every other task, including the ones the devices started. Before
+    Python 3.12 `asyncio.wait_for` can swallow a cancellation, so tasks are
+    cancelled again until they finish.
+    """
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    while tasks:
+        for task in tasks:
+            task.cancel()
+        _, tasks = await asyncio.wait(tasks, timeout=1)
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return None
+    return dict(
+        ('p{percent}_ms'.format(percent=percent),
+         bench.percentile(latencies, percent) * 1000)
+        for percent in (50, 95, 99)
+    )
+
+
+async def simulate(args, server_url):
+    """
+    Boot the fleet, run it for the duration and return the measurements.
+    """
+    import machine
+    from umqtt import simple
+
+    mqtt_host = MQTT_HOST
+    client_class = simple.MQTTClient
+    if args.broker:
+        mqtt_host, port = parse_broker(args.broker)
+        simple.MQTTClient = functools.partial(
+            mqttclient.MQTTClient, port=port
+        )
+    else:
+        broker_module.BROKERS.pop(MQTT_HOST, None)
+
+    # The soil moisture sensor dries out and gets watered now and then
+    machine.INPUTS[5] = lambda: int(random.random() < 0.8)
+
+    workdir = tempfile.mkdtemp(prefix='iotdevice-fleet-')
+    http_latencies = []
+    lags = []
+
+    if args.trace:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0] if args.trace else 0
+
+    devices = []
+    try:
+        for index in range(args.devices):
+            identifier = 'fleet-{index:05d}'.format(index=index)
+            config = bench.format_config(
+                device_config(
+                    identifier, args.interval, args.cache_ttl, mqtt_host
+                ),
+                server_url
+            )
+            device = VirtualDevice(
+                identifier, config, workdir, http_latencies
+            )
+            device.boot()
+            devices.append(device)
+    finally:
+        simple.MQTTClient = client_class
+
+    result = {'devices': args.devices, 'duration_s': args.duration}
+    if args.trace:
+        result['boot_kib_per_device'] = (
+            tracemalloc.get_traced_memory()[0] - baseline
+        ) / 1024 / args.devices
+
+    identifiers = [device.identifier for device in devices]
+    if args.broker:
+        backend = Backend(None, identifiers)
+        client = connect_backend(args.broker, backend)
+        backend.publish = client.publish
+        asyncio.create_task(poll_client(client))
+    else:
+        broker = broker_module.get_broker(MQTT_HOST)
+        backend = Backend(broker.publish, identifiers)
+        broker.observers.append(backend.observe)
+
+    def published():
+        return (
+            sum(device.mqtt.published for device in devices),
+            sum(device.mqtt.published_bytes for device in devices),
+        )
+
+    before = published()
+
+    # Spread the device starts over a process interval
+    for index, device in enumerate(devices):
+        asyncio.create_task(device.run(args.interval * index / args.devices))
+    asyncio.create_task(monitor_lag(lags))
+    asyncio.create_task(backend.run(args.commands))
+
+    start = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - start
+
+    if args.trace:
+        result['run_kib_per_device'] = (
+            tracemalloc.get_traced_memory()[0] - baseline
+        ) / 1024 / args.devices
+        tracemalloc.stop()
+
+    after = published()
+    await cancel_tasks()
+    for device in devices:
+        device.mqtt.disconnect()
+    if args.broker:
+        client.disconnect()
+
+    result.update({
+        'publishes_per_s': (after[0] - before[0]) / elapsed,
+        'bytes_per_s': (after[1] - before[1]) / elapsed,
+        'http_per_s': len(http_latencies) / elapsed,
+        'http_latency': latency_summary(http_latencies),
+        'commands': backend.commands,
+        'commands_pending': len(backend.sent),
+        'command_latency': latency_summary(backend.latencies),
+        'loop_lag': latency_summary(lags),
+        'failed_devices': sum(1 for device in devices if device.error),
+        'errors': sorted(set(
+            repr(device.error) for device in devices if device.error
+        ))[:5],
+    })
+    return result
+
+
+def format_latency(name, summary):
+    if summary is None:
+        return '{:<20} -'.format(name)
+    return '{:<20} p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+        name, summary['p50_ms'], summary['p95_ms'], summary['p99_ms']
+    )
+
+
+def format_result(result):
+    lines = [
+        '{:<20} {devices}'.format('devices', **result),
+        '{:<20} {duration_s} s'.format('duration', **result),
+        '{:<20} {publishes_per_s:.1f}/s, {bytes_per_s:.0f} bytes/s'.format(
+            'publishes', **result
+        ),
+        '{:<20} {http_per_s:.1f}/s'.format('http requests', **result),
+        format_latency('http latency', result['http_latency']),
+        '{:<20} {commands} sent, {commands_pending} pending'.format(
+            'commands', **result
+        ),
+        format_latency('command latency', result['command_latency']),
+        format_latency('loop lag', result['loop_lag']),
+    ]
+    if 'boot_kib_per_device' in result:
+        lines.append(
+            '{:<20} {boot_kib_per_device:.1f} KiB after boot, '
+            '{run_kib_per_device:.1f} KiB running'.format(
+                'memory per device', **result
+            )
+        )
+    lines.append('{:<20} {failed_devices}'.format('failed devices', **result))
+    for error in result['errors']:
+        lines.append('  ' + error)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument(
+        '--interval', type=float, default=5.0,
+        help='process_interval of the devices in seconds'
+    )
+    parser.add_argument(
+        '--commands', type=float, default=5.0,
+        help='Toggle commands published per second'
+    )
+    parser.add_argument('--cache-ttl', type=int, default=60)
+    parser.add_argument(
+        '--server', help='iotserver url, a local stand-in by default'
+    )
+    parser.add_argument(
+        '--broker',
+        help='host:port of a broker to connect to, an in-process one by '
+        'default'
+    )
+    parser.add_argument(
+        '--no-trace', dest='trace', action='store_false',
+        help='Skip the memory tracing, which slows the fleet down'
+    )
+    parser.add_argument('--save', help='Write the results as json')
+    args = parser.parse_args(argv)
+    if args.devices < 1:
+        parser.error('--devices must be at least 1')
+
+    host.reload()
+    host.install(WallClock())
+
+    server = None
+    server_url = args.server
+    if not server_url:
+        server = IotServer().start()
+        server_url = server.url
+
+    try:
+        result = asyncio.run(simulate(args, server_url))
+    finally:
+        if server:
+            server.stop()
+
+    print(format_result(result))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            results_file.write(json.dumps(result, indent=2))
+
+    return 1 if result['failed_devices'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+Local stand-in for the iotserver health and weather endpoints.
+
+The server runs in its own process so its allocations and CPU time don't
+show up in the device measurements. Responses carry an ETag and honour
+If-None-Match. `/stats/` returns the request counters.
+
+Usage: python -m host.iotserver [--forecast-days N] [--chunked]
+"""
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import socket
+import subprocess
+import sys
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def weather(path, forecast_days):
+    if path.startswith('/health/'):
+        return {'status': 'ok'}
+    if 'type=forecast' in path:
+        return [
+            {
+                'date': '2022-10-{day:02d}'.format(day=day % 28 + 1),
+                'temperature': 18 + day % 10,
+                'humidity': 60,
+                'rain': day % 3 == 0,
+                'wind_speed': 12.5,
+                'description': 'Partly cloudy with a chance of rain',
+            }
+            for day in range(forecast_days)
+        ]
+    if 'type=current' in path:
+        return {
+            'temperature': 21.5,
+            'humidity': 58,
+            'rain': False,
+            'wind_speed': 10.1,
+            'description': 'Sunny',
+        }
+    return None
+
+
+def make_handler(forecast_days, chunked):
+    stats = {
+        'requests': 0,
+        'not_modified': 0,
+        'bytes_sent': 0,
+        'connections': 0,
+    }
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            self.connection.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+            )
+            stats['connections'] += 1
+
+        def send_body(self, body, status=200, headers=()):
+            self.send_response(status)
+            for key, value in headers:
+                self.send_header(key, value)
+            if chunked and body:
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                data = b''
+                for start in range(0, len(body), 256):
+                    chunk = body[start:start + 256]
+                    data += b'%x\r\n' % len(chunk) + chunk + b'\r\n'
+                self.wfile.write(data + b'0\r\n\r\n')
+            else:
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats/':
+                self.send_body(json.dumps(stats).encode())
+                return
+
+            stats['requests'] += 1
+            data = weather(self.path, forecast_days)
+            if data is None:
+                self.send_body(b'', status=404)
+                return
+
+            body = json.dumps(data, indent=2).encode()
+            etag = '"{digest}"'.format(
+                digest=hashlib.sha1(body).hexdigest()[:16]
+            )
+            if self.headers.get('If-None-Match') == etag:
+                stats['not_modified'] += 1
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            stats['bytes_sent'] += len(body)
+            self.send_body(
+                body,
+                headers=(
+                    ('Content-Type', 'application/json'),
+                    ('ETag', etag),
+                )
+            )
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Room for a simulated fleet connecting at once
+    request_queue_size = 1024
+
+
+def serve(forecast_days=7, chunked=False, port=0):
+    server = Server(
+        ('127.0.0.1', port), make_handler(forecast_days, chunked)
+    )
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+
+class IotServer(object):
+    """
+    Runs the stand-in server in a child process.
+    """
+
+    def __init__(self, forecast_days=7, chunked=False):
+        self.forecast_days = forecast_days
+        self.chunked = chunked
+        self.process = None
+        self.port = None
+
+    def start(self):
+        command = [
+            sys.executable, '-m', 'host.iotserver',
+            '--forecast-days', str(self.forecast_days),
+        ]
+        if self.chunked:
+            command.append('--chunked')
+        self.process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, cwd=ROOT
+        )
+        self.port = int(self.process.stdout.readline())
+        return self
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{port}'.format(port=self.port)
+
+    def stats(self):
+        with urllib.request.urlopen(self.url + '/stats/') as response:
+            return json.loads(response.read())
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--forecast-days', type=int, default=7)
+    parser.add_argument('--chunked', action='store_true')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+    try:
+        serve(args.forecast_days, args.chunked, args.port)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,25 @@
+# Host stand-in for MicroPython's `dht` module
+READINGS = {'temperature': 21, 'humidity': 55}
+
+
+class DHTBase(object):
+
+    def __init__(self, pin):
+        self.pin = pin
+
+    def measure(self):
+        pass
+
+    def temperature(self):
+        return READINGS['temperature']
+
+    def humidity(self):
+        return READINGS['humidity']
+
+
+class DHT11(DHTBase):
+    pass
+
+
+class DHT22(DHTBase):
+    pass
@@ -0,0 +1,117 @@
+# Host stand-in for MicroPython's `framebuf` module. Only the MONO_VLSB
+# format is drawn. Text uses a made up 8x8 font with the same cell size as
+# the firmware's, so only the pixels touched match.
+MONO_VLSB = 0
+RGB565 = 1
+GS4_HMSB = 2
+MONO_HLSB = 3
+MONO_HMSB = 4
+GS2_HMSB = 5
+GS8 = 6
+
+
+def glyph(char):
+    """
+    Returns the 8 columns of a character, the last one blank.
+    """
+    code = ord(char)
+    if char == ' ':
+        return bytes(8)
+    return bytes(
+        ((code * (column + 7) * 37) | 0x01) & 0x7F if column < 7 else 0
+        for column in range(8)
+    )
+
+
+class FrameBuffer(object):
+
+    def __init__(self, buffer, width, height, format, stride=None):
+        if format != MONO_VLSB:
+            raise ValueError('only MONO_VLSB is simulated')
+        self.buffer = buffer
+        self.width = width
+        self.height = height
+
+    def pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        index = (y >> 3) * self.width + x
+        bit = 1 << (y & 7)
+        if c is None:
+            return int(bool(self.buffer[index] & bit))
+        if c:
+            self.buffer[index] |= bit
+        else:
+            self.buffer[index] &= ~bit & 0xFF
+
+    def fill(self, c):
+        value = 0xFF if c else 0x00
+        for index in range(len(self.buffer)):
+            self.buffer[index] = value
+
+    def fill_rect(self, x, y, w, h, c):
+        for row in range(max(y, 0), min(y + h, self.height)):
+            for column in range(max(x, 0), min(x + w, self.width)):
+                self.pixel(column, row, c)
+
+    def hline(self, x, y, w, c):
+        self.fill_rect(x, y, w, 1, c)
+
+    def vline(self, x, y, h, c):
+        self.fill_rect(x, y, 1, h, c)
+
+    def rect(self, x, y, w, h, c, f=False):
+        if f:
+            self.fill_rect(x, y, w, h, c)
+            return
+        self.hline(x, y, w, c)
+        self.hline(x, y + h - 1, w, c)
+        self.vline(x, y, h, c)
+        self.vline(x + w - 1, y, h, c)
+
+    def line(self, x1, y1, x2, y2, c):
+        dx = abs(x2 - x1)
+        dy = -abs(y2 - y1)
+        sx = 1 if x1 < x2 else -1
+        sy = 1 if y1 < y2 else -1
+        error = dx + dy
+        while True:
+            self.pixel(x1, y1, c)
+            if x1 == x2 and y1 == y2:
+                return
+            double = 2 * error
+            if double >= dy:
+                error += dy
+                x1 += sx
+            if double <= dx:
+                error += dx
+                y1 += sy
+
+    def text(self, s, x, y, c=1):
+        for offset, char in enumerate(s):
+            for column, bits in enumerate(glyph(char)):
+                for row in range(8):
+                    if bits & (1 << row):
+                        self.pixel(x + offset * 8 + column, y + row, c)
+
+    def scroll(self, xstep, ystep):
+        pixels = [
+            [self.pixel(x, y) for x in range(self.width)]
+            for y in range(self.height)
+        ]
+        for y in range(self.height):
+            for x in range(self.width):
+                source_x = x - xstep
+                source_y = y - ystep
+                if (
+                    0 <= source_x < self.width
+                    and 0 <= source_y < self.height
+                ):
+                    self.pixel(x, y, pixels[source_y][source_x])
+
+    def blit(self, fbuf, x, y, key=-1, palette=None):
+        for row in range(fbuf.height):
+            for column in range(fbuf.width):
+                c = fbuf.pixel(column, row)
+                if c != key:
+                    self.pixel(x + column, y + row, c)
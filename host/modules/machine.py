@@ -0,0 +1,314 @@
+# Host stand-in for MicroPython's `machine` module. Input levels, ADC
+# readings and I2C devices are set by the host through the module globals.
+import time
+
+# Levels of the digital pins and readings of the analog pins by pin number,
+# either a value or a callable returning one
+INPUTS = {}
+ANALOG = {}
+
+# Output levels driven by the device by pin number, and the count of writes
+OUTPUTS = {}
+OUTPUT_WRITES = {}
+
+# I2C device models by address, see host.devices, and the traffic of all
+# the buses
+I2C_DEVICES = {}
+I2C_STATS = {'transactions': 0, 'bytes': 0}
+
+# Survives simulated resets and deep sleeps, like the real RTC memory
+RTC_MEMORY = bytearray()
+
+PWRON_RESET = 0
+HARD_RESET = 1
+WDT_RESET = 2
+DEEPSLEEP_RESET = 3
+SOFT_RESET = 4
+
+RESET_CAUSE = PWRON_RESET
+
+# Wake source for `RTC.irq` on the ESP8266
+DEEPSLEEP = 4
+
+
+class DeviceReset(BaseException):
+    """
+    Raised by `reset()`, outside the Exception hierarchy so the embedded
+    error handlers don't catch it.
+    """
+
+
+class DeepSleep(BaseException):
+    """
+    Raised by `deepsleep()` with the requested sleep time in ms.
+    """
+
+    def __init__(self, ms):
+        super().__init__(ms)
+        self.ms = ms
+
+
+def reset():
+    raise DeviceReset()
+
+
+def soft_reset():
+    raise DeviceReset()
+
+
+def deepsleep(ms=0):
+    raise DeepSleep(ms)
+
+
+def lightsleep(ms=0):
+    time.sleep_ms(ms)
+
+
+def reset_cause():
+    return RESET_CAUSE
+
+
+def unique_id():
+    return b'\x00\x11\x22\x33\x44\x55'
+
+
+def freq(value=None):
+    if value is None:
+        return 160_000_000
+
+
+def idle():
+    pass
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state=0):
+    pass
+
+
+def resolve(value):
+    return value() if callable(value) else value
+
+
+class Pin(object):
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    # Pins with an irq handler by pin number, see `drive`
+    HANDLERS = {}
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        if value is not None:
+            self.value(value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        self.mode = mode
+        self.pull = pull
+        if value is not None:
+            self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            if self.mode == Pin.OUT:
+                return OUTPUTS.get(self.id, 0)
+            return int(bool(resolve(INPUTS.get(self.id, 0))))
+
+        OUTPUTS[self.id] = int(bool(value))
+        OUTPUT_WRITES[self.id] = OUTPUT_WRITES.get(self.id, 0) + 1
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def irq(self, handler=None, trigger=IRQ_RISING | IRQ_FALLING, **kwargs):
+        Pin.HANDLERS[self.id] = (self, handler, trigger)
+
+
+def drive(pin_number, level):
+    """
+    Set an input level from the host, running the pin's irq handler on an
+    edge it is registered for.
+    """
+    previous = int(bool(resolve(INPUTS.get(pin_number, 0))))
+    INPUTS[pin_number] = int(bool(level))
+
+    registered = Pin.HANDLERS.get(pin_number)
+    if registered and previous != INPUTS[pin_number]:
+        pin, handler, trigger = registered
+        edge = Pin.IRQ_RISING if INPUTS[pin_number] else Pin.IRQ_FALLING
+        if handler and trigger & edge:
+            handler(pin)
+
+
+class Signal(object):
+
+    def __init__(self, pin, *args, invert=False, **kwargs):
+        if not isinstance(pin, Pin):
+            pin = Pin(pin, *args, **kwargs)
+        self.pin = pin
+        self.invert = invert
+
+    def value(self, value=None):
+        if value is None:
+            return self.pin.value() ^ int(self.invert)
+        self.pin.value(int(bool(value)) ^ int(self.invert))
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+
+class ADC(object):
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
+    ATTN_11DB = 3
+
+    def __init__(self, pin, atten=None):
+        self.id = pin.id if isinstance(pin, Pin) else pin
+        self.attenuation = atten
+
+    def atten(self, atten):
+        self.attenuation = atten
+
+    def read(self):
+        return int(resolve(ANALOG.get(self.id, 0)))
+
+    def read_u16(self):
+        return self.read() << 4
+
+
+class SoftI2C(object):
+    """
+    I2C bus routed to the device models in `I2C_DEVICES`. The number of
+    transactions and bytes moved are counted per bus.
+    """
+
+    def __init__(self, scl=None, sda=None, freq=400_000, timeout=50_000):
+        self.scl = scl
+        self.sda = sda
+        self.freq = freq
+        self.transactions = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.raw = None
+
+    def transfer_time(self, count):
+        """
+        Seconds the bus needs to move the bytes, 9 clocks per byte.
+        """
+        return count * 9 / self.freq
+
+    def device(self, addr):
+        try:
+            return I2C_DEVICES[addr]
+        except KeyError:
+            raise OSError(19)  # ENODEV
+
+    def count(self, written=0, read=0):
+        self.transactions += 1
+        self.bytes_written += written
+        self.bytes_read += read
+        I2C_STATS['transactions'] += 1
+        I2C_STATS['bytes'] += written + read
+        time.sleep_us(self.transfer_time(written + read + 1) * 1_000_000)
+
+    def scan(self):
+        return sorted(I2C_DEVICES)
+
+    def start(self):
+        self.raw = bytearray()
+
+    def stop(self):
+        raw, self.raw = self.raw, None
+        if raw:
+            self.count(written=len(raw))
+            self.device(raw[0] >> 1).write(bytes(raw[1:]))
+
+    def write(self, buf):
+        self.raw.extend(buf)
+        return len(buf)
+
+    def writeto(self, addr, buf, stop=True):
+        self.count(written=len(buf) + 1)
+        self.device(addr).write(bytes(buf))
+        return len(buf)
+
+    def writevto(self, addr, vector, stop=True):
+        data = b''.join(bytes(buf) for buf in vector)
+        self.count(written=len(data) + 1)
+        self.device(addr).write(data)
+        return len(data)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        self.count(written=1, read=nbytes)
+        return self.device(addr).read(nbytes)
+
+    def readfrom_into(self, addr, buf, stop=True):
+        buf[:] = self.readfrom(addr, len(buf))
+
+    def writeto_mem(self, addr, memaddr, buf, addrsize=8):
+        self.count(written=len(buf) + 2)
+        self.device(addr).write_mem(memaddr, bytes(buf))
+
+    def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+        self.count(written=3, read=nbytes)
+        return self.device(addr).read_mem(memaddr, nbytes)
+
+    def readfrom_mem_into(self, addr, memaddr, buf, addrsize=8):
+        buf[:] = self.readfrom_mem(addr, memaddr, len(buf))
+
+
+I2C = SoftI2C
+
+
+class RTC(object):
+    ALARM0 = 0
+
+    def __init__(self, id=0):
+        self.alarm_ms = None
+
+    def memory(self, data=None):
+        if data is None:
+            return bytes(RTC_MEMORY)
+        RTC_MEMORY[:] = data
+
+    def datetime(self, datetimetuple=None):
+        if datetimetuple is None:
+            year, month, day, hour, minute, second, weekday, _ = (
+                time.localtime()
+            )
+            return (year, month, day, weekday, hour, minute, second, 0)
+
+    def irq(self, trigger=ALARM0, wake=None, handler=None):
+        pass
+
+    def alarm(self, alarm_id, ms):
+        self.alarm_ms = ms
+
+
+class WDT(object):
+
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+
+    def feed(self):
+        pass
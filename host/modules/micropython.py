@@ -0,0 +1,15 @@
+# Host stand-in for MicroPython's `micropython` module
+def const(value):
+    return value
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def schedule(function, argument):
+    function(argument)
+
+
+def mem_info(verbose=False):
+    pass
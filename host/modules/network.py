@@ -0,0 +1,120 @@
+# Host stand-in for MicroPython's `network` module
+import time
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = 2
+STAT_NO_AP_FOUND = 3
+STAT_CONNECT_FAIL = 4
+STAT_GOT_IP = 5
+
+# Access points in range by essid, and the seconds an association and a
+# scan take
+ACCESS_POINTS = {}
+ASSOCIATION_TIME = 1.5
+SCAN_TIME = 2.0
+
+
+class WLAN(object):
+
+    INTERFACES = {}
+
+    def __new__(cls, interface_id=STA_IF):
+        # Like the real driver, there is one object per interface
+        wlan = cls.INTERFACES.get(interface_id)
+        if wlan is None:
+            wlan = cls.INTERFACES[interface_id] = object.__new__(cls)
+            wlan.interface_id = interface_id
+            wlan.enabled = False
+            wlan.essid = None
+            wlan.bssid = None
+            wlan.channel = 1
+            wlan.connected_at = None
+            wlan.failure = None
+            wlan.ip = ('192.168.1.50', '255.255.255.0', '192.168.1.1', '8.8.8.8')
+        return wlan
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self.enabled
+        self.enabled = bool(is_active)
+
+    def connect(self, essid=None, password=None, bssid=None):
+        access_point = ACCESS_POINTS.get(essid)
+        self.essid = essid
+        self.connected_at = None
+        self.failure = None
+        if access_point is None:
+            self.failure = STAT_NO_AP_FOUND
+            return
+        if access_point.get('password') != password:
+            self.failure = STAT_WRONG_PASSWORD
+            return
+        ap_bssid = access_point.get('bssid', b'\x00\x01\x02\x03\x04\x05')
+        if bssid is not None and bssid != ap_bssid:
+            self.failure = STAT_NO_AP_FOUND
+            return
+        self.bssid = ap_bssid
+        self.channel = access_point.get('channel', 1)
+
+        # A targeted join on a known bssid skips the scan
+        association_time = access_point.get('time', ASSOCIATION_TIME)
+        if bssid is not None and bssid == self.bssid:
+            association_time /= 3
+        self.connected_at = time.time() + association_time
+
+    def disconnect(self):
+        self.connected_at = None
+        self.failure = None
+
+    def isconnected(self):
+        return (
+            self.enabled
+            and self.connected_at is not None
+            and time.time() >= self.connected_at
+        )
+
+    def status(self, param=None):
+        if param == 'rssi':
+            return -60
+        if self.isconnected():
+            return STAT_GOT_IP
+        if self.connected_at is not None:
+            return STAT_CONNECTING
+        if self.failure is not None:
+            return self.failure
+        return STAT_IDLE
+
+    def ifconfig(self, config=None):
+        if config is None:
+            return self.ip
+        self.ip = tuple(config)
+
+    def config(self, *args, **kwargs):
+        if kwargs:
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+            return
+        return {
+            'mac': b'\x24\x0a\xc4\x00\x00\x01',
+            'essid': self.essid,
+            'channel': self.channel,
+            'hostname': 'iotdevice',
+        }[args[0]]
+
+    def scan(self):
+        time.sleep(SCAN_TIME)
+        return [
+            (
+                essid.encode(),
+                access_point.get('bssid', b'\x00\x01\x02\x03\x04\x05'),
+                access_point.get('channel', 1),
+                -60,
+                3,
+                False,
+            )
+            for essid, access_point in ACCESS_POINTS.items()
+        ]
@@ -0,0 +1,20 @@
+# Host stand-in for MicroPython's `ntptime` module
+host = 'pool.ntp.org'
+timeout = 1
+
+# Set to make `settime` fail like an unreachable server
+OFFLINE = False
+SYNCS = 0
+
+
+def time():
+    if OFFLINE:
+        raise OSError(110)  # ETIMEDOUT
+    import time as _time
+    return int(_time.time())
+
+
+def settime():
+    global SYNCS
+    time()
+    SYNCS += 1
@@ -0,0 +1,73 @@
+# Host stand-in for micropython-umqtt.simple backed by host.broker
+from host.broker import get_broker
+
+
+class MQTTException(Exception):
+    pass
+
+
+def to_bytes(value):
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return bytes(value)
+
+
+class MQTTClient(object):
+
+    def __init__(
+        self, client_id, server, port=0, user=None, password=None,
+        keepalive=0, ssl=False, ssl_params={}
+    ):
+        self.client_id = to_bytes(client_id)
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.cb = None
+        self.lastwill = None
+        self.pending = []
+        self.broker = get_broker(server)
+        self.published = 0
+        self.published_bytes = 0
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        self.lastwill = (to_bytes(topic), to_bytes(msg), retain)
+
+    def connect(self, clean_session=True):
+        self.broker.connect(self)
+        if clean_session:
+            self.pending = []
+        return False
+
+    def disconnect(self):
+        self.broker.disconnect(self)
+
+    def ping(self):
+        self.broker.check(self)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self.broker.check(self)
+        topic = to_bytes(topic)
+        msg = to_bytes(msg)
+        self.broker.publish(topic, msg, retain)
+        self.published += 1
+        self.published_bytes += len(topic) + len(msg)
+
+    def subscribe(self, topic, qos=0):
+        assert self.cb is not None, 'Subscribe callback is not set'
+        self.broker.check(self)
+        self.broker.subscribe(self, to_bytes(topic))
+
+    def wait_msg(self):
+        self.broker.check(self)
+        if not self.pending:
+            return None
+        topic, msg = self.pending.pop(0)
+        self.cb(topic, msg)
+
+    def check_msg(self):
+        return self.wait_msg()
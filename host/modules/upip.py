@@ -0,0 +1,4 @@
+# Host stand-in for MicroPython's `upip` module, the host packages are
+# already importable
+def install(*packages):
+    pass
@@ -0,0 +1,2 @@
+# Host stand-in for MicroPython's `ustruct` module
+from struct import *  # noqa: F401,F403
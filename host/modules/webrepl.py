@@ -0,0 +1,11 @@
+# Host stand-in for MicroPython's `webrepl` module
+PASSWORD = None
+
+
+def start(port=8266, password=None):
+    global PASSWORD
+    PASSWORD = password
+
+
+def stop():
+    pass
@@ -0,0 +1,209 @@
+"""
+MQTT 3.1.1 client over a TCP socket, with the interface of
+`umqtt.simple.MQTTClient`.
+
+Used by the fleet simulator to run the virtual devices against a real
+broker. Only QoS 0 is supported, like the firmware uses. Every client counts
+the messages and bytes (topic and payload) it publishes.
+"""
+import socket
+import struct
+
+TIMEOUT = 15.0
+
+
+class MQTTException(Exception):
+    pass
+
+
+def to_bytes(value):
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return bytes(value)
+
+
+def encode_length(length):
+    """
+    Returns the variable length encoding of a packet's remaining length.
+    """
+    encoded = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    value = to_bytes(value)
+    return struct.pack('!H', len(value)) + value
+
+
+class MQTTClient(object):
+
+    def __init__(
+        self, client_id, server, port=0, user=None, password=None,
+        keepalive=0, ssl=False, ssl_params={}, timeout=TIMEOUT
+    ):
+        self.client_id = to_bytes(client_id)
+        self.server = server
+        self.port = port or 1883
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.sock = None
+        self.cb = None
+        self.lastwill = None
+        self.pid = 0
+        self.published = 0
+        self.published_bytes = 0
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        self.lastwill = (to_bytes(topic), to_bytes(msg), retain)
+
+    def send(self, packet_type, body=b''):
+        if self.sock is None:
+            raise OSError('Not connected.')
+        self.sock.sendall(
+            bytes((packet_type,)) + encode_length(len(body)) + body
+        )
+
+    def read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                self.close()
+                raise OSError('Connection closed by broker.')
+            data += chunk
+        return data
+
+    def read_length(self):
+        length = 0
+        shift = 0
+        while True:
+            byte = self.read(1)[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return length
+            shift += 7
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def connect(self, clean_session=True):
+        self.close()
+        self.sock = socket.create_connection(
+            (self.server, self.port), self.timeout
+        )
+
+        flags = 0x02 if clean_session else 0
+        payload = encode_string(self.client_id)
+        if self.lastwill:
+            topic, msg, retain = self.lastwill
+            flags |= 0x04 | (0x20 if retain else 0)
+            payload += encode_string(topic) + encode_string(msg)
+        if self.user is not None:
+            flags |= 0x80
+            payload += encode_string(self.user)
+            if self.password is not None:
+                flags |= 0x40
+                payload += encode_string(self.password)
+
+        try:
+            self.send(0x10, (
+                encode_string(b'MQTT') + bytes((4, flags))
+                + struct.pack('!H', self.keepalive) + payload
+            ))
+            response = self.read(4)
+        except OSError:
+            self.close()
+            raise
+        if response[0] != 0x20 or response[3] != 0:
+            self.close()
+            raise MQTTException(response[3])
+        return bool(response[2] & 1)
+
+    def disconnect(self):
+        try:
+            self.send(0xE0)
+        except OSError:
+            pass
+        self.close()
+
+    def ping(self):
+        self.send(0xC0)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        topic = to_bytes(topic)
+        msg = to_bytes(msg)
+        self.send(0x30 | (1 if retain else 0), encode_string(topic) + msg)
+        self.published += 1
+        self.published_bytes += len(topic) + len(msg)
+
+    def subscribe(self, topic, qos=0):
+        assert self.cb is not None, 'Subscribe callback is not set'
+        self.pid = self.pid % 0xFFFF + 1
+        self.send(
+            0x82,
+            struct.pack('!H', self.pid) + encode_string(topic) + bytes((qos,))
+        )
+        while True:
+            op = self.wait_msg()
+            if op == 0x90:
+                body = self.read(self.read_length())
+                if struct.unpack('!H', body[:2])[0] != self.pid:
+                    continue
+                if body[2] == 0x80:
+                    raise MQTTException(body[2])
+                return
+
+    def wait_msg(self):
+        """
+        Handle one incoming packet, calling the callback for a message.
+        Returns the packet type of any other packet but a ping response,
+        whose body is left to the caller.
+        """
+        if self.sock is None:
+            raise OSError('Not connected.')
+        try:
+            first = self.sock.recv(1)
+        except BlockingIOError:
+            return None
+        finally:
+            if self.sock is not None:
+                self.sock.settimeout(self.timeout)
+        if not first:
+            self.close()
+            raise OSError('Connection closed by broker.')
+
+        op = first[0]
+        if op == 0xD0:
+            self.read(1)
+            return None
+        if op & 0xF0 != 0x30:
+            return op
+
+        body = self.read(self.read_length())
+        topic_length = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + topic_length]
+        start = 2 + topic_length
+        if op & 0x06:
+            start += 2
+        self.cb(topic, body[start:])
+        return None
+
+    def check_msg(self):
+        if self.sock is None:
+            raise OSError('Not connected.')
+        self.sock.setblocking(False)
+        return self.wait_msg()
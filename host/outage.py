@@ -0,0 +1,233 @@
+"""
+MQTT outage harness for the store-and-forward outbox.
+
+Boots a simulated device running `main.run()`, takes the broker offline
+for a number of cycles and brings it back. By default the broker drops
+mid-cycle, right after the health check's ping, so the `mqtt_toggle` rule
+is the first to find it gone. `--drop sleep` drops it during the sleep
+instead. The soil moisture sensor flips every cycle, so every cycle has a
+status change to buffer. Reports:
+
+- buffered: messages stored in the outbox during the outage
+- replayed: messages received on the backlog topic, in order
+- dropped: messages dropped by the outbox
+- flash: peak bytes used by the outbox segments, against the bound
+- drain: cycles after the broker is back until the backlog is empty
+- publishes: peak MQTT publishes in a cycle while draining
+
+The run fails if the device resets, a buffered message is lost or
+reordered, the flash bound is exceeded or the backlog doesn't drain.
+
+Usage: python -m host.outage [--before N] [--outage N] [--after N]
+       [--drop cycle|sleep] [--segment-size BYTES] [--segments N]
+       [--batch-size BYTES] [--batches N] [--save FILE]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+import host
+from host import bench
+from host import broker as broker_module
+from host.iotserver import IotServer
+
+
+class StopOutage(BaseException):
+    pass
+
+
+def device_config(args):
+    config = bench.base_config(bench.example_pins(), level='warning')
+    config['outbox'] = {
+        'segment_size': args.segment_size,
+        'segments': args.segments,
+        'batch_size': args.batch_size,
+        'batches': args.batches,
+    }
+    return config
+
+
+def run_outage(args):
+    server = IotServer().start()
+    workdir = tempfile.mkdtemp(prefix='iotdevice-outage-')
+    cwd = os.getcwd()
+    os.makedirs(os.path.join(workdir, 'config'))
+    os.chdir(workdir)
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            clock, main, mqtt = bench.boot(device_config(args), server)
+
+        import machine
+
+        broker = broker_module.get_broker(bench.MQTT_HOST)
+        backlog_topic = 'iot-devices/{identifier}/backlog'.format(
+            identifier=bench.DEVICE_ID
+        ).encode()
+        process_interval = main.CONFIG['main']['process_interval']
+
+        # The soil dries out and gets watered every other cycle
+        machine.INPUTS[5] = lambda: int(clock.now // process_interval % 2)
+
+        store = main.get_outbox()
+        buffered = []
+        append = store.append
+
+        def record(timestamp, topic, payload, retain=False):
+            stored = append(timestamp, topic, payload, retain)
+            if stored:
+                buffered.append((topic, payload))
+            return stored
+
+        store.append = record
+
+        # Drop the broker once the health check has found it online
+        check_mqtt = main.check_mqtt
+
+        def drop_after_ping(mqtt):
+            check_mqtt(mqtt)
+            if state.pop('drop', False):
+                broker.online = False
+
+        main.check_mqtt = drop_after_ping
+
+        replayed = []
+        broker.observers.append(
+            lambda topic, msg: replayed.extend(
+                (item[1], item[2]) for item in json.loads(msg)
+            ) if topic == backlog_topic else None
+        )
+
+        outage_start = args.before
+        outage_end = args.before + args.outage
+        state = {'cycle': 0, 'published': broker.published}
+        result = {
+            'flash_peak': 0,
+            'flash_bound': args.segment_size * args.segments,
+            'drain_cycles': None,
+            'drain_publishes_peak': 0,
+        }
+
+        def on_sleep(seconds):
+            if seconds != process_interval:
+                return
+
+            cycle = state['cycle'] = state['cycle'] + 1
+            published = broker.published - state['published']
+            state['published'] = broker.published
+            result['flash_peak'] = max(result['flash_peak'], store.used())
+
+            if cycle == outage_start:
+                if args.drop == 'sleep':
+                    broker.online = False
+                else:
+                    state['drop'] = True
+            elif cycle == outage_end:
+                broker.online = True
+            elif cycle > outage_end:
+                result['drain_publishes_peak'] = max(
+                    result['drain_publishes_peak'], published
+                )
+                if not len(store) and result['drain_cycles'] is None:
+                    result['drain_cycles'] = cycle - outage_end
+                if cycle >= outage_end + args.after:
+                    raise StopOutage()
+
+        clock.on_sleep = on_sleep
+        reset = False
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                main.run(mqtt, main.CONFIG['pins'])
+        except StopOutage:
+            pass
+        except machine.DeviceReset:
+            reset = True
+        except Exception:
+            # `main.start()` resets the device on any error out of run()
+            reset = True
+        finally:
+            clock.on_sleep = None
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        host.reload()
+
+    # The outbox drops the oldest messages when it is full, the replayed
+    # ones are the newest
+    result.update({
+        'reset': reset,
+        'buffered': len(buffered),
+        'replayed': len(replayed),
+        'dropped': store.dropped,
+        'in_order': replayed == buffered[len(buffered) - len(replayed):],
+    })
+
+    failures = []
+    if reset:
+        failures.append('the device reset')
+    if result['flash_peak'] > result['flash_bound']:
+        failures.append('flash bound exceeded')
+    if not result['in_order']:
+        failures.append('backlog out of order')
+    if result['drain_cycles'] is None:
+        failures.append('backlog not drained')
+    elif result['replayed'] + result['dropped'] != result['buffered']:
+        failures.append('buffered messages lost')
+    result['failures'] = failures
+    return result
+
+
+def format_result(result):
+    lines = [
+        '{:<12} {buffered}'.format('buffered', **result),
+        '{:<12} {replayed}'.format('replayed', **result),
+        '{:<12} {dropped}'.format('dropped', **result),
+        '{:<12} {flash_peak} of {flash_bound} bytes'.format(
+            'flash', **result
+        ),
+        '{:<12} {} cycles'.format(
+            'drain', '-' if result['drain_cycles'] is None
+            else result['drain_cycles']
+        ),
+        '{:<12} {drain_publishes_peak} per cycle'.format(
+            'publishes', **result
+        ),
+        '{:<12} {}'.format('failures', ', '.join(result['failures']) or '-'),
+    ]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--before', type=int, default=3)
+    parser.add_argument('--outage', type=int, default=60)
+    parser.add_argument('--after', type=int, default=60)
+    parser.add_argument(
+        '--drop', choices=('cycle', 'sleep'), default='cycle',
+        help='Drop the broker after the health check or during the sleep'
+    )
+    parser.add_argument('--segment-size', type=int, default=1024)
+    parser.add_argument('--segments', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--batches', type=int, default=2)
+    parser.add_argument('--save', help='Write the results as json')
+    args = parser.parse_args(argv)
+    if args.before < 1 or args.outage < 1:
+        parser.error('--before and --outage must be at least 1')
+
+    result = run_outage(args)
+    print(format_result(result))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            results_file.write(json.dumps(result, indent=2))
+
+    return 1 if result['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""
+Provisioning check for the parallel `cli.py flash` and `cli.py install`.
+
+Starts a number of fake boards (`host.repl`) on ptys and a fake esptool,
+then runs `cli.py flash` and `cli.py install --source` against all of them
+plus one port which fails: a path with no board behind it for `install`,
+and a port the fake esptool fails on for `flash`. Reports per command:
+
+- exit: the exit code, 1 as one port failed
+- summary: the ports in the summary table and how many succeeded
+- prefixed: whether every output line before the summary carries a port
+- overlap: seconds the device pipelines ran at the same time
+
+The run fails if the exit code isn't 1, an output line isn't prefixed, the
+summary doesn't list every port with its result, a good board misses a file
+or the installed files differ from the sources, or the pipelines ran one
+after the other.
+
+Usage: python -m host.provision [--boards N] [--flash-delay S] [--save FILE]
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+
+from host.repl import FakeBoard
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FAKE_ESPTOOL = '''#!{python}
+import sys
+import time
+
+port = sys.argv[sys.argv.index('--port') + 1]
+with open({log!r}, 'a') as log:
+    log.write('{{}} {{}} {{}}\\n'.format(port, sys.argv[-1], time.time()))
+print('Connecting to {{}}...'.format(port), flush=True)
+time.sleep({delay})
+if port == {failing!r}:
+    print('A fatal error occurred: Failed to connect', flush=True)
+    sys.exit(2)
+print('Hard resetting via RTS pin...', flush=True)
+'''
+
+# The summary line printed by `cli.run_pipelines`
+SUMMARY = re.compile(r'^(\d+) succeeded, (\d+) failed$')
+
+
+def write_fake_esptool(workdir, failing, delay):
+    """
+    Write an esptool stand-in which logs its calls, returns its path and
+    the path of its log.
+    """
+    path = os.path.join(workdir, 'esptool.py')
+    log = os.path.join(workdir, 'esptool.log')
+    with open(path, 'w') as script:
+        script.write(FAKE_ESPTOOL.format(
+            python=sys.executable, log=log, failing=failing, delay=delay
+        ))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path, log
+
+
+def make_project(workdir):
+    """
+    Returns a directory laid out like the repository for `cli.py`, with the
+    example config as `config.json`, so the check leaves the tree alone.
+    """
+    project = os.path.join(workdir, 'project')
+    shutil.copytree(
+        os.path.join(ROOT, 'embedded'),
+        os.path.join(project, 'embedded'),
+        ignore=shutil.ignore_patterns('__pycache__', 'config.json')
+    )
+    shutil.copy(
+        os.path.join(project, 'embedded', 'config', 'config.example.json'),
+        os.path.join(project, 'embedded', 'config', 'config.json')
+    )
+    return project
+
+
+def run_cli(project, argv, env):
+    process = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'cli.py')] + argv,
+        cwd=project,
+        env=env,
+        capture_output=True,
+        text=True
+    )
+    return process.returncode, process.stdout + process.stderr
+
+
+def parse_output(output, ports):
+    """
+    Split the cli output into the prefixed pipeline lines and the summary.
+    Returns the result per port in the table, the summary counts and the
+    lines which aren't prefixed with a port.
+    """
+    lines = [line for line in output.splitlines() if line.strip()]
+    prefixes = tuple('[{port}] '.format(port=port) for port in ports)
+
+    table = {}
+    counts = None
+    unprefixed = []
+    in_summary = False
+    for line in lines:
+        if line.startswith('port '):
+            in_summary = True
+            continue
+        match = SUMMARY.match(line)
+        if match:
+            counts = (int(match.group(1)), int(match.group(2)))
+            continue
+        if in_summary:
+            fields = line.split()
+            table[fields[0]] = fields[1]
+        elif not line.startswith(prefixes) and not line.startswith((
+            'Flashing ', 'Writing firmware to '
+        )):
+            unprefixed.append(line)
+    return table, counts, unprefixed
+
+
+def overlap(spans):
+    """
+    Returns the seconds during which at least two of the spans ran.
+    """
+    if len(spans) < 2:
+        return 0.0
+    return max(0.0, min(end for _, end in spans) - max(
+        start for start, _ in spans
+    ))
+
+
+def check_command(name, code, output, ports, failing, failures):
+    table, counts, unprefixed = parse_output(output, ports)
+    expected = dict(
+        (port, 'failed' if port == failing else 'ok') for port in ports
+    )
+    if code != 1:
+        failures.append('{} exited with {}'.format(name, code))
+    if unprefixed:
+        failures.append('{} printed unprefixed lines'.format(name))
+    if table != expected:
+        failures.append('{} summary table is wrong'.format(name))
+    if counts != (len(ports) - 1, 1):
+        failures.append('{} summary counts are wrong'.format(name))
+    return {
+        'exit': code,
+        'summary': table,
+        'succeeded': counts[0] if counts else None,
+        'failed': counts[1] if counts else None,
+        'prefixed': not unprefixed,
+    }
+
+
+def run_provision(args):
+    workdir = tempfile.mkdtemp(prefix='iotdevice-provision-')
+    boards = []
+    failures = []
+    result = {}
+    try:
+        for index in range(args.boards):
+            boards.append(FakeBoard(
+                os.path.join(workdir, 'board-{}'.format(index))
+            ).start())
+        failing = os.path.join(workdir, 'missing-board')
+        ports = [board.port for board in boards] + [failing]
+
+        esptool, log = write_fake_esptool(workdir, failing, args.flash_delay)
+        project = make_project(workdir)
+        env = dict(os.environ, ESPTOOL=esptool)
+        port_args = []
+        for port in ports:
+            port_args += ['--port', port]
+
+        code, output = run_cli(project, [
+            'flash', '--chip', 'esp32', '--bin-file', 'firmware.bin'
+        ] + port_args, env)
+        result['flash'] = check_command(
+            'flash', code, output, ports, failing, failures
+        )
+
+        # Every port is erased and then written, except the failing one
+        spans = {}
+        calls = {}
+        with open(log) as log_file:
+            for line in log_file:
+                port, command, started = line.split()
+                calls.setdefault(port, []).append(command)
+                span = spans.setdefault(port, [float(started)] * 2)
+                span[1] = float(started) + args.flash_delay
+        result['flash']['overlap_s'] = overlap(list(spans.values()))
+        for port in ports:
+            expected = ['erase_flash'] if port == failing else [
+                'erase_flash', 'firmware.bin'
+            ]
+            if calls.get(port) != expected:
+                failures.append('flash ran the wrong steps on a port')
+        if result['flash']['overlap_s'] <= 0:
+            failures.append('flash pipelines ran one after the other')
+
+        code, output = run_cli(
+            project, ['install', '--source'] + port_args, env
+        )
+        result['install'] = check_command(
+            'install', code, output, ports, failing, failures
+        )
+
+        # The good boards get every file, each pipeline announcing its own
+        sys.path.insert(0, ROOT)
+        try:
+            import cli
+        finally:
+            sys.path.remove(ROOT)
+        config_path = os.path.join(
+            project, 'embedded', 'config', 'config.json'
+        )
+        with open(config_path) as config_file:
+            drivers = json.loads(config_file.read()).get('drivers')
+        files = cli.install_files(drivers)
+        installed = 0
+        for board in boards:
+            complete = True
+            for local_path, path in files:
+                with open(os.path.join(project, local_path), 'rb') as source:
+                    expected = source.read()
+                try:
+                    with open(
+                        os.path.join(board.directory, path), 'rb'
+                    ) as uploaded:
+                        complete = complete and uploaded.read() == expected
+                except OSError:
+                    complete = False
+            installed += complete
+            if '[{}] Uploading main.py'.format(board.port) not in output:
+                failures.append('install output of a board is missing')
+        result['install']['installed'] = installed
+        if installed != len(boards):
+            failures.append('a board is missing files')
+    finally:
+        for board in boards:
+            board.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result['boards'] = args.boards
+    result['failures'] = failures
+    return result
+
+
+def format_result(result):
+    lines = ['{:<8} {:>5} {:>10} {:>7} {:>9} {:>9}'.format(
+        'command', 'exit', 'succeeded', 'failed', 'prefixed', 'overlap s'
+    )]
+    for name in ('flash', 'install'):
+        command = result.get(name)
+        if command is None:
+            continue
+        lines.append('{:<8} {:>5} {:>10} {:>7} {:>9} {:>9}'.format(
+            name, command['exit'], str(command['succeeded']),
+            str(command['failed']), 'yes' if command['prefixed'] else 'no',
+            '{:.1f}'.format(command['overlap_s'])
+            if 'overlap_s' in command else '-'
+        ))
+    if 'install' in result:
+        lines.append('installed {} of {} boards'.format(
+            result['install']['installed'], result['boards']
+        ))
+    lines.append('failures: {}'.format(', '.join(result['failures']) or '-'))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--boards', type=int, default=3)
+    parser.add_argument(
+        '--flash-delay', type=float, default=0.5,
+        help='Seconds every fake esptool call takes'
+    )
+    parser.add_argument('--save', help='Write the results as json')
+    args = parser.parse_args(argv)
+    if args.boards < 2:
+        parser.error('--boards must be at least 2')
+
+    result = run_provision(args)
+    print(format_result(result))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            results_file.write(json.dumps(result, indent=2))
+
+    return 1 if result['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+"""
+Event input harness for interrupt driven digital inputs.
+
+Boots a simulated device running `main.run()` with two event inputs: a
+bouncing push button switching a pump relay, and a flow meter sending a
+pulse train counted by a `read_count` rule. The edges are driven through
+the pins' irq handlers at their simulated time. Reports:
+
+- presses: button presses and releases driven
+- reactions: relay changes following them
+- latency: ms from the first edge of a press to the relay change
+- pulses: flow meter pulses driven and counted
+- dropped: edges dropped by the full ring buffer
+
+The run fails if a press or release is missed, a bounce switches the relay
+or a pulse is miscounted.
+
+Usage: python -m host.pulses [--duration S] [--presses N] [--bounces N]
+       [--flow-rate HZ] [--debounce MS] [--save FILE]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+import host
+from host import bench
+from host.iotserver import IotServer
+
+BUTTON_PIN = 14
+FLOW_PIN = 15
+RELAY_PIN = 4
+
+# Seconds the button is held down, and between the bounces of an edge
+HOLD = 0.5
+BOUNCE = 0.0007
+
+# Seconds a flow meter pulse is high, at most half the period
+PULSE_WIDTH = 0.004
+
+
+class StopPulses(BaseException):
+    pass
+
+
+def device_config(args):
+    pins = [
+        bench.pin('button', 'read_bool', BUTTON_PIN),
+        bench.pin('flow_meter', 'read_count', FLOW_PIN),
+        bench.pin(
+            'pump_relay', 'toggle', RELAY_PIN, read=False,
+            on={
+                'conditions': {
+                    'button': bench.condition('eq', True),
+                }
+            }
+        ),
+    ]
+    pins[0].update(event=True, debounce=args.debounce)
+    pins[1].update(event=True, debounce=1)
+    return bench.base_config(pins)
+
+
+class RelayOutputs(dict):
+    """
+    Output levels recording the simulated time of every relay change.
+    """
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+        self.changes = []
+
+    def __setitem__(self, pin_number, level):
+        if pin_number == RELAY_PIN and self.get(pin_number, level) != level:
+            self.changes.append((self.clock.now, level))
+        super().__setitem__(pin_number, level)
+
+
+def schedule_edge(clock, machine, when, level, bounces):
+    """
+    Drive an edge to `level` at `when`, bouncing back `bounces` times.
+    """
+    for index in range(bounces * 2 + 1):
+        bounced = level if index % 2 == 0 else int(not level)
+        clock.call_at(
+            when + index * BOUNCE,
+            lambda bounced=bounced: machine.drive(BUTTON_PIN, bounced)
+        )
+
+
+def schedule_pulses(clock, machine, start, end, rate):
+    """
+    Drive a flow meter pulse train, returns the number of pulses.
+    """
+    width = min(PULSE_WIDTH, 0.5 / rate)
+    count = 0
+    when = start
+    while when + width < end:
+        clock.call_at(when, lambda: machine.drive(FLOW_PIN, 1))
+        clock.call_at(when + width, lambda: machine.drive(FLOW_PIN, 0))
+        count += 1
+        when = start + count / rate
+    return count
+
+
+def run_pulses(args):
+    server = IotServer().start()
+    workdir = tempfile.mkdtemp(prefix='iotdevice-pulses-')
+    cwd = os.getcwd()
+    os.makedirs(os.path.join(workdir, 'config'))
+    os.chdir(workdir)
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            clock, main, mqtt = bench.boot(device_config(args), server)
+
+        import events
+        import machine
+
+        machine.INPUTS[BUTTON_PIN] = 0
+        machine.INPUTS[FLOW_PIN] = 0
+        outputs = machine.OUTPUTS = RelayOutputs(clock)
+
+        start = clock.now + 1
+        end = start + args.duration
+
+        # Spread the presses over the run, off the cycle boundaries
+        edges = []
+        spacing = args.duration / args.presses
+        for index in range(args.presses):
+            pressed = start + index * spacing + 0.137
+            edges.append((pressed, 1))
+            edges.append((pressed + HOLD, 0))
+        for when, level in edges:
+            schedule_edge(clock, machine, when, level, args.bounces)
+
+        generated = schedule_pulses(clock, machine, start, end, args.flow_rate)
+
+        counted = []
+        complete_rule = main.complete_rule
+
+        def record_count(mqtt, rule, value):
+            if rule.identifier == 'flow_meter':
+                counted.append(value)
+            complete_rule(mqtt, rule, value)
+
+        main.complete_rule = record_count
+
+        dropped = []
+        drain = events.drain
+
+        def record_dropped():
+            drained, count = drain()
+            dropped.append(count)
+            return drained, count
+
+        events.drain = record_dropped
+
+        def stop():
+            raise StopPulses()
+
+        clock.call_at(end + 1, stop)
+        reset = False
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                main.run(mqtt, main.CONFIG['pins'])
+        except StopPulses:
+            pass
+        except machine.DeviceReset:
+            reset = True
+
+        flow_meter = [
+            event_input for event_input in events.INPUTS
+            if event_input is not None and event_input.pin.id == FLOW_PIN
+        ][0]
+        counted.append(flow_meter.take_pulses())
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        host.reload()
+
+    # Match every edge with the first relay change after it
+    latencies = []
+    changes = list(outputs.changes)
+    for index, (when, level) in enumerate(edges):
+        following = edges[index + 1][0] if index + 1 < len(edges) else None
+        for changed, relay in changes:
+            if changed >= when and (following is None or changed < following):
+                if relay == level:
+                    latencies.append((changed - when) * 1000)
+                break
+
+    result = {
+        'reset': reset,
+        'presses': len(edges),
+        'reactions': len(latencies),
+        'relay_changes': len(changes),
+        'latency_p50_ms': bench.percentile(latencies, 50) if latencies else None,
+        'latency_max_ms': max(latencies) if latencies else None,
+        'pulses': generated,
+        'counted': sum(counted),
+        'dropped': sum(dropped),
+    }
+
+    failures = []
+    if reset:
+        failures.append('the device reset')
+    if result['reactions'] != result['presses']:
+        failures.append('presses missed')
+    if result['relay_changes'] != result['presses']:
+        failures.append('bounces switched the relay')
+    if result['counted'] != result['pulses']:
+        failures.append('pulses miscounted')
+    result['failures'] = failures
+    return result
+
+
+def format_result(result):
+    latency = '-'
+    if result['reactions']:
+        latency = '{latency_p50_ms:.0f} p50, {latency_max_ms:.0f} max'.format(
+            **result
+        )
+    lines = [
+        '{:<12} {presses}'.format('presses', **result),
+        '{:<12} {reactions} ({relay_changes} relay changes)'.format(
+            'reactions', **result
+        ),
+        '{:<12} {} ms'.format('latency', latency),
+        '{:<12} {counted} of {pulses}'.format('pulses', **result),
+        '{:<12} {dropped}'.format('dropped', **result),
+        '{:<12} {}'.format('failures', ', '.join(result['failures']) or '-'),
+    ]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--duration', type=float, default=120)
+    parser.add_argument('--presses', type=int, default=20)
+    parser.add_argument(
+        '--bounces', type=int, default=3,
+        help='Contact bounces after every button edge'
+    )
+    parser.add_argument('--flow-rate', type=float, default=40)
+    parser.add_argument('--debounce', type=int, default=20)
+    parser.add_argument('--save', help='Write the results as json')
+    args = parser.parse_args(argv)
+    if args.presses < 1 or args.duration / args.presses <= HOLD * 2:
+        parser.error('--presses must leave a second per press')
+
+    result = run_pulses(args)
+    print(format_result(result))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            results_file.write(json.dumps(result, indent=2))
+
+    return 1 if result['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+Fake serial endpoint for the install pipeline.
+
+Serves the MicroPython raw REPL protocol on a pty, executing the commands
+with CPython in a directory standing in for the device's filesystem. The
+pty path is printed on startup and can be passed to `cli.py install
+--port`.
+
+Usage: python -m host.repl DIRECTORY
+"""
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import traceback
+import tty
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BANNER = b'raw REPL; CTRL-B to exit\r\n>'
+
+
+class RawRepl(object):
+    """
+    The raw REPL state machine, fed the bytes received on the pty.
+    """
+
+    def __init__(self, write):
+        self.write = write
+        self.raw = False
+        self.code = bytearray()
+        self.globals = {}
+        self.executed = 0
+
+    def feed(self, data):
+        for byte in data:
+            if byte == 0x01:  # ctrl-A, enter the raw REPL
+                self.raw = True
+                self.code = bytearray()
+                self.write(BANNER)
+            elif byte == 0x02:  # ctrl-B, back to the friendly REPL
+                self.raw = False
+                self.write(b'\r\n>>> ')
+            elif byte == 0x03:  # ctrl-C, clears the raw REPL input
+                self.code = bytearray()
+            elif byte == 0x04 and self.raw:  # ctrl-D, soft reset or exec
+                if self.code:
+                    self.execute(bytes(self.code))
+                    self.code = bytearray()
+                else:
+                    self.globals = {}
+                    self.write(b'soft reboot\r\n' + BANNER)
+            elif self.raw:
+                self.code.append(byte)
+
+    def execute(self, code):
+        self.write(b'OK')
+        output = io.StringIO()
+        error = ''
+        try:
+            with contextlib.redirect_stdout(output):
+                exec(compile(code, '<stdin>', 'exec'), self.globals)
+        except Exception:
+            error = traceback.format_exc()
+        self.executed += 1
+        self.write(
+            output.getvalue().replace('\n', '\r\n').encode() + b'\x04'
+            + error.encode() + b'\x04>'
+        )
+
+
+def serve(directory):
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print(os.ttyname(slave), flush=True)
+
+    def write(data):
+        os.write(master, data)
+
+    repl = RawRepl(write)
+    while True:
+        try:
+            data = os.read(master, 4096)
+        except OSError:
+            break
+        if not data:
+            break
+        repl.feed(data)
+
+
+class FakeBoard(object):
+    """
+    Runs the fake serial endpoint in a child process.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.process = None
+        self.port = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'host.repl', self.directory],
+            stdout=subprocess.PIPE,
+            cwd=ROOT
+        )
+        self.port = self.process.stdout.readline().decode().strip()
+        return self
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory')
+    args = parser.parse_args()
+    try:
+        serve(os.path.abspath(args.directory))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,151 @@
+"""
+Status request harness for the `refresh-status` subscription.
+
+Boots a simulated device running `main.run()` with the digital bench config,
+which has no `mqtt_toggle` rule to poll the broker, and publishes a message
+to `iot-devices/{identifier}/refresh-status` during the sleep of every few
+cycles. Reports:
+
+- requests: status requests published
+- snapshots: full snapshots published after the first one
+- latency: peak cycles from a request to its snapshot
+
+The run fails if a request isn't answered with a snapshot in the next
+cycle, or a snapshot is published without a request.
+
+Usage: python -m host.status [--cycles N] [--every N] [--save FILE]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+import host
+from host import bench
+from host import broker as broker_module
+from host.iotserver import IotServer
+
+
+class StopStatus(BaseException):
+    pass
+
+
+def run_status(args):
+    server = IotServer().start()
+    workdir = tempfile.mkdtemp(prefix='iotdevice-status-')
+    cwd = os.getcwd()
+    os.makedirs(os.path.join(workdir, 'config'))
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            clock, main, mqtt = bench.boot(
+                bench.base_config(bench.digital_pins()), server
+            )
+
+        broker = broker_module.get_broker(bench.MQTT_HOST)
+        request_topic = 'iot-devices/{identifier}/refresh-status'.format(
+            identifier=bench.DEVICE_ID
+        ).encode()
+        snapshot_topic = 'iot-devices/{identifier}/status/'.format(
+            identifier=bench.DEVICE_ID
+        ).encode()
+        process_interval = main.CONFIG['main']['process_interval']
+
+        # Cycle of every snapshot and of every request, the first snapshot
+        # is published on boot
+        state = {'cycle': 0}
+        snapshots = []
+        requests = []
+        broker.observers.append(
+            lambda topic, msg: snapshots.append(state['cycle'])
+            if topic == snapshot_topic else None
+        )
+
+        def on_sleep(seconds):
+            if seconds != process_interval:
+                return
+
+            cycle = state['cycle'] = state['cycle'] + 1
+            if cycle >= args.cycles:
+                raise StopStatus()
+            if cycle % args.every == 0:
+                requests.append(cycle)
+                broker.publish(request_topic, b'1')
+
+        clock.on_sleep = on_sleep
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                main.run(mqtt, main.CONFIG['pins'])
+        except StopStatus:
+            pass
+        finally:
+            clock.on_sleep = None
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        host.reload()
+
+    # A request sent during a sleep is answered by the next cycle
+    answered = snapshots[1:]
+    latencies = [
+        snapshot - request for request, snapshot in zip(requests, answered)
+    ]
+    result = {
+        'requests': len(requests),
+        'snapshots': len(answered),
+        'latency_peak': max(latencies) if latencies else None,
+    }
+
+    failures = []
+    if not snapshots:
+        failures.append('no snapshot on boot')
+    if len(answered) < len(requests):
+        failures.append('a status request was ignored')
+    elif len(answered) > len(requests):
+        failures.append('a snapshot was published without a request')
+    if any(latency != 0 for latency in latencies):
+        failures.append('a snapshot was late')
+    result['failures'] = failures
+    return result
+
+
+def format_result(result):
+    lines = [
+        '{:<12} {requests}'.format('requests', **result),
+        '{:<12} {snapshots}'.format('snapshots', **result),
+        '{:<12} {} cycles'.format(
+            'latency', '-' if result['latency_peak'] is None
+            else result['latency_peak']
+        ),
+        '{:<12} {}'.format('failures', ', '.join(result['failures']) or '-'),
+    ]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument(
+        '--every', type=int, default=3,
+        help='Cycles between the status requests'
+    )
+    parser.add_argument('--save', help='Write the results as json')
+    args = parser.parse_args(argv)
+    if args.cycles < 2 or args.every < 1:
+        parser.error('--cycles must be at least 2 and --every at least 1')
+
+    result = run_status(args)
+    print(format_result(result))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            results_file.write(json.dumps(result, indent=2))
+
+    return 1 if result['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
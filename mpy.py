@@ -0,0 +1,171 @@
+"""
+Cross-compiles the embedded modules to .mpy bytecode with mpy-cross.
+
+Artifacts are cached in `CACHE_DIR` under the sha256 of the source, the
+compiler version and the flags, so rebuilding unchanged modules costs
+nothing. When mpy-cross is missing, fails or emits a different .mpy version
+than the firmware loads, the sources are uploaded instead.
+
+MicroPython only runs `boot.py` and `main.py` as source, so `main.py` is
+compiled as the `firmware` module and a small `main.py` stub starts it.
+"""
+import hashlib
+import os
+import re
+import subprocess
+
+CACHE_DIR = '.mpy-cache'
+MPY_CROSS = os.environ.get('MPY_CROSS', 'mpy-cross')
+
+# The .mpy version loaded by the MicroPython 1.19 firmware
+MPY_VERSION = 6
+
+# mpy-cross architecture and its code in the .mpy header by chip
+ARCHS = {'esp8266': ('xtensa', 9), 'esp32': ('xtensawin', 10)}
+
+# Device paths uploaded as source
+SOURCE_ONLY = ('boot.py', 'drivers/__init__.py')
+
+MAIN_STUB = b'''# Starts the precompiled firmware, see mpy.py
+import firmware
+
+firmware.start()
+'''
+
+
+class CompileError(Exception):
+    pass
+
+
+def compiler_version():
+    """
+    Returns the mpy-cross version banner or None if it isn't installed.
+    """
+    try:
+        result = subprocess.run(
+            [MPY_CROSS, '--version'], capture_output=True, text=True
+        )
+    except OSError:
+        return None
+    if result.returncode:
+        return None
+    return result.stdout.strip()
+
+
+def emitted_version(banner):
+    """
+    Returns the .mpy version emitted by the compiler with the banner.
+    """
+    match = re.search(r'mpy v(\d+)', banner)
+    return int(match.group(1)) if match else None
+
+
+def check_mpy(path, chip):
+    """
+    Check the header of a compiled module: the magic, the .mpy version and,
+    for modules with native code, the architecture.
+    """
+    with open(path, 'rb') as mpy_file:
+        header = mpy_file.read(4)
+
+    if len(header) < 4 or header[0] != ord('M'):
+        raise CompileError(f'{path} is not a .mpy file')
+    if header[1] != MPY_VERSION:
+        raise CompileError(
+            f'{path} is .mpy v{header[1]}, the firmware loads v{MPY_VERSION}'
+        )
+    arch = header[2] >> 2
+    if arch and arch != ARCHS[chip][1]:
+        raise CompileError(f'{path} has native code for another chip')
+    if header[3] > 31:
+        raise CompileError(f'{path} needs {header[3]} bit small ints')
+
+
+def build(source_path, name, chip, banner):
+    """
+    Returns the path of the compiled module and whether it came from the
+    cache. `name` is the source name recorded in tracebacks.
+    """
+    flags = ['-march=' + ARCHS[chip][0]]
+    with open(source_path, 'rb') as source_file:
+        source = source_file.read()
+
+    key = hashlib.sha256(
+        b'\0'.join([
+            source,
+            banner.encode('utf-8'),
+            ' '.join(flags + [name]).encode('utf-8'),
+        ])
+    ).hexdigest()
+    path = os.path.join(CACHE_DIR, key + '.mpy')
+    if os.path.exists(path):
+        return path, True
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = path + '.tmp'
+    result = subprocess.run(
+        [MPY_CROSS] + flags + ['-s', name, '-o', temp_path, source_path],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode:
+        raise CompileError(result.stderr.strip() or result.stdout.strip())
+
+    check_mpy(temp_path, chip)
+    os.replace(temp_path, path)
+    return path, False
+
+
+def write_main_stub():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, 'main.py')
+    with open(path, 'wb') as stub_file:
+        stub_file.write(MAIN_STUB)
+    return path
+
+
+def compile_files(files, chip, echo=print):
+    """
+    Swap the python modules of the (local path, device path) pairs for
+    compiled ones. Returns the files to upload, the stale sources to remove
+    from the device, which would shadow the compiled modules, and a summary
+    row per compiled module.
+    """
+    banner = compiler_version()
+    if banner is None:
+        echo(f'{MPY_CROSS} not found, uploading the sources')
+        return files, [], []
+    if emitted_version(banner) != MPY_VERSION:
+        echo(
+            f'{banner} doesn\'t emit .mpy v{MPY_VERSION}, uploading the '
+            'sources'
+        )
+        return files, [], []
+
+    compiled = []
+    remove = []
+    rows = []
+    for local_path, path in files:
+        if not path.endswith('.py') or path in SOURCE_ONLY:
+            compiled.append((local_path, path))
+            continue
+
+        module_path = 'firmware.py' if path == 'main.py' else path
+        try:
+            mpy_path, cached = build(local_path, module_path, chip, banner)
+        except CompileError as exc:
+            echo(f'Could not compile {path}, uploading the source: {exc}')
+            compiled.append((local_path, path))
+            continue
+
+        compiled.append((mpy_path, module_path[:-3] + '.mpy'))
+        if path == 'main.py':
+            compiled.append((write_main_stub(), 'main.py'))
+        else:
+            remove.append(path)
+        rows.append((
+            path, os.path.getsize(local_path), os.path.getsize(mpy_path),
+            cached
+        ))
+
+    return compiled, remove, rows
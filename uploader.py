@@ -0,0 +1,175 @@
+"""
+Uploads the firmware to a device over a single raw REPL session.
+
+The device keeps a manifest of the sha256 digest and size of every file
+uploaded, in `MANIFEST_PATH`. Only the files whose digest differs from the
+manifest, or whose size on the device no longer matches it, are sent. Each
+file is written to a temporary file in base64 chunks and then renamed into
+place, so an interrupted upload never leaves a truncated module behind.
+"""
+import binascii
+import hashlib
+import json
+import posixpath
+
+from ampy.pyboard import Pyboard, PyboardError
+
+MANIFEST_PATH = 'manifest.json'
+
+# Bytes of file data sent per raw REPL command
+CHUNK_SIZE = 2048
+
+READ_MANIFEST = '''
+import json, os
+try:
+    with open({path!r}) as f:
+        m = json.load(f)
+except (OSError, ValueError):
+    m = {{}}
+for p in list(m):
+    try:
+        s = os.stat(p)[6]
+    except OSError:
+        s = -1
+    if s != m[p][1]:
+        del m[p]
+print(json.dumps(m))
+'''
+
+MKDIR = '''
+import os
+try:
+    os.mkdir({path!r})
+except OSError:
+    pass
+'''
+
+OPEN = '''
+import binascii
+f = open({path!r}, 'wb')
+'''
+
+WRITE = 'f.write(binascii.a2b_base64({data!r}))'
+
+CLOSE = '''
+f.close()
+import os
+try:
+    os.remove({path!r})
+except OSError:
+    pass
+os.rename({temp_path!r}, {path!r})
+'''
+
+REMOVE = '''
+import os
+for p in {paths!r}:
+    try:
+        os.remove(p)
+    except OSError:
+        pass
+'''
+
+
+class Uploader(object):
+    """
+    A raw REPL session with the device on the port.
+    """
+
+    def __init__(self, port, baudrate=115200, chunk_size=CHUNK_SIZE):
+        self.board = Pyboard(port, baudrate=baudrate)
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        self.board.enter_raw_repl()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self.board.exit_raw_repl()
+        finally:
+            self.board.close()
+
+    def exec(self, code):
+        return self.board.exec_(code).decode('utf-8')
+
+    def read_manifest(self):
+        """
+        Returns the manifest of the files on the device which still have the
+        recorded size.
+        """
+        output = self.exec(READ_MANIFEST.format(path=MANIFEST_PATH))
+        return json.loads(output.strip() or '{}')
+
+    def write_manifest(self, manifest):
+        self.put(MANIFEST_PATH, json.dumps(manifest).encode('utf-8'))
+
+    def makedirs(self, path):
+        if not path:
+            return
+        self.makedirs(posixpath.dirname(path))
+        self.exec(MKDIR.format(path=path))
+
+    def put(self, path, data):
+        temp_path = path + '.tmp'
+        self.exec(OPEN.format(path=temp_path))
+        for start in range(0, len(data), self.chunk_size):
+            chunk = data[start:start + self.chunk_size]
+            self.exec(WRITE.format(
+                data=binascii.b2a_base64(chunk, newline=False).decode('ascii')
+            ))
+        self.exec(CLOSE.format(path=path, temp_path=temp_path))
+
+    def remove(self, paths):
+        self.exec(REMOVE.format(paths=list(paths)))
+
+    def sync(self, files, echo=print, remove=()):
+        """
+        Upload the changed files, given as (local path, device path) pairs,
+        and then delete the `remove` paths. Returns the device paths
+        uploaded.
+
+        The `remove` paths are only deleted once every file is in place,
+        so an interrupted upload leaves the old sources, which shadow a
+        partly uploaded `.mpy`, instead of neither.
+        """
+        manifest = self.read_manifest()
+        uploaded = []
+        removed = []
+        try:
+            for local_path, path in files:
+                with open(local_path, 'rb') as _file:
+                    data = _file.read()
+                digest = hashlib.sha256(data).hexdigest()
+                if manifest.get(path, [None])[0] == digest:
+                    continue
+
+                echo(f'Uploading {path} ({len(data)} bytes)')
+                self.makedirs(posixpath.dirname(path))
+                self.put(path, data)
+                manifest[path] = [digest, len(data)]
+                uploaded.append(path)
+
+            if remove:
+                self.remove(remove)
+                removed = [path for path in remove if path in manifest]
+                for path in removed:
+                    del manifest[path]
+        finally:
+            # Record what was uploaded, even if a later file failed
+            if uploaded or removed:
+                self.write_manifest(manifest)
+
+        return uploaded
+
+
+def upload(port, files, echo=print, remove=(), **kwargs):
+    """
+    Sync the files to the device on the port in one session. Returns the
+    device paths uploaded.
+    """
+    try:
+        with Uploader(port, **kwargs) as uploader:
+            return uploader.sync(files, echo, remove)
+    except PyboardError as exc:
+        raise OSError(f'Upload to {port} failed: {exc}') from exc